@@ -0,0 +1,202 @@
+import time
+import threading
+from collections import OrderedDict
+
+from django.core.urlresolvers import RegexURLResolver, ResolverMatch, Resolver404
+
+# Characters of a pattern that are not a literal character of the path
+_SPECIAL = set('.^$*+?{}[]()|\\')
+_QUANTIFIERS = set('*+?{')
+
+# Route statistics, keyed by view name: hits and time spent resolving
+_stats = {}
+_stats_lock = threading.Lock()
+_totals = {'hits': 0, 'cache_hits': 0, 'not_found': 0, 'ms': 0.0}
+
+def _get_literal_prefix(pattern):
+    # Returns the text every path the pattern matches starts with, and
+    # whether the pattern matches that text only; None if the pattern
+    # cannot be reasoned about this way.
+
+    if '|' in pattern or not pattern.startswith('^'):
+        return None
+    prefix = []
+    i = 1
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '\\':
+            if i + 1 < len(pattern) and not pattern[i + 1].isalnum():
+                char = pattern[i + 1]
+                i += 1
+            else:
+                break
+        elif char in _SPECIAL:
+            break
+        i += 1
+        if i < len(pattern) and pattern[i] in _QUANTIFIERS:
+            # The last character is repeated or optional
+            return ''.join(prefix), False
+        prefix.append(char)
+    return ''.join(prefix), pattern[i:] == '$'
+
+def _get_key(pattern):
+    # First path segment of all the paths the pattern matches, None if
+    # there is no such segment.
+
+    literal = _get_literal_prefix(pattern)
+    if literal is None:
+        return None
+    prefix, exact = literal
+    if '/' in prefix:
+        return prefix.split('/', 1)[0]
+    if exact:
+        return prefix
+    return None
+
+def _record(match, elapsed, cached):
+    with _stats_lock:
+        _totals['hits'] += 1
+        _totals['ms'] += elapsed
+        if match is None:
+            _totals['not_found'] += 1
+            return
+        if cached:
+            _totals['cache_hits'] += 1
+        stats = _stats.get(match.view_name)
+        if stats is None:
+            stats = _stats[match.view_name] = {'hits': 0, 'ms': 0.0, 'max_ms': 0.0}
+        stats['hits'] += 1
+        stats['ms'] += elapsed
+        stats['max_ms'] = max(stats['max_ms'], elapsed)
+
+def route_stats():
+    """
+    Hits and resolve time of each route, most hit first, with totals.
+    """
+    with _stats_lock:
+        routes = []
+        for name, values in sorted(_stats.items(), key=lambda item: item[1]['hits'], reverse=True):
+            route = dict(values, name=name)
+            route['avg_ms'] = values['ms'] / values['hits']
+            routes.append(route)
+        return {'totals': dict(_totals), 'routes': routes}
+
+class Dispatcher(RegexURLResolver):
+    """
+    Resolves paths against urlpatterns as Django does, trying them in
+    order, and records hits and resolve time of each route.
+
+    In compiled mode, only the patterns that can match the first segment
+    of the path are tried, still in order, so that the match is the one
+    trying all of them would give. Matches of the last cache_size paths
+    are kept. Paths nothing matches are resolved the regular way to
+    raise the usual Resolver404.
+    """
+    def __init__(self, urlpatterns, compiled=False, cache_size=1024):
+        super(Dispatcher, self).__init__(r'^', urlpatterns)
+        self.compiled = compiled
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._index = None
+
+    def _build_index(self):
+        # Indexes of the patterns by first path segment. Patterns with
+        # no definite first segment are tried for every path.
+        index, unkeyed = {}, []
+        for i, pattern in enumerate(self.url_patterns):
+            key = _get_key(pattern.regex.pattern)
+            if key is None:
+                unkeyed.append(i)
+            else:
+                index.setdefault(key, []).append(i)
+        patterns = list(self.url_patterns)
+        return dict((key, [patterns[i] for i in sorted(indexes + unkeyed)]) for key, indexes in index.items()), \
+            [patterns[i] for i in unkeyed]
+
+    def _get_candidates(self, path):
+        if self._index is None:
+            self._index = self._build_index()
+        index, unkeyed = self._index
+        return index.get(path.split('/', 1)[0], unkeyed)
+
+    def _resolve(self, path):
+        for pattern in self._get_candidates(path):
+            try:
+                sub_match = pattern.resolve(path)
+            except Resolver404:
+                continue
+            if sub_match:
+                return ResolverMatch(sub_match.func, sub_match.args, sub_match.kwargs, sub_match.url_name,
+                                     sub_match.app_name, sub_match.namespaces)
+        return super(Dispatcher, self).resolve(path)
+
+    def resolve(self, path):
+        start = time.time()
+        match, cached = None, False
+        try:
+            if not self.compiled:
+                match = super(Dispatcher, self).resolve(path)
+                return match
+            with self._lock:
+                match = self._cache.get(path)
+                if match is not None:
+                    del self._cache[path]
+                    self._cache[path] = match
+                    cached = True
+            if match is None:
+                match = self._resolve(path)
+                with self._lock:
+                    self._cache[path] = match
+                    while len(self._cache) > self.cache_size:
+                        self._cache.popitem(last=False)
+            # The caller may change kwargs
+            return ResolverMatch(match.func, match.args, dict(match.kwargs), match.url_name, match.app_name,
+                                 match.namespaces)
+        finally:
+            _record(match, (time.time() - start) * 1000, cached)
+
+def dispatch(urlpatterns, compiled=False, cache_size=1024):
+    """
+    Returns urlpatterns resolved through a Dispatcher. Reversing URLs is
+    not affected.
+    """
+    return [Dispatcher(urlpatterns, compiled, cache_size)]
+
+if __name__ == '__main__':
+    # python -m conf.routing [path ...]
+    # Checks that compiled dispatch resolves the given paths as the
+    # URLconf does, then compares their resolve time in both modes.
+
+    import os
+    import sys
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "conf.settings")
+    from django.conf import settings
+    from django.utils.importlib import import_module
+
+    urlpatterns = import_module(settings.ROOT_URLCONF).urlpatterns
+    if len(urlpatterns) == 1 and isinstance(urlpatterns[0], Dispatcher):
+        urlpatterns = urlpatterns[0].url_patterns
+    paths = [path.lstrip('/') for path in sys.argv[1:]] or \
+            ['', 'shopping/cart/', 'playground/confirm_checkout', 'welcome/', 'offline.html', 'nowhere/']
+
+    def describe(resolver, path):
+        try:
+            match = resolver.resolve(path)
+        except Resolver404:
+            return None
+        return match.func, match.args, match.kwargs, match.url_name, match.app_name, match.namespaces
+
+    regular, compiled = Dispatcher(urlpatterns), Dispatcher(urlpatterns, compiled=True)
+    mismatches = 0
+    for path in paths:
+        if describe(regular, path) != describe(compiled, path):
+            mismatches += 1
+            print >> sys.stdout, 'Mismatch: /%s' % path
+    for name, resolver in (('regular', regular), ('compiled', compiled)):
+        start = time.time()
+        for i in range(1000):
+            for path in paths:
+                describe(resolver, path)
+        print >> sys.stdout, '%s: %.1f us per resolve' % (name, (time.time() - start) * 1e6 / (1000 * len(paths)))
+    print >> sys.stdout, '%d paths, %d mismatches' % (len(paths), mismatches)
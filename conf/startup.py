@@ -0,0 +1,229 @@
+import gc
+import os
+import sys
+import time
+import threading
+
+try:
+    import __builtin__ as builtins
+except ImportError:
+    import builtins
+
+# Paths resolved by preload(). Resolving them imports their URLconfs and
+# views; the URLconfs of other paths are imported on the first request
+# that matches their prefix.
+HOT_PATHS = ['/', '/shopping/', '/shopping/cart/', '/playground/confirm_checkout', '/kako/', '/daraja/']
+
+# Import timer. Time spent importing a module, not counting the modules
+# it imports, keyed by module name. Only imports made by the thread that
+# started the timer are timed.
+_import_times = {}
+_nested = []
+_original_import = None
+_timer_thread = None
+
+_preloaded = None
+
+def _timed_import(name, *args, **kwargs):
+    if threading.current_thread() is not _timer_thread:
+        return _original_import(name, *args, **kwargs)
+    fromlist = args[2] if len(args) > 2 else kwargs.get('fromlist')
+    key = name
+    if name in sys.modules and fromlist:
+        key = '%s.%s' % (name, fromlist[0])
+    module_count = len(sys.modules)
+    _nested.append(0.0)
+    start = time.time()
+    try:
+        return _original_import(name, *args, **kwargs)
+    finally:
+        elapsed = time.time() - start
+        nested = _nested.pop()
+        if _nested:
+            _nested[-1] += elapsed
+        if len(sys.modules) > module_count:
+            _import_times[key] = _import_times.get(key, 0) + elapsed - nested
+
+def start_import_timer():
+    global _original_import, _timer_thread
+    if _original_import is not None:
+        return
+    _timer_thread = threading.current_thread()
+    _original_import = builtins.__import__
+    builtins.__import__ = _timed_import
+
+def stop_import_timer():
+    global _original_import
+    if _original_import is None:
+        return
+    builtins.__import__ = _original_import
+    _original_import = None
+
+def get_slowest_imports(count=20):
+    """
+    Returns the count modules that took longest to import while the
+    timer ran, as (name, seconds) slowest first.
+    """
+    return sorted(_import_times.items(), key=lambda item: item[1], reverse=True)[:count]
+
+def memory_usage():
+    """
+    Resident memory of this process in kB, and its private part: the
+    pages not shared with other processes, like the copy-on-write pages
+    a worker inherited from a preloading master and never wrote to.
+    private is None where /proc does not tell.
+    """
+    usage = {'rss': None, 'private': None}
+    try:
+        with open('/proc/self/status') as fh:
+            for line in fh:
+                if line.startswith('VmRSS:'):
+                    usage['rss'] = int(line.split()[1])
+    except IOError:
+        import resource
+        usage['rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    for path in ('/proc/self/smaps_rollup', '/proc/self/smaps'):
+        try:
+            with open(path) as fh:
+                private = 0
+                for line in fh:
+                    if line.startswith('Private_Clean:') or line.startswith('Private_Dirty:'):
+                        private += int(line.split()[1])
+            usage['private'] = private
+            break
+        except IOError:
+            continue
+    return usage
+
+class LazyView(object):
+    """
+    View imported from path on its first call, then decorated with
+    decorators, innermost first. Class-based views are made views with
+    as_view(). Attributes middlewares look up on views, like
+    csrf_exempt, are those of the loaded view.
+    """
+    def __init__(self, path, *decorators):
+        self.path = path
+        self.decorators = decorators
+        self._view = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self._view is None:
+            with self._lock:
+                if self._view is None:
+                    module_name, attr = self.path.rsplit('.', 1)
+                    __import__(module_name)
+                    view = getattr(sys.modules[module_name], attr)
+                    if hasattr(view, 'as_view'):
+                        view = view.as_view()
+                    for decorator in self.decorators:
+                        view = decorator(view)
+                    self._view = view
+        return self._view
+
+    def __call__(self, request, *args, **kwargs):
+        return self.load()(request, *args, **kwargs)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+    def __repr__(self):
+        return '<LazyView %s>' % self.path
+
+def lazy_view(path, *decorators):
+    return LazyView(path, *decorators)
+
+def preload(paths=None, modules=None, languages=None):
+    """
+    Imports modules and the URLconfs and views of paths, builds the URL
+    reverse maps of their namespaces and loads the translation catalogs
+    of languages, LANGUAGE_CODE by default, so that this is done once in
+    a master process and shared by the workers it forks. Database
+    connections opened meanwhile are closed, as forked workers must not
+    share them.
+    """
+    global _preloaded
+    from django.conf import settings
+    from django.core.urlresolvers import get_resolver, resolve, Resolver404
+    from django.db import connections
+    from django.utils import translation
+
+    prefix = 'startup (pid=%d):' % os.getpid()
+    start = time.time()
+    errors = 0
+    for name in modules or []:
+        try:
+            __import__(name)
+        except Exception as e:
+            errors += 1
+            print >> sys.stderr, '%s Failed to preload %s: %s' % (prefix, name, e)
+
+    resolver = get_resolver(None)
+    resolver.reverse_dict
+    for path in HOT_PATHS if paths is None else paths:
+        try:
+            match = resolve(path)
+        except Resolver404:
+            # The URLconfs on the way were imported all the same
+            continue
+        except Exception as e:
+            errors += 1
+            print >> sys.stderr, '%s Failed to preload %s: %s' % (prefix, path, e)
+            continue
+        if isinstance(match.func, LazyView):
+            match.func.load()
+        namespace_resolver = resolver
+        for namespace in match.namespaces:
+            namespace_resolver = namespace_resolver.namespace_dict[namespace][1]
+            namespace_resolver.reverse_dict
+
+    for language in languages or [settings.LANGUAGE_CODE]:
+        translation.activate(language)
+    translation.deactivate()
+
+    for connection in connections.all():
+        connection.close()
+    gc.collect()
+    _preloaded = {'seconds': time.time() - start, 'errors': errors}
+    print >> sys.stderr, '%s Preloaded in %.2fs with %d errors.' % (prefix, _preloaded['seconds'], errors)
+    return _preloaded
+
+def report(count=20):
+    """
+    Startup report of this process: slowest imports, if the timer ran,
+    preloading and memory usage. Workers forked from a preloading master
+    report the imports of the master.
+    """
+    return {
+        'pid': os.getpid(),
+        'preloaded': _preloaded,
+        'slowest_imports': get_slowest_imports(count),
+        'memory': memory_usage(),
+    }
+
+def print_report(count=20, stream=None):
+    stream = stream or sys.stderr
+    prefix = 'startup (pid=%d):' % os.getpid()
+    for name, seconds in get_slowest_imports(count):
+        print >> stream, '%s %8.1f ms  %s' % (prefix, seconds * 1000, name)
+    usage = memory_usage()
+    private = '%d kB' % usage['private'] if usage['private'] is not None else 'unknown'
+    print >> stream, '%s Resident memory: %s kB, private: %s.' % (prefix, usage['rss'], private)
+
+if __name__ == '__main__':
+    # python -m conf.startup [path ...]
+    # Reports what importing the URLconf and preloading the given paths,
+    # or HOT_PATHS, costs in a fresh process.
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "conf.settings")
+    start_import_timer()
+    start = time.time()
+    from django.core.wsgi import get_wsgi_application
+    get_wsgi_application()
+    preload(sys.argv[1:] or None)
+    stop_import_timer()
+    print >> sys.stdout, 'Startup took %.2fs, %d modules timed.' % (time.time() - start, len(_import_times))
+    print_report(stream=sys.stdout)
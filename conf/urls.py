@@ -1,17 +1,18 @@
+from django.conf import settings
 from django.conf.urls import patterns, include, url
 
 from django.contrib import admin
 from django.contrib.auth.decorators import permission_required, user_passes_test
 
 from ikwen.accesscontrol.utils import is_staff
-from ikwen.core.views import Offline
 
 from ikwen_kakocase.shopping.views import FlatPageView, Home
-from ikwen_kakocase.kakocase.views import Welcome, AdminHome
-from ikwen_kakocase.trade.provider.views import ProviderDashboard, CCMDashboard
+
+from conf.routing import dispatch
+from conf.startup import lazy_view
 
 # from playground.views import save_ghost_user
-from playground.views import confirm_checkout, PlaygroundCart
+from playground.views import confirm_checkout, order_rollups, runtime_stats, PlaygroundCart
 
 admin.autodiscover()
 
@@ -29,6 +30,8 @@ urlpatterns = patterns(
     url(r'^shopping/cart/(?P<order_id>[-\w]+)/$', PlaygroundCart.as_view(), name='cart'),
     url(r'^shopping/', include('ikwen_kakocase.shopping.urls', namespace='shopping')),
     url(r'^playground/confirm_checkout', confirm_checkout, name='confirm_checkout'),
+    url(r'^playground/stats$', user_passes_test(is_staff)(runtime_stats), name='runtime_stats'),
+    url(r'^playground/rollups$', user_passes_test(is_staff)(order_rollups), name='order_rollups'),
 
     url(r'^i18n/', include('django.conf.urls.i18n')),
     url(r'^currencies/', include('currencies.urls')),
@@ -39,24 +42,30 @@ urlpatterns = patterns(
     url(r'^rewarding/', include('ikwen.rewarding.urls', namespace='rewarding')),
     url(r'^daraja/', include('daraja.urls', namespace='daraja')),
 
-    url(r'^ikwen/dashboard/$', permission_required('trade.ik_view_dashboard')(ProviderDashboard.as_view()), name='dashboard'),
-    url(r'^ikwen/CCMDashboard/$', permission_required('trade.ik_view_dashboard')(CCMDashboard.as_view()), name='ccm_dashboard'),
+    url(r'^ikwen/dashboard/$', lazy_view('ikwen_kakocase.trade.provider.views.ProviderDashboard', permission_required('trade.ik_view_dashboard')), name='dashboard'),
+    url(r'^ikwen/CCMDashboard/$', lazy_view('ikwen_kakocase.trade.provider.views.CCMDashboard', permission_required('trade.ik_view_dashboard')), name='ccm_dashboard'),
     url(r'^ikwen/theming/', include('ikwen.theming.urls', namespace='theming')),
     url(r'^cci/', include('ikwen_kakocase.cci.urls', namespace='cci')),
     url(r'^ikwen/cashout/', include('ikwen.cashout.urls', namespace='cashout')),
-    url(r'^ikwen/home/$', user_passes_test(is_staff)(AdminHome.as_view()), name='admin_home'),
+    url(r'^ikwen/home/$', lazy_view('ikwen_kakocase.kakocase.views.AdminHome', user_passes_test(is_staff)), name='admin_home'),
     url(r'^ikwen/', include('ikwen.core.urls', namespace='ikwen')),
 
     url(r'^echo/', include('echo.urls', namespace='echo')),
 
     # url(r'^$', ProviderDashboard.as_view(), name='admin_home'),
     url(r'^page/(?P<url>[-\w]+)/$', FlatPageView.as_view(), name='flatpage'),
-    url(r'^welcome/$', Welcome.as_view(), name='welcome'),
+    url(r'^welcome/$', lazy_view('ikwen_kakocase.kakocase.views.Welcome'), name='welcome'),
 
     url(r'^home/', include('ikwen_webnode.webnode.urls', namespace='webnode')),
     url(r'^$', Home.as_view(), name='home'),
 
-    url(r'^offline.html$', Offline.as_view(), name='offline'),
+    url(r'^offline.html$', lazy_view('ikwen.core.views.Offline'), name='offline'),
     # url(r'^save_ghost_user$', save_ghost_user, name='save_ghost_user'),
 )
 
+# Routes are resolved through conf.routing, which records their hits. With
+# URL_DISPATCH_COMPILED = True, only the patterns that can match the first
+# segment of the path are tried, and matches of the last
+# URL_DISPATCH_CACHE_SIZE paths are kept.
+urlpatterns = dispatch(urlpatterns, getattr(settings, 'URL_DISPATCH_COMPILED', False),
+                       getattr(settings, 'URL_DISPATCH_CACHE_SIZE', 1024))
@@ -7,14 +7,64 @@ For more information on this file, see
 https://docs.djangoproject.com/en/1.6/howto/deployment/wsgi/
 """
 
+import hashlib
 import os
+import signal
+import tempfile
 
-from conf import monitor
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "conf.settings")
 
-monitor.start(interval=1.0)
-monitor.track(os.path.join(os.path.dirname(__file__)))
+from django.conf import settings
 
-os.environ.setdefault("DJANGO_SETTINGS_MODULE", "conf.settings")
+# With WSGI_IMPORT_REPORT = True, the slowest imports of startup and the
+# resident memory are printed once the application is loaded. With
+# WSGI_PRELOAD = True, the URLconf and the views of WSGI_PRELOAD_PATHS
+# (startup.HOT_PATHS by default) are imported here, along with
+# WSGI_PRELOAD_MODULES; load this module in the master process (e.g.
+# gunicorn --preload) for workers to share them instead of each
+# importing them on its first request.
+from conf import startup
+
+import_report = getattr(settings, 'WSGI_IMPORT_REPORT', False)
+if import_report:
+    startup.start_import_timer()
+
+# Set MONITOR_CODE_CHANGES = False in production settings to skip the
+# change monitor entirely. MONITOR_MODE is 'inotify' or 'poll'. With
+# MONITOR_GRACEFUL_RELOAD = True, workers drain their requests and exit
+# one at a time instead of being interrupted. They take turns on the
+# MONITOR_LOCK_PATH file, one per project by default, and send
+# MONITOR_PARENT_SIGNAL (e.g. 'SIGHUP') to their process manager if set.
+monitor_code_changes = getattr(settings, 'MONITOR_CODE_CHANGES', True)
+graceful_reload = monitor_code_changes and getattr(settings, 'MONITOR_GRACEFUL_RELOAD', False)
+if monitor_code_changes:
+    from conf import monitor
+
+    if graceful_reload:
+        base_dir = getattr(settings, 'BASE_DIR', os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        lock_path = getattr(settings, 'MONITOR_LOCK_PATH', None) or \
+            os.path.join(tempfile.gettempdir(), 'monitor-reload-%s.lock' % hashlib.md5(base_dir).hexdigest()[:12])
+        parent_signal = getattr(settings, 'MONITOR_PARENT_SIGNAL', None)
+        if isinstance(parent_signal, basestring):
+            parent_signal = getattr(signal, parent_signal)
+        monitor.graceful(drain_timeout=getattr(settings, 'MONITOR_DRAIN_TIMEOUT', 30),
+                         stagger=getattr(settings, 'MONITOR_RELOAD_STAGGER', 5),
+                         lock_path=lock_path, parent_signal=parent_signal)
+    # When preloading, this runs in the master process: workers start
+    # the monitor on their first request instead.
+    if not getattr(settings, 'WSGI_PRELOAD', False):
+        monitor.start(interval=1.0, mode=getattr(settings, 'MONITOR_MODE', 'inotify'))
+    monitor.track(os.path.join(os.path.dirname(__file__)))
 
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
+if getattr(settings, 'WSGI_PRELOAD', False):
+    startup.preload(getattr(settings, 'WSGI_PRELOAD_PATHS', None), getattr(settings, 'WSGI_PRELOAD_MODULES', None),
+                    getattr(settings, 'WSGI_PRELOAD_LANGUAGES', None))
+if import_report:
+    startup.stop_import_timer()
+    startup.print_report()
+if graceful_reload:
+    application = monitor.wrap(application)
+if monitor_code_changes and getattr(settings, 'WSGI_PRELOAD', False):
+    application = monitor.deferred(application, interval=1.0, mode=getattr(settings, 'MONITOR_MODE', 'inotify'))
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic multi-tenant fixtures and measurement helpers for the checkout
+benchmarks. Fixtures are created in throwaway databases: the test
+databases of 'default' and UMBRELLA, and bench_* tenant databases for
+providers, the delivery company and the referring Daras.
+"""
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections, reset_queries
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.utils.importlib import import_module
+
+from ikwen.accesscontrol.backends import UMBRELLA
+from ikwen.accesscontrol.models import Member
+from ikwen.billing.models import PaymentMean
+from ikwen.core.models import Service, Application
+from ikwen_kakocase.kako.models import Product
+from ikwen_kakocase.kakocase.models import OperatorProfile, ProductCategory, DeliveryOption
+from ikwen_kakocase.shopping.models import Customer
+from ikwen_kakocase.trade.models import Order, OrderEntry, DeliveryAddress
+
+from daraja.models import Dara, DARAJA
+
+from playground import jobs, mail
+from playground.db import use_database
+from playground.stubs import StubHTTPServer
+
+
+def count_queries():
+    """
+    Number of queries run on each database since the last reset_queries().
+    Queries are only recorded when settings.DEBUG is True.
+    """
+    return dict((alias, len(connections[alias].queries)) for alias in settings.DATABASES.keys()
+                if connections[alias].queries)
+
+
+class Measure(object):
+    """
+    Measures wall time, queries per database and thread growth of a block.
+    """
+    def __init__(self):
+        self.elapsed = 0
+        self.queries = {}
+        self.threads = 0
+
+    @contextmanager
+    def __call__(self):
+        reset_queries()
+        threads = threading.active_count()
+        start = time.time()
+        try:
+            yield self
+        finally:
+            self.elapsed += time.time() - start
+            self.threads = max(self.threads, threading.active_count() - threads)
+            for alias, count in count_queries().items():
+                self.queries[alias] = self.queries.get(alias, 0) + count
+
+    def as_dict(self, runs=1):
+        runs = float(runs)
+        return {
+            'ms': self.elapsed * 1000 / runs,
+            'queries': sum(self.queries.values()) / runs,
+            'queries_per_database': dict((alias, count / runs) for alias, count in self.queries.items()),
+            'threads': self.threads,
+        }
+
+
+@contextmanager
+def benchmark_databases(tenant_aliases):
+    """
+    Runs the block against test databases for 'default' and UMBRELLA
+    and registers tenant_aliases, whose databases are dropped afterwards.
+    """
+    created = []
+    for alias in tenant_aliases:
+        use_database(alias)
+    try:
+        for alias in ['default', UMBRELLA] + list(tenant_aliases):
+            connection = connections[alias]
+            old_name = connection.settings_dict['NAME']
+            connection.creation.create_test_db(verbosity=0, autoclobber=True)
+            created.append((connection, old_name))
+        yield
+    finally:
+        for connection, old_name in reversed(created):
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+@contextmanager
+def stubbed_side_effects(views_module):
+    """
+    Routes emails to the locmem backend, partner callbacks to a local
+    stub server, and replaces the SMS sender of the views with a no-op.
+    Background jobs and the Mailer are replaced by ones of the block,
+    with a throwaway Outbox, and drained before it ends. Yields the stub
+    server.
+    """
+    stub = StubHTTPServer().start()
+    outbox_dir = tempfile.mkdtemp(prefix='bench_outbox_')
+    executor = jobs.JobExecutor(jobs.Outbox(os.path.join(outbox_dir, 'outbox.sqlite3')))
+    mailer = mail.Mailer(backend='django.core.mail.backends.locmem.EmailBackend')
+    send_sms = views_module.send_order_confirmation_sms
+    views_module.send_order_confirmation_sms = _send_no_sms
+    previous_executor, previous_mailer = jobs._executor, mail._mailer
+    jobs._executor, mail._mailer = executor, mailer
+    try:
+        with override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend', DEBUG=True,
+                               PLAYGROUND_MAX_TENANT_DATABASES=10000):
+            try:
+                yield stub
+            finally:
+                # Mails may be handed to jobs and jobs may send mails
+                mailer.drain()
+                executor.drain()
+                mailer.drain()
+    finally:
+        jobs._executor, mail._mailer = previous_executor, previous_mailer
+        views_module.send_order_confirmation_sms = send_sms
+        executor.stop()
+        stub.stop()
+        shutil.rmtree(outbox_dir, ignore_errors=True)
+
+
+def _send_no_sms(buyer_name, buyer_phone, order):
+    pass
+
+
+class SyntheticTenants(object):
+    """
+    Builds a retailer with its providers, delivery company and a chain
+    of referring Daras, then orders on demand.
+
+    :param providers: Number of provider services the products come from
+    :param referral_depth: 0 for a buyer who was not referred. Otherwise,
+        the buyer is referred by a Dara, itself referred by a Dara, etc.
+    :param return_url: URL partner callbacks are posted to
+    """
+    def __init__(self, providers=1, referral_depth=1, return_url=None):
+        self.provider_count = providers
+        self.referral_depth = referral_depth
+        self.return_url = return_url
+        self._sequence = 0
+
+    @property
+    def tenant_aliases(self):
+        return ['bench_provider_%d' % i for i in range(self.provider_count)] + ['bench_delcom'] + \
+               ['bench_dara_%d' % i for i in range(self.referral_depth)]
+
+    def _next(self):
+        self._sequence += 1
+        return self._sequence
+
+    def _create_member(self, name):
+        member = Member(username='%s%d' % (name, self._next()), email='%s@bench.local' % name,
+                        first_name=name, last_name='Bench', phone='6%08d' % self._sequence)
+        for db in ['default', UMBRELLA]:
+            member.save(using=db)
+        return member
+
+    def _create_service(self, name, database, app, member=None, pk=None):
+        member = member or self._create_member(name)
+        service = Service(id=pk, member=member, app=app, project_name=name, project_name_slug=name.lower(),
+                          database=database, domain='%s.bench.local' % name.lower())
+        for db in set(['default', UMBRELLA, database]):
+            service.save(using=db)
+        profile = OperatorProfile(service=service, company_name=name, ikwen_share_rate=10,
+                                  payment_delay=OperatorProfile.STRAIGHT, return_url=self.return_url,
+                                  notification_email='%s@bench.local' % name.lower())
+        for db in set([UMBRELLA, database]):
+            profile.save(using=db)
+        return service
+
+    def build(self):
+        kakocase = Application.objects.using(UMBRELLA).create(name='Kakocase', slug='kakocase')
+        daraja = Application.objects.using(UMBRELLA).create(name='Daraja', slug=DARAJA)
+        for app in (kakocase, daraja):
+            app.save(using='default')
+        self.retailer = self._create_service('Retailer', 'default', kakocase, pk=settings.IKWEN_SERVICE_ID)
+        self.providers = [self._create_service('Provider%d' % i, 'bench_provider_%d' % i, kakocase)
+                          for i in range(self.provider_count)]
+        self.delcom = self._create_service('Delcom', 'bench_delcom', kakocase)
+        self.delivery_option = DeliveryOption.objects.create(company=self.delcom, name='Bench delivery',
+                                                             cost=500, packing_cost=100)
+        self.payment_mean = PaymentMean.objects.create(name='Bench MoMo', slug='mtn-momo')
+        self.category = ProductCategory.objects.create(name='Bench', slug='bench')
+
+        # Chain of Daras: daras[0] referred the buyer, daras[1] referred daras[0], etc.
+        self.daras = []
+        for i in range(self.referral_depth):
+            member = self._create_member('Dara%d' % i)
+            dara = Dara(member=member, share_rate=5, level=1, xp=0)
+            for db in ['default', UMBRELLA]:
+                dara.save(using=db)
+            dara_service = self._create_service('Dara%d' % i, 'bench_dara_%d' % i, daraja, member)
+            if self.daras:
+                Customer.objects.create(member=member, referrer=self.daras[-1][1])
+            self.daras.append((dara, dara_service))
+        if self.daras:
+            self.daras.reverse()
+        return self
+
+    def create_order(self, entries=1):
+        buyer = self._create_member('Buyer')
+        Customer.objects.create(member=buyer, referrer=self.daras[0][1] if self.daras else None)
+        order_entries, items_cost = [], 0
+        for i in range(entries):
+            provider = self.providers[i % len(self.providers)]
+            product = Product.objects.create(name='Product %d' % self._next(), category=self.category,
+                                             provider=provider, retail_price=1000, stock=1000000)
+            order_entries.append(OrderEntry(product=product, count=1))
+            items_cost += product.retail_price
+        address = DeliveryAddress(name=buyer.full_name, email=buyer.email, phone=buyer.phone)
+        order = Order.objects.create(member=buyer, retailer=self.retailer, payment_mean=self.payment_mean,
+                                     delivery_option=self.delivery_option, delivery_address=address,
+                                     entries=order_entries, items_count=entries, items_cost=items_cost,
+                                     total_cost=items_cost + self.delivery_option.cost, status=Order.PENDING)
+        return order
+
+    def create_referee(self):
+        return self._create_member('Referee')
+
+    def get_request(self, user, method='get', session=None):
+        request = getattr(RequestFactory(), method)('/')
+        engine = import_module(settings.SESSION_ENGINE)
+        request.session = engine.SessionStore()
+        request.session.update(session or {})
+        request.user = user
+        request.COOKIES = {}
+        return request
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from copy import deepcopy
+from threading import Thread
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from ikwen.core.utils import set_counters, increment_history_field
+
+from playground.db import close_evicted_connections
+
+logger = logging.getLogger('ikwen')
+
+
+@contextmanager
+def _deferred_save(obj):
+    """
+    ikwen's set_counters and increment_history_field save the object
+    each time they are called. This shadows obj.save for the time of
+    the block so that their changes stay in memory.
+    """
+    obj.save = lambda *args, **kwargs: None
+    try:
+        yield obj
+    finally:
+        del obj.save
+
+
+def _increment_history_field(obj, history_field, increment_value, days_ago=0):
+    """
+    increment_history_field on the day days_ago days before the last one
+    of the history, which is today once set_counters ran. Days older than
+    the history kept count on its first day.
+    """
+    if not days_ago:
+        increment_history_field(obj, history_field, increment_value)
+        return
+    history = getattr(obj, history_field)
+    cut = max(len(history) - days_ago, 1)
+    later = history[cut:]
+    setattr(obj, history_field, history[:cut])
+    increment_history_field(obj, history_field, increment_value)
+    getattr(obj, history_field).extend(later)
+
+
+def _field_values(obj):
+    return dict((field.attname, deepcopy(getattr(obj, field.attname, None)))
+                for field in obj._meta.fields if not field.primary_key)
+
+
+class _Entry(object):
+    def __init__(self, obj):
+        self.obj = obj
+        self.reset = False
+        self.assignments = OrderedDict()
+        self.deltas = OrderedDict()
+
+
+class CounterBuffer(object):
+    """
+    Write-behind buffer for watch object counters. Calls to set_counters
+    and increment_history_field are recorded in memory, deltas to the same
+    field are summed and flush() issues one save per object per database,
+    restricted to the fields that actually changed.
+
+    With immediate=True, calls go straight to ikwen as they used to. This
+    is the behaviour when PLAYGROUND_WRITE_BEHIND_COUNTERS is False.
+    """
+    def __init__(self, immediate=None, interval=0):
+        if immediate is None:
+            immediate = not getattr(settings, 'PLAYGROUND_WRITE_BEHIND_COUNTERS', True)
+        self.immediate = immediate
+        self.interval = interval
+        self.flush_count = 0
+        self.write_count = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_entry(self, obj):
+        key = (obj._state.db or 'default', type(obj), obj.pk)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = _Entry(obj)
+            self._entries[key] = entry
+        return entry
+
+    def set_counters(self, obj):
+        if self.immediate:
+            set_counters(obj)
+            return
+        with self._lock:
+            self._get_entry(obj).reset = True
+
+    def increment(self, obj, history_field, increment_value=1, days_ago=0):
+        if self.immediate:
+            _increment_history_field(obj, history_field, increment_value, days_ago)
+            return
+        with self._lock:
+            deltas = self._get_entry(obj).deltas
+            deltas[(history_field, days_ago)] = deltas.get((history_field, days_ago), 0) + increment_value
+
+    def set_field(self, obj, field, value):
+        """
+        Sets a plain attribute that must be persisted along with the
+        counters, like customer.last_payment_on. In immediate mode the
+        next increment saves it, as it used to.
+        """
+        setattr(obj, field, value)
+        if self.immediate:
+            return
+        with self._lock:
+            self._get_entry(obj).assignments[field] = value
+
+    def __len__(self):
+        return len(self._entries)
+
+    def flush(self):
+        """
+        Writes all pending changes, one save per object per database.
+        Returns the objects whose changes could not be written, as a
+        list of (model, pk, db, error).
+        """
+        with self._lock:
+            entries, self._entries = self._entries, OrderedDict()
+        failures = []
+        for (db, model, pk), entry in entries.items():
+            obj = entry.obj
+            try:
+                if self.interval:
+                    # Objects may have been held for a while, reload them so
+                    # that writes of other processes are not overwritten.
+                    obj = model._default_manager.using(db).get(pk=pk)
+                before = _field_values(obj)
+                with _deferred_save(obj):
+                    for field, value in entry.assignments.items():
+                        setattr(obj, field, value)
+                    if entry.reset:
+                        set_counters(obj)
+                    for (history_field, days_ago), value in entry.deltas.items():
+                        _increment_history_field(obj, history_field, value, days_ago)
+                # set_field already assigned the values on the object the
+                # snapshot was taken from, so they never show as changed.
+                update_fields = [field.name for field in obj._meta.fields
+                                 if field.name in entry.assignments or
+                                 (not field.primary_key and getattr(obj, field.attname, None) != before[field.attname])]
+                if update_fields:
+                    obj.save(using=db, update_fields=update_fields)
+                    self.write_count += 1
+            except Exception as e:
+                logger.error("Failed to flush counters of %s %s in %s" % (model.__name__, pk, db), exc_info=True)
+                failures.append((model, pk, db, '%s: %s' % (type(e).__name__, e)))
+        self.flush_count += 1
+        return failures
+
+    def commit(self):
+        """
+        Called by the code that opened the buffer once its unit of work is
+        done. Flushes right away unless the buffer is flushed on a timer.
+        """
+        if not self.interval:
+            self.flush()
+
+
+class PeriodicFlusher(Thread):
+    """
+    Flushes a shared CounterBuffer every `buffer.interval` seconds so that
+    consecutive orders touching the same objects are merged in one write.
+    """
+    def __init__(self, buffer):
+        super(PeriodicFlusher, self).__init__(name='counter-flusher')
+        self.setDaemon(True)
+        self.buffer = buffer
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.buffer.interval):
+            try:
+                self.buffer.flush()
+            finally:
+                close_old_connections()
+                close_evicted_connections()
+        self.buffer.flush()
+
+    def stop(self):
+        self._stopped.set()
+
+
+_shared_buffer = None
+_shared_lock = threading.Lock()
+
+
+def get_counter_buffer():
+    """
+    Returns the buffer the order path must record its counters in. When
+    PLAYGROUND_COUNTERS_FLUSH_INTERVAL is set, this is a process-wide
+    buffer flushed on a timer, otherwise a fresh buffer that the caller
+    flushes with commit() at the end of its work.
+    """
+    global _shared_buffer
+    interval = getattr(settings, 'PLAYGROUND_COUNTERS_FLUSH_INTERVAL', 0)
+    if not interval or getattr(settings, 'UNIT_TESTING', False):
+        return CounterBuffer()
+    with _shared_lock:
+        if _shared_buffer is None:
+            _shared_buffer = CounterBuffer(interval=interval)
+            PeriodicFlusher(_shared_buffer).start()
+    return _shared_buffer
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of the Dara of each member, which the cart looks up on every
+view. Members who are not Daras are cached too, so that they do not
+cost a query each time either. Entries are kept
+PLAYGROUND_DARA_CACHE_TIMEOUT seconds, 0 not to cache, and dropped as
+soon as the Dara is saved or deleted in this project. Daras created or
+changed by other projects are seen when the entry expires.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+
+from daraja.models import Dara
+
+from playground.identity import get_identity_map
+
+_NOT_A_DARA = 0
+
+
+def _get_key(member_id, db):
+    return 'playground:dara:%s:%s' % (db, member_id)
+
+
+def get_dara(member, db='default'):
+    """
+    Returns the Dara of member in db, None if member is anonymous or not
+    a Dara.
+    """
+    if not member.is_authenticated():
+        return None
+    timeout = getattr(settings, 'PLAYGROUND_DARA_CACHE_TIMEOUT', 600)
+    key = _get_key(member.id, db)
+    dara = cache.get(key) if timeout else None
+    if dara is None:
+        try:
+            dara = get_identity_map().get(Dara, db, member=member)
+        except Dara.DoesNotExist:
+            dara = _NOT_A_DARA
+        if timeout:
+            cache.set(key, dara, timeout)
+    return dara or None
+
+
+def invalidate_dara(sender, instance, using=None, **kwargs):
+    cache.delete(_get_key(instance.member_id, using or 'default'))
+
+post_save.connect(invalidate_dara, sender=Dara)
+post_delete.connect(invalidate_dara, sender=Dara)
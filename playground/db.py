@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import connections
+
+from ikwen.core.utils import add_database
+
+
+class DatabaseRegistry(object):
+    """
+    Registers tenant databases (delivery companies, providers, Daras)
+    lazily and keeps at most max_aliases of them, evicting the least
+    recently used one: its settings.DATABASES entry is removed and its
+    connection closed. Databases configured in settings at startup are
+    never evicted. Databases ikwen registers itself with add_database
+    are taken in as least recently used and evicted alike.
+    """
+    def __init__(self, max_aliases=100):
+        self.max_aliases = max_aliases
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._static = set(settings.DATABASES.keys())
+        self._aliases = OrderedDict()
+        self._lock = threading.Lock()
+
+    def use(self, alias):
+        """
+        Makes sure alias is registered and marks it as recently used.
+        Must be called before each use of a tenant database.
+        """
+        if alias in self._static:
+            return alias
+        with self._lock:
+            if alias in self._aliases:
+                self.hits += 1
+                del self._aliases[alias]
+                self._aliases[alias] = True
+                return alias
+            self.misses += 1
+            self._adopt()
+            add_database(alias)
+            self._aliases[alias] = True
+            self._trim()
+        return alias
+
+    def trim(self):
+        """
+        Takes in databases registered outside use() and evicts the least
+        recently used ones above max_aliases.
+        """
+        with self._lock:
+            self._adopt()
+            self._trim()
+
+    def _trim(self):
+        while len(self._aliases) > self.max_aliases:
+            evicted, __ = self._aliases.popitem(last=False)
+            self._evict(evicted)
+
+    def _adopt(self):
+        # Databases registered outside use(), as least recently used
+        adopted = [alias for alias in settings.DATABASES.keys()
+                   if alias not in self._static and alias not in self._aliases]
+        if adopted:
+            aliases = OrderedDict((alias, True) for alias in adopted)
+            aliases.update(self._aliases)
+            self._aliases = aliases
+
+    def _evict(self, alias):
+        self.evictions += 1
+        settings.DATABASES.pop(alias, None)
+        _close_connection(alias)
+
+    def stats(self):
+        return {
+            'aliases': len(self._aliases),
+            'max_aliases': self.max_aliases,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+def _close_connection(alias):
+    # Connections are per thread, only the one of the current thread can be reached.
+    connection = getattr(connections._connections, alias, None)
+    if connection is not None:
+        connection.close()
+        delattr(connections._connections, alias)
+
+
+def close_evicted_connections(sender=None, **kwargs):
+    """
+    Closes connections the current thread still holds to databases
+    evicted by another thread. Runs at the end of each request, and must
+    be called by background threads at the end of each round of work.
+    """
+    if _registry is not None:
+        _registry.trim()
+    for alias in list(vars(connections._connections).keys()):
+        if alias not in settings.DATABASES:
+            _close_connection(alias)
+
+request_finished.connect(close_evicted_connections)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = DatabaseRegistry(getattr(settings, 'PLAYGROUND_MAX_TENANT_DATABASES', 100))
+    return _registry
+
+
+def use_database(alias):
+    """
+    Drop-in replacement of ikwen add_database for tenant databases.
+    """
+    return get_registry().use(alias)
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+from django.db import models
+
+from ikwen.core.utils import get_service_instance
+
+logger = logging.getLogger('ikwen')
+
+_local = threading.local()
+_totals = {'units': 0, 'hits': 0, 'misses': 0}
+_totals_lock = threading.Lock()
+
+_MISSING = object()
+
+
+class IdentityMap(object):
+    """
+    Unit of work cache returning the instance already loaded for a given
+    (database, model, lookup) instead of querying again. Instances are
+    shared, so changes made on one are seen by every later lookup of the
+    same row within the unit of work. Lookups that found nothing are
+    remembered too.
+    """
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._objects = {}
+
+    @staticmethod
+    def _key(model, using, lookup):
+        items = []
+        for name, value in sorted(lookup.items()):
+            if isinstance(value, models.Model):
+                value = value.pk
+            if name == 'id':
+                name = 'pk'
+            items.append((name, value))
+        return using, model, tuple(items)
+
+    def get(self, model, using='default', **lookup):
+        key = self._key(model, using, lookup)
+        obj = self._objects.get(key)
+        if obj is not None:
+            self.hits += 1
+            if obj is _MISSING:
+                raise model.DoesNotExist("%s matching %s does not exist in %s." % (model.__name__, lookup, using))
+            return obj
+        self.misses += 1
+        try:
+            obj = model._default_manager.using(using).get(**lookup)
+        except model.DoesNotExist:
+            self._objects[key] = _MISSING
+            raise
+        self.add(obj, key)
+        return obj
+
+    def add(self, obj, key=None):
+        using = obj._state.db or 'default'
+        if key:
+            self._objects[key] = obj
+        self._objects[(using, type(obj), (('pk', obj.pk), ))] = obj
+        return obj
+
+    def get_service_instance(self):
+        key = ('default', 'service_instance', ())
+        service = self._objects.get(key)
+        if service is not None:
+            self.hits += 1
+            return service
+        self.misses += 1
+        service = get_service_instance()
+        self._objects[key] = service
+        return service
+
+
+def get_identity_map():
+    """
+    Returns the identity map of the running unit of work. Outside of
+    one, a fresh map is returned each time, so nothing is cached.
+    """
+    return getattr(_local, 'identity_map', None) or IdentityMap()
+
+
+@contextmanager
+def identity_map(name=''):
+    """
+    Runs a block as a unit of work. Nested blocks share the map of the
+    outermost one.
+    """
+    current = getattr(_local, 'identity_map', None)
+    if current is not None:
+        yield current
+        return
+    current = IdentityMap()
+    _local.identity_map = current
+    try:
+        yield current
+    finally:
+        _local.identity_map = None
+        with _totals_lock:
+            _totals['units'] += 1
+            _totals['hits'] += current.hits
+            _totals['misses'] += current.misses
+        if current.hits:
+            logger.debug("%s: identity map saved %d queries out of %d lookups" %
+                         (name, current.hits, current.hits + current.misses))
+
+
+def identity_map_stats():
+    with _totals_lock:
+        return dict(_totals)
+
+
+class IdentityMapMiddleware(object):
+    """
+    Runs each request as a unit of work. Add it to MIDDLEWARE_CLASSES.
+    """
+    def process_request(self, request):
+        request._identity_map = identity_map(request.path)
+        request._identity_map.__enter__()
+
+    def process_response(self, request, response):
+        unit = getattr(request, '_identity_map', None)
+        if unit is not None:
+            request._identity_map = None
+            unit.__exit__(None, None, None)
+        return response
+
+
+def unit_of_work(func):
+    """
+    Decorator running func as a unit of work, for views and callbacks
+    that must benefit from the identity map even without the middleware.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with identity_map(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+Low overhead stage profiler for the checkout path. Functions decorated
+with @profiled are profiled on a sample of calls, defined by the
+PLAYGROUND_PROFILE_SAMPLE_RATE setting (0 to 1, default 0.01). Within
+them, checkpoint('name') starts a stage that lasts until the next
+checkpoint or the end of the function. A profiled function called from
+another one is recorded as a stage of the caller.
+
+For each stage, the wall time, queries per database alias and threads
+and background jobs started are recorded. Each sampled call is logged
+as a JSON line on the 'playground.profile' logger, and totals per stage
+are returned by profile_stats(). Calls that are not sampled only pay a
+thread local lookup per checkpoint.
+"""
+import json
+import logging
+import random
+import threading
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger('playground.profile')
+
+_local = threading.local()
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _count_queries():
+    return dict((alias, len(connections[alias].queries)) for alias in settings.DATABASES.keys())
+
+
+class _Segment(object):
+    def __init__(self, name, profile):
+        self.name = name
+        self.start = time.time()
+        self.queries = _count_queries()
+        self.threads = threading.active_count()
+        self.jobs = profile.jobs
+
+    def close(self, profile):
+        queries = _count_queries()
+        profile.stages.append({
+            'name': self.name,
+            'ms': round((time.time() - self.start) * 1000, 2),
+            'queries': dict((alias, count - self.queries.get(alias, 0)) for alias, count in queries.items()
+                            if count > self.queries.get(alias, 0)),
+            'threads': threading.active_count() - self.threads,
+            'jobs': profile.jobs - self.jobs,
+        })
+
+
+class _Profile(object):
+    def __init__(self, name):
+        self.name = name
+        self.jobs = 0
+        self.stages = []
+        self.frames = []  # [function segment, current checkpoint segment]
+
+    def enter(self, name):
+        if self.frames:
+            name = '%s/%s' % (self.frames[-1][0].name, name)
+        self.frames.append([_Segment(name, self), None])
+
+    def checkpoint(self, name):
+        frame = self.frames[-1]
+        if frame[1] is not None:
+            frame[1].close(self)
+        frame[1] = _Segment('%s.%s' % (frame[0].name, name), self)
+
+    def leave(self):
+        segment, checkpoint_segment = self.frames.pop()
+        if checkpoint_segment is not None:
+            checkpoint_segment.close(self)
+        segment.close(self)
+
+
+def _is_sampled():
+    rate = getattr(settings, 'PLAYGROUND_PROFILE_SAMPLE_RATE', 0.01)
+    return rate >= 1 or random.random() < rate
+
+
+def _publish(profile):
+    logger.info(json.dumps({'profile': profile.name, 'stages': profile.stages}))
+    with _stats_lock:
+        for stage in profile.stages:
+            stats = _stats.setdefault(stage['name'], {'count': 0, 'ms': 0, 'max_ms': 0, 'queries': 0, 'jobs': 0})
+            stats['count'] += 1
+            stats['ms'] += stage['ms']
+            stats['max_ms'] = max(stats['max_ms'], stage['ms'])
+            stats['queries'] += sum(stage['queries'].values())
+            stats['jobs'] += stage['jobs']
+
+
+def profiled(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        profile = getattr(_local, 'profile', None)
+        if profile is None:
+            if not _is_sampled():
+                return func(*args, **kwargs)
+            profile = _local.profile = _Profile(func.__name__)
+            debug_cursors, query_counts = {}, _count_queries()
+            for alias in settings.DATABASES.keys():
+                debug_cursors[alias] = connections[alias].use_debug_cursor
+                connections[alias].use_debug_cursor = True
+        else:
+            debug_cursors = None
+        profile.enter(func.__name__)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.leave()
+            if debug_cursors is not None:
+                _local.profile = None
+                for alias, value in debug_cursors.items():
+                    if alias not in settings.DATABASES:
+                        continue
+                    connection = connections[alias]
+                    connection.use_debug_cursor = value
+                    if not (value or settings.DEBUG):
+                        # Queries would otherwise pile up in threads where nothing resets them
+                        del connection.queries[query_counts[alias]:]
+                _publish(profile)
+    return wrapper
+
+
+def checkpoint(name):
+    profile = getattr(_local, 'profile', None)
+    if profile is not None and profile.frames:
+        profile.checkpoint(name)
+
+
+def count_job():
+    profile = getattr(_local, 'profile', None)
+    if profile is not None:
+        profile.jobs += 1
+
+
+def profile_stats():
+    """
+    Totals per stage of the sampled calls, with averages.
+    """
+    with _stats_lock:
+        stats = {}
+        for name, values in _stats.items():
+            stats[name] = dict(values)
+            stats[name]['avg_ms'] = values['ms'] / values['count']
+            stats[name]['avg_queries'] = float(values['queries']) / values['count']
+        return stats
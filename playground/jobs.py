@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from importlib import import_module
+from threading import Thread
+
+import Queue
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from playground.db import close_evicted_connections
+from playground.instrumentation import count_job
+
+logger = logging.getLogger('ikwen')
+
+PENDING = 'Pending'
+QUEUED = 'Queued'
+RUNNING = 'Running'
+FAILED = 'Failed'
+
+# Former paths of functions that moved, which jobs queued before the move
+# still refer to
+MOVED = {
+    'playground.views.send_message': 'playground.mail.send_message',
+}
+
+
+class Outbox(object):
+    """
+    SQLite file where jobs are written before they are queued, so that
+    jobs not yet run when the process stops are picked up after restart.
+    Rows are marked queued by the process whose queue holds them and
+    claimed before they run, which makes it safe for several worker
+    processes to share the same file. Queued and running rows are leased
+    for lease seconds, after which they are considered abandoned by a
+    process that stopped and are put back in the pending state.
+    """
+    def __init__(self, path, lease=600):
+        self.path = path
+        self.lease = lease
+        self._lock = threading.Lock()
+        self._execute("CREATE TABLE IF NOT EXISTS job ("
+                      "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                      "func TEXT NOT NULL, "
+                      "payload BLOB NOT NULL, "
+                      "status TEXT NOT NULL, "
+                      "owner INTEGER, "
+                      "attempts INTEGER NOT NULL DEFAULT 0, "
+                      "created_on REAL NOT NULL, "
+                      "next_attempt_on REAL NOT NULL, "
+                      "last_error TEXT, "
+                      "leased_until REAL)")
+        lastrowid, rowcount, columns = self._execute("PRAGMA table_info(job)")
+        if 'leased_until' not in [column[1] for column in columns]:
+            # Outbox created before leases
+            try:
+                self._execute("ALTER TABLE job ADD COLUMN leased_until REAL")
+            except sqlite3.OperationalError:
+                # Added by another process meanwhile
+                pass
+        self._execute("CREATE INDEX IF NOT EXISTS job_status_next_attempt_on ON job (status, next_attempt_on)")
+        for old_path, path in MOVED.items():
+            self._execute("UPDATE job SET func=? WHERE func=?", (path, old_path))
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            cnx = self._connect()
+            try:
+                with cnx:
+                    cursor = cnx.execute(sql, params)
+                    return cursor.lastrowid, cursor.rowcount, cursor.fetchall()
+            finally:
+                cnx.close()
+
+    def add(self, func, payload):
+        """
+        Adds a job, marked queued by this process.
+        """
+        now = time.time()
+        job_id, rowcount, rows = self._execute("INSERT INTO job (func, payload, status, owner, created_on, "
+                                               "next_attempt_on, leased_until) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                               (func, sqlite3.Binary(payload), QUEUED, os.getpid(), now, now,
+                                                now + self.lease))
+        return job_id
+
+    def queue(self, job_id):
+        """
+        Marks a pending job as queued by this process. Returns False if
+        another process or the sweeper got it first.
+        """
+        lastrowid, rowcount, rows = self._execute("UPDATE job SET status=?, owner=?, leased_until=? "
+                                                  "WHERE id=? AND status=?",
+                                                  (QUEUED, os.getpid(), time.time() + self.lease, job_id, PENDING))
+        return rowcount == 1
+
+    def unqueue(self, job_id):
+        self._execute("UPDATE job SET status=?, owner=NULL WHERE id=? AND status=?", (PENDING, job_id, QUEUED))
+
+    def claim(self, job_id):
+        """
+        Marks the job as running and returns (func, payload, attempts, created_on),
+        or None if another worker got it first.
+        """
+        lastrowid, rowcount, rows = self._execute("UPDATE job SET status=?, owner=?, leased_until=? "
+                                                  "WHERE id=? AND status=?",
+                                                  (RUNNING, os.getpid(), time.time() + self.lease, job_id, QUEUED))
+        if rowcount != 1:
+            return None
+        lastrowid, rowcount, rows = self._execute("SELECT func, payload, attempts, created_on FROM job WHERE id=?",
+                                                  (job_id, ))
+        return rows[0]
+
+    def delete(self, job_id):
+        self._execute("DELETE FROM job WHERE id=?", (job_id, ))
+
+    def release(self, job_id, error, next_attempt_on):
+        self._execute("UPDATE job SET status=?, owner=NULL, attempts=attempts+1, last_error=?, next_attempt_on=? "
+                      "WHERE id=?", (PENDING, error, next_attempt_on, job_id))
+
+    def fail(self, job_id, error):
+        self._execute("UPDATE job SET status=?, owner=NULL, attempts=attempts+1, last_error=? WHERE id=?",
+                      (FAILED, error, job_id))
+
+    def due(self, limit):
+        lastrowid, rowcount, rows = self._execute("SELECT id FROM job WHERE status=? AND next_attempt_on<=? "
+                                                  "ORDER BY next_attempt_on LIMIT ?", (PENDING, time.time(), limit))
+        return [row[0] for row in rows]
+
+    def recover(self):
+        """
+        Puts back in the pending state jobs queued or running whose lease
+        expired, left by processes that stopped. Returns their number.
+        """
+        lastrowid, rowcount, rows = self._execute("UPDATE job SET status=?, owner=NULL WHERE status IN (?, ?) "
+                                                  "AND (leased_until IS NULL OR leased_until<?)",
+                                                  (PENDING, QUEUED, RUNNING, time.time()))
+        return rowcount
+
+    def count(self, owner=None):
+        if owner is None:
+            lastrowid, rowcount, rows = self._execute("SELECT status, COUNT(*) FROM job GROUP BY status")
+        else:
+            lastrowid, rowcount, rows = self._execute("SELECT status, COUNT(*) FROM job WHERE owner=? GROUP BY status",
+                                                      (owner, ))
+        return dict(rows)
+
+
+class JobExecutor(object):
+    """
+    Runs background jobs (emails, SMS, callbacks) on a fixed pool of
+    worker threads fed by a bounded queue. Every job goes through the
+    Outbox first: when the queue is full, or when a job fails, the job
+    stays pending in the Outbox and the sweeper queues it when it is
+    due. Jobs already queued are left to the queue.
+    Failed jobs are retried with exponential backoff up to max_attempts.
+    """
+    def __init__(self, outbox, workers=4, queue_size=500, max_attempts=5, retry_delay=30, sweep_interval=5):
+        self.outbox = outbox
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.sweep_interval = sweep_interval
+        self.queue = Queue.Queue(maxsize=queue_size)
+        self.submitted = 0
+        self.succeeded = 0
+        self.retried = 0
+        self.failed = 0
+        self.overflowed = 0
+        self.total_latency = 0
+        self.max_latency = 0
+        self._lock = threading.Lock()
+        self._started = False
+        self._stopped = threading.Event()
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        self.outbox.recover()
+        for i in range(self.workers):
+            thread = Thread(target=self._work, name='job-worker-%d' % i)
+            thread.setDaemon(True)
+            thread.start()
+        thread = Thread(target=self._sweep, name='job-sweeper')
+        thread.setDaemon(True)
+        thread.start()
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Schedules func(*args, **kwargs). func must be a module level
+        function and arguments must be picklable.
+        """
+        count_job()
+        if getattr(settings, 'UNIT_TESTING', False):
+            return func(*args, **kwargs)
+        job_id = self.hold(func, *args, **kwargs)
+        try:
+            self.queue.put_nowait(job_id)
+        except Queue.Full:
+            self.overflowed += 1
+            self.outbox.unqueue(job_id)
+        return job_id
+
+    def hold(self, func, *args, **kwargs):
+        """
+        Writes func(*args, **kwargs) to the Outbox without queueing it,
+        for callers that run the job themselves, like the Mailer which
+        sends emails in batches. They claim() the job before running it,
+        then call done() or retry(), which leaves it to the workers.
+        Held jobs of a process that stops are recovered like queued ones.
+        """
+        self.start()
+        path = '%s.%s' % (func.__module__, func.__name__)
+        job_id = self.outbox.add(path, pickle.dumps((args, kwargs), pickle.HIGHEST_PROTOCOL))
+        self.submitted += 1
+        return job_id
+
+    def claim(self, job_id):
+        """
+        Marks a held job as running. Returns False if it was recovered
+        and run by a worker meanwhile.
+        """
+        return self.outbox.claim(job_id) is not None
+
+    def done(self, job_id):
+        self.succeeded += 1
+        self.outbox.delete(job_id)
+
+    def retry(self, job_id, error):
+        self.retried += 1
+        self.outbox.release(job_id, error, time.time())
+
+    def _run(self, job_id):
+        job = self.outbox.claim(job_id)
+        if job is None:
+            return
+        path, payload, attempts, created_on = job
+        try:
+            module_name, func_name = path.rsplit('.', 1)
+            func = getattr(import_module(module_name), func_name)
+            args, kwargs = pickle.loads(bytes(payload))
+            func(*args, **kwargs)
+        except Exception as e:
+            error = '%s: %s' % (type(e).__name__, e)
+            if attempts + 1 >= self.max_attempts:
+                self.failed += 1
+                self.outbox.fail(job_id, error)
+                logger.error("Background job %s %s failed after %d attempts" % (job_id, path, attempts + 1),
+                             exc_info=True)
+            else:
+                self.retried += 1
+                self.outbox.release(job_id, error, time.time() + self.retry_delay * 2 ** attempts)
+        else:
+            latency = time.time() - created_on
+            self.succeeded += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            self.outbox.delete(job_id)
+        finally:
+            close_old_connections()
+            close_evicted_connections()
+
+    def _work(self):
+        while True:
+            job_id = self.queue.get()
+            if job_id is None:
+                return
+            try:
+                self._run(job_id)
+            except:
+                logger.error("Background job worker error", exc_info=True)
+
+    def _sweep(self):
+        while not self._stopped.wait(self.sweep_interval):
+            try:
+                recovered = self.outbox.recover()
+                if recovered:
+                    logger.warning("Recovered %d background jobs whose lease expired" % recovered)
+                room = self.queue.maxsize - self.queue.qsize()
+                if room <= 0:
+                    continue
+                for job_id in self.outbox.due(room):
+                    if not self.outbox.queue(job_id):
+                        continue
+                    try:
+                        self.queue.put_nowait(job_id)
+                    except Queue.Full:
+                        self.outbox.unqueue(job_id)
+                        break
+            except:
+                logger.error("Background job sweeper error", exc_info=True)
+
+    def drain(self, timeout=30):
+        """
+        Waits at most timeout seconds for the jobs queued by this process
+        and the jobs due in the Outbox to run. Returns True if none is
+        left. Jobs waiting for a retry are not waited for. Commands that
+        submit jobs call this before they exit, as jobs still queued in
+        memory would otherwise wait for their lease to expire.
+        """
+        if not self._started:
+            # Nothing was submitted by this process
+            return True
+        deadline = time.time() + timeout
+        while True:
+            counts = self.outbox.count(owner=os.getpid())
+            if self.queue.empty() and not counts.get(QUEUED) and not counts.get(RUNNING) and not self.outbox.due(1):
+                return True
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.05)
+
+    def stop(self):
+        """
+        Stops the workers, once the jobs queued are run, and the sweeper.
+        """
+        self._stopped.set()
+        if self._started:
+            for i in range(self.workers):
+                self.queue.put(None)
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'queue_depth': self.queue.qsize(),
+            'queue_size': self.queue.maxsize,
+            'outbox': self.outbox.count(),
+            'submitted': self.submitted,
+            'succeeded': self.succeeded,
+            'retried': self.retried,
+            'failed': self.failed,
+            'overflowed': self.overflowed,
+            'avg_latency': self.total_latency / self.succeeded if self.succeeded else 0,
+            'max_latency': self.max_latency,
+        }
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            default_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'outbox.sqlite3')
+            outbox = Outbox(getattr(settings, 'PLAYGROUND_OUTBOX_PATH', default_path),
+                            lease=getattr(settings, 'PLAYGROUND_JOB_LEASE', 600))
+            _executor = JobExecutor(outbox,
+                                    workers=getattr(settings, 'PLAYGROUND_JOB_WORKERS', 4),
+                                    queue_size=getattr(settings, 'PLAYGROUND_JOB_QUEUE_SIZE', 500),
+                                    max_attempts=getattr(settings, 'PLAYGROUND_JOB_MAX_ATTEMPTS', 5),
+                                    retry_delay=getattr(settings, 'PLAYGROUND_JOB_RETRY_DELAY', 30))
+    return _executor
+
+
+def submit(func, *args, **kwargs):
+    """
+    Runs func(*args, **kwargs) in the background on the shared executor.
+    """
+    return get_executor().submit(func, *args, **kwargs)
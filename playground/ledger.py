@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+Earnings ledger. The order path records the earnings of each provider
+as an EarningEntry instead of raising the balance of the provider
+right away; settlement then adds entries to balances with one
+raise_balance per service and payment provider.
+
+Entries are settled as soon as they are recorded unless
+PLAYGROUND_SETTLEMENT_INTERVAL is set, in which case a Settler settles
+them in batches every interval seconds, so that busy providers get one
+balance update per batch instead of one per order. Entries stay in the
+ledger once settled, as the record of what was credited for what order.
+"""
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from threading import Thread
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections
+
+from ikwen.core.models import Service
+
+from playground.db import close_evicted_connections, use_database
+from playground.models import EarningEntry
+
+logger = logging.getLogger('ikwen')
+
+
+def _get_key(order_id, service_id, db):
+    return '%s:%s:%s' % (order_id, service_id, db)
+
+
+class EarningsLedger(object):
+    """
+    Earnings of the services involved in an order, recorded on commit().
+    Recording an order twice has no effect.
+    """
+    def __init__(self, order_id):
+        self.order_id = order_id
+        self._entries = OrderedDict()
+        self._services = {}
+
+    def credit(self, service, db, amount, provider=None):
+        """
+        Records amount to add to the balance of service, whose record in
+        db is the one raise_balance is called on.
+        """
+        key = _get_key(self.order_id, service.id, db)
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = EarningEntry(key=key, order_id=self.order_id, service_id=service.id,
+                                                      db=db, provider=provider, amount=0)
+        entry.amount += amount
+        self._services[(db, service.id)] = service
+
+    def commit(self):
+        recorded = []
+        for key, entry in self._entries.items():
+            try:
+                entry.save()
+                recorded.append(entry.pk)
+            except IntegrityError:
+                logger.info("Earnings %s were already recorded" % key)
+        self._entries = OrderedDict()
+        if getattr(settings, 'PLAYGROUND_SETTLEMENT_INTERVAL', 0) and not getattr(settings, 'UNIT_TESTING', False):
+            if recorded:
+                get_settler().start()
+            return
+        # Entries a failed settlement of the order left pending are settled
+        # too, so that processing the order again completes it.
+        _settle(_claim(EarningEntry.objects.filter(order_id=self.order_id)), self._services, raise_errors=True)
+
+
+def _claim(queryset, limit=None):
+    entry_ids = list(queryset.filter(status=EarningEntry.PENDING).order_by('created_on')
+                     .values_list('id', flat=True)[:limit])
+    if not entry_ids:
+        return []
+    batch = uuid.uuid4().hex
+    EarningEntry.objects.filter(pk__in=entry_ids, status=EarningEntry.PENDING)\
+        .update(status=EarningEntry.SETTLING, batch=batch)
+    return list(EarningEntry.objects.filter(batch=batch))
+
+
+def _settle(entries, services=None, raise_errors=False):
+    """
+    Raises balances by the claimed entries, once per service, database and
+    payment provider. Entries of a balance that could not be raised go
+    back to pending; with raise_errors, the error is raised once the
+    other balances are raised.
+    """
+    services = services or {}
+    error = None
+    groups = OrderedDict()
+    for entry in entries:
+        groups.setdefault((entry.db, entry.service_id, entry.provider), []).append(entry)
+    settled = 0
+    for (db, service_id, provider), group in groups.items():
+        entry_ids = [entry.pk for entry in group]
+        try:
+            service = services.get((db, service_id))
+            if service is None:
+                use_database(db)
+                service = Service.objects.using(db).get(pk=service_id)
+            service.raise_balance(sum(entry.amount for entry in group), provider=provider)
+        except Exception as e:
+            logger.error("Failed to settle %d earning entries of Service %s in %s" % (len(group), service_id, db),
+                         exc_info=True)
+            EarningEntry.objects.filter(pk__in=entry_ids).update(status=EarningEntry.PENDING, batch=None)
+            error = error or e
+            continue
+        EarningEntry.objects.filter(pk__in=entry_ids).update(status=EarningEntry.SETTLED, settled_on=datetime.now())
+        settled += len(group)
+    if error is not None and raise_errors:
+        raise error
+    return settled
+
+
+def settle(batch_size=1000, service_id=None):
+    """
+    Settles at most batch_size pending entries, of service_id only if
+    given. Returns the number of entries settled.
+    """
+    queryset = EarningEntry.objects.all()
+    if service_id:
+        queryset = queryset.filter(service_id=service_id)
+    return _settle(_claim(queryset, batch_size))
+
+
+def reconcile(service_id=None, stuck_after=3600):
+    """
+    Settles pending entries, of service_id only if given, then returns
+    totals of the ledger per service and database: amounts settled and
+    still pending, and entries stuck settling for more than stuck_after
+    seconds. Those were being settled by a process that stopped; whether
+    their balance was raised must be checked by hand.
+    """
+    while settle(service_id=service_id):
+        pass
+    queryset = EarningEntry.objects.all()
+    if service_id:
+        queryset = queryset.filter(service_id=service_id)
+    stuck_on = datetime.now() - timedelta(seconds=stuck_after)
+    report = {}
+    for key, service_id, db, amount, status, created_on in \
+            queryset.values_list('key', 'service_id', 'db', 'amount', 'status', 'created_on'):
+        totals = report.setdefault((service_id, db), {'settled': 0, 'pending': 0, 'settling': 0, 'stuck': []})
+        if status == EarningEntry.SETTLED:
+            totals['settled'] += amount
+        elif status == EarningEntry.PENDING:
+            totals['pending'] += amount
+        else:
+            totals['settling'] += amount
+            if created_on < stuck_on:
+                totals['stuck'].append(key)
+    return report
+
+
+class Settler(object):
+    """
+    Settles pending entries every interval seconds from a background thread.
+    """
+    def __init__(self, interval=60, batch_size=1000):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.settled = 0
+        self.rounds = 0
+        self._lock = threading.Lock()
+        self._started = False
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        thread = Thread(target=self._run, name='earnings-settler')
+        thread.setDaemon(True)
+        thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                while True:
+                    settled = settle(self.batch_size)
+                    self.settled += settled
+                    if settled < self.batch_size:
+                        break
+            except:
+                logger.error("Earnings settler error", exc_info=True)
+            finally:
+                self.rounds += 1
+                close_old_connections()
+                close_evicted_connections()
+
+    def stats(self):
+        return {
+            'settled': self.settled,
+            'rounds': self.rounds,
+            'pending': EarningEntry.objects.filter(status=EarningEntry.PENDING).count(),
+        }
+
+
+_settler = None
+_settler_lock = threading.Lock()
+
+
+def get_settler():
+    global _settler
+    with _settler_lock:
+        if _settler is None:
+            _settler = Settler(interval=getattr(settings, 'PLAYGROUND_SETTLEMENT_INTERVAL', 0) or 60,
+                               batch_size=getattr(settings, 'PLAYGROUND_SETTLEMENT_BATCH_SIZE', 1000))
+    return _settler
@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+"""
+Load testing of the Mobile Money checkout. Virtual users go through the
+whole flow over HTTP against the project served by a local WSGI server:
+cart, MOMO_BEFORE_CHECKOUT with the checkout page, payment and
+confirm_checkout. Payment, SMS and partner callbacks go to stub servers
+and emails to a stub SMTP server, all with configurable latencies.
+
+The Mobile Money view of ikwen billing is stood for by momo_checkout,
+served by this module used as URLconf on top of the project one. Orders
+are created before each level, so that latencies do not include
+fixtures, and parse_order_info is replaced for the run to return the
+order posted.
+"""
+import Cookie
+import math
+import threading
+import time
+import urllib
+import urllib2
+from Queue import Queue, Empty
+from SocketServer import ThreadingMixIn
+from contextlib import contextmanager
+from threading import Thread
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+
+from django.conf import settings
+from django.conf.urls import patterns, url
+from django.contrib.auth import SESSION_KEY, BACKEND_SESSION_KEY
+from django.shortcuts import render
+from django.utils.importlib import import_module
+from django.utils.module_loading import import_by_path
+from django.views.decorators.csrf import csrf_exempt
+
+from ikwen.billing.models import PaymentMean
+from ikwen_kakocase.trade.models import Order
+
+from conf.urls import urlpatterns as project_urlpatterns
+
+from playground import views
+from playground.identity import get_identity_map
+
+STEPS = ['cart', 'momo_checkout', 'payment', 'confirm_checkout']
+
+
+@csrf_exempt
+def momo_checkout(request, *args, **kwargs):
+    """
+    Stands for the Mobile Money view of ikwen billing: runs the
+    MOMO_BEFORE_CHECKOUT hook, then renders the checkout page.
+    """
+    payment_mean = PaymentMean.objects.get(slug='mtn-momo')
+    before_checkout = import_by_path(getattr(settings, 'MOMO_BEFORE_CHECKOUT',
+                                             'playground.views.set_momo_order_checkout'))
+    response = before_checkout(request, payment_mean)
+    if response:
+        return response
+    service = get_identity_map().get_service_instance()
+    context = {'service': service, 'config': service.config, 'payment_mean': payment_mean,
+               'amount': request.session['amount'], 'phone': request.POST.get('phone', '')}
+    return render(request, 'billing/momo_checkout.html', context)
+
+urlpatterns = patterns(
+    '',
+    url(r'^loadtest/momo_checkout$', momo_checkout, name='loadtest_momo_checkout'),
+) + project_urlpatterns
+
+
+def _parse_posted_order(request):
+    return Order.objects.get(pk=request.POST['order_id'])
+
+
+class _ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+@contextmanager
+def local_server(application):
+    """
+    Serves application on a free local port, one thread per request, for
+    the duration of the block. Yields its URL.
+    """
+    server = make_server('127.0.0.1', 0, application, _ThreadingWSGIServer, _QuietHandler)
+    thread = Thread(target=server.serve_forever, name='loadtest-wsgi')
+    thread.setDaemon(True)
+    thread.start()
+    try:
+        yield 'http://%s:%d' % server.server_address
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@contextmanager
+def posted_orders():
+    """
+    Has set_momo_order_checkout take the order whose id is posted as
+    order_id instead of parsing the order from the request.
+    """
+    parse_order_info = views.parse_order_info
+    views.parse_order_info = _parse_posted_order
+    try:
+        yield
+    finally:
+        views.parse_order_info = parse_order_info
+
+
+@contextmanager
+def sms_to(sms_url):
+    """
+    Has the order confirmation SMS sent to the SMS API at sms_url.
+    """
+    send_sms = views.send_order_confirmation_sms
+
+    def send_order_confirmation_sms(buyer_name, buyer_phone, order):
+        query = urllib.urlencode({'to': buyer_phone, 'order_id': order.id})
+        urllib2.urlopen(sms_url + '/sms?' + query, timeout=30).read()
+
+    views.send_order_confirmation_sms = send_order_confirmation_sms
+    try:
+        yield
+    finally:
+        views.send_order_confirmation_sms = send_sms
+
+
+def login(member):
+    """
+    Returns the session cookies of member logged in.
+    """
+    engine = import_module(settings.SESSION_ENGINE)
+    session = engine.SessionStore()
+    session[SESSION_KEY] = member.pk
+    session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+    session.save()
+    return {settings.SESSION_COOKIE_NAME: session.session_key}
+
+
+class _NoRedirect(urllib2.HTTPRedirectHandler):
+    # Redirects are answers to report, like the redirection to the
+    # checkout when stock is short, not to follow.
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+class VirtualUser(object):
+    """
+    Buyer going through the checkout of an order with its own cookies.
+    """
+    def __init__(self, base_url, payment_url, cookies):
+        self.base_url = base_url
+        self.payment_url = payment_url
+        self.cookies = dict(cookies)
+        self._opener = urllib2.build_opener(_NoRedirect())
+
+    def _request(self, url, data=None):
+        request = urllib2.Request(url, urllib.urlencode(data) if data is not None else None)
+        request.add_header('Cookie', '; '.join('%s=%s' % item for item in self.cookies.items()))
+        response = self._opener.open(request, timeout=60)
+        try:
+            response.read()
+            for header in response.info().getheaders('Set-Cookie'):
+                for name, morsel in Cookie.SimpleCookie(header).items():
+                    self.cookies[name] = morsel.value
+        finally:
+            response.close()
+
+    def checkout(self, order_id, phone, timings):
+        """
+        Goes through the flow, recording the time of each step in
+        timings. Raises on the first step that fails.
+        """
+        steps = [
+            ('cart', self.base_url + '/shopping/cart/', None),
+            ('momo_checkout', self.base_url + '/loadtest/momo_checkout', {'order_id': order_id, 'phone': phone}),
+            ('payment', self.payment_url + '/momo', {'phone': phone, 'order_id': order_id}),
+            ('confirm_checkout', self.base_url + '/playground/confirm_checkout?' + urllib.urlencode({'phone': phone}),
+             None),
+        ]
+        for step, url, data in steps:
+            start = time.time()
+            try:
+                self._request(url, data)
+            finally:
+                timings.setdefault(step, []).append(time.time() - start)
+
+
+def percentile(values, rank):
+    """
+    Nearest-rank percentile of values, rank between 0 and 100.
+    """
+    if not values:
+        return 0
+    values = sorted(values)
+    index = max(int(math.ceil(rank / 100.0 * len(values))) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+def summarize(latencies):
+    return {
+        'count': len(latencies),
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    }
+
+
+class _ThreadSampler(object):
+    # Samples the number of threads of the process while running
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = threading.active_count()
+        self._stopped = threading.Event()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.peak = max(self.peak, threading.active_count())
+
+    def start(self):
+        thread = Thread(target=self._run, name='loadtest-sampler')
+        thread.setDaemon(True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+
+
+def run_level(base_url, payment_url, flows, concurrency):
+    """
+    Has concurrency virtual users share flows, a list of (order_id,
+    phone, cookies), each going through the checkout of one order after
+    the other. Returns throughput, latencies of the steps and whole
+    flows, error rate and thread growth.
+    """
+    queue = Queue()
+    for flow in flows:
+        queue.put(flow)
+    lock = threading.Lock()
+    timings, durations, errors = {}, [], {}
+
+    def work():
+        while True:
+            try:
+                order_id, phone, cookies = queue.get_nowait()
+            except Empty:
+                return
+            user_timings = {}
+            start = time.time()
+            try:
+                VirtualUser(base_url, payment_url, cookies).checkout(order_id, phone, user_timings)
+            except Exception as e:
+                with lock:
+                    step = STEPS[len(user_timings) - 1] if user_timings else STEPS[0]
+                    key = '%s: %s' % (step, getattr(e, 'code', None) or type(e).__name__)
+                    errors[key] = errors.get(key, 0) + 1
+            else:
+                with lock:
+                    durations.append(time.time() - start)
+            finally:
+                with lock:
+                    for step, values in user_timings.items():
+                        timings.setdefault(step, []).extend(values)
+
+    threads_before = threading.active_count()
+    sampler = _ThreadSampler().start()
+    users = [Thread(target=work, name='loadtest-user-%d' % i) for i in range(concurrency)]
+    start = time.time()
+    for user in users:
+        user.start()
+    for user in users:
+        user.join()
+    elapsed = time.time() - start
+    sampler.stop()
+    # Virtual users and the sampler are not counted in thread growth,
+    # the threads they made the server start are.
+    peak = sampler.peak - concurrency - 1
+    time.sleep(1)
+    return {
+        'concurrency': concurrency,
+        'flows': len(flows),
+        'completed': len(durations),
+        'elapsed': elapsed,
+        'flows_per_second': len(durations) / elapsed if elapsed else 0,
+        'error_rate': float(sum(errors.values())) / len(flows) if flows else 0,
+        'errors': errors,
+        'flow': summarize(durations),
+        'steps': dict((step, summarize(timings.get(step, []))) for step in STEPS),
+        'threads': {'before': threads_before, 'peak_growth': max(peak - threads_before, 0),
+                    'left': threading.active_count() - threads_before},
+    }
+
+
+def find_saturation(results, min_gain=0.1):
+    """
+    Returns the first concurrency level whose throughput is less than
+    min_gain above the one of the level before, None if throughput
+    grows all along.
+    """
+    for previous, current in zip(results, results[1:]):
+        if current['flows_per_second'] < previous['flows_per_second'] * (1 + min_gain):
+            return current['concurrency']
+    return None
@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+"""
+Outgoing mail. render() builds the HTML of notification emails like
+ikwen's get_mail_content, with compiled templates cached per template
+and language. send() writes messages to the Outbox of the background
+jobs and queues them for the Mailer, which sends them in batches over
+one SMTP connection kept open between batches.
+"""
+import atexit
+import logging
+import os
+import smtplib
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from threading import Thread
+
+import Queue
+
+from django.conf import settings
+from django.core.mail import get_connection
+from django.template import Context
+from django.template.loader import get_template
+from django.utils.translation import get_language
+
+from playground import jobs
+from playground.identity import get_identity_map
+
+logger = logging.getLogger('ikwen')
+
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+def get_cached_template(template_name):
+    """
+    Returns the compiled template, loaded once per language. Templates
+    are loaded on every call when DEBUG is True, so that edits show.
+    """
+    if settings.DEBUG:
+        return get_template(template_name)
+    key = (template_name, get_language())
+    template = _templates.get(key)
+    if template is None:
+        template = get_template(template_name)
+        with _templates_lock:
+            _templates[key] = template
+    return template
+
+
+def render(subject, message=None, template_name='core/mails/notice.html', extra_context=None, service=None):
+    """
+    Renders a notification email with the context of ikwen's get_mail_content.
+    """
+    if service is None:
+        service = get_identity_map().get_service_instance()
+    config = service.config
+    context = {
+        'subject': subject,
+        'message': message,
+        'service': service,
+        'config': config,
+        'logo': config.logo,
+        'project_name': service.project_name,
+        'company_name': config.company_name,
+        'media_url': getattr(settings, 'CLUSTER_MEDIA_URL', settings.MEDIA_URL),
+        'year': datetime.now().year,
+    }
+    if extra_context:
+        context.update(extra_context)
+    return get_cached_template(template_name).render(Context(context))
+
+
+def _normalize(addresses):
+    seen, normalized = set(), []
+    for address in addresses or []:
+        address = address.strip()
+        if address and address.lower() not in seen:
+            seen.add(address.lower())
+            normalized.append(address)
+    return normalized
+
+
+def _collapse(messages):
+    collapsed = OrderedDict()
+    for msg in messages:
+        msg.to = _normalize(msg.to)
+        msg.cc = _normalize(msg.cc)
+        visible = set(address.lower() for address in msg.to + msg.cc)
+        msg.bcc = [address for address in _normalize(msg.bcc) if address.lower() not in visible]
+        if msg.attachments:
+            collapsed[id(msg)] = (msg, [msg])
+            continue
+        key = (type(msg), msg.from_email, tuple(msg.to), tuple(msg.cc), msg.subject, msg.body,
+               msg.content_subtype, tuple(sorted(msg.extra_headers.items())))
+        group = collapsed.get(key)
+        if group is None:
+            collapsed[key] = (msg, [msg])
+        else:
+            first, merged = group
+            first.bcc = _normalize(first.bcc + msg.bcc)
+            merged.append(msg)
+    return list(collapsed.values())
+
+
+def collapse(messages):
+    """
+    Removes duplicate recipients of each message, BCC recipients already
+    in To or Cc, and merges messages identical but for their BCC into
+    one message sent to the union of their BCC recipients.
+    """
+    return [msg for msg, merged in _collapse(messages)]
+
+
+class Mailer(object):
+    """
+    Sends queued messages in batches of at most batch_size from a single
+    thread. A batch is sent as soon as it is full or batch_wait seconds
+    after its first message. The SMTP connection stays open between
+    batches and is closed after idle_timeout seconds without messages.
+
+    Each message is held in the Outbox of the background jobs before it
+    is queued, and deleted from there once the SMTP server accepted it.
+    Messages that could not be sent, or that were still queued when the
+    process stopped, are left to the background jobs, which retry them
+    one by one.
+    """
+    def __init__(self, batch_size=50, batch_wait=1.0, idle_timeout=30, backend=None):
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.idle_timeout = idle_timeout
+        self.backend = backend
+        self.queue = Queue.Queue()
+        self.sent = 0
+        self.failed = 0
+        self.collapsed = 0
+        self.batches = 0
+        self.connections = 0
+        self.send_time = 0
+        self._unsent = 0
+        self._connection = None
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._started = False
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        thread = Thread(target=self._run, name='mailer')
+        thread.setDaemon(True)
+        thread.start()
+
+    def send(self, msg):
+        if getattr(settings, 'UNIT_TESTING', False):
+            return msg.send()
+        self.start()
+        job_id = jobs.get_executor().hold(send_message, msg)
+        with self._lock:
+            self._unsent += 1
+        self.queue.put((job_id, msg))
+
+    def _next_batch(self):
+        try:
+            batch = [self.queue.get(timeout=self.idle_timeout)]
+        except Queue.Empty:
+            return []
+        deadline = time.time() + self.batch_wait
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except Queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch:
+                try:
+                    self._send_held(batch)
+                finally:
+                    self._done(len(batch))
+            else:
+                with self._send_lock:
+                    self._close()
+
+    def _open(self):
+        if self._connection is None:
+            self._connection = get_connection(self.backend)
+            self._connection.open()
+            self.connections += 1
+        return self._connection
+
+    def _close(self):
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except:
+                pass
+            self._connection = None
+
+    def flush(self, batch=None):
+        """
+        Sends batch, or what is currently queued, over the shared connection.
+        Messages of batch that could not be sent are submitted to the
+        background jobs.
+        """
+        if batch is None:
+            batch = []
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            try:
+                self._send_held(batch)
+            finally:
+                self._done(len(batch))
+            return
+
+        def failed(msg, merged, error):
+            jobs.submit(send_message, msg)
+
+        self._send(batch, lambda merged: None, failed)
+
+    def _send_held(self, batch):
+        """
+        Sends a batch of (job_id, msg) held in the Outbox. Jobs are deleted
+        once their message is accepted and left to the background jobs
+        otherwise.
+        """
+        executor = jobs.get_executor()
+        messages, job_ids = [], {}
+        for job_id, msg in batch:
+            # The job was recovered and run by a worker if it took too long
+            if executor.claim(job_id):
+                messages.append(msg)
+                job_ids[id(msg)] = job_id
+
+        def sent(merged):
+            for msg in merged:
+                executor.done(job_ids[id(msg)])
+
+        def failed(msg, merged, error):
+            for msg in merged:
+                executor.retry(job_ids[id(msg)], error)
+
+        self._send(messages, sent, failed)
+
+    def _send(self, messages, sent, failed):
+        """
+        Sends messages one after the other over the shared connection,
+        calling sent(merged) when a message is accepted, merged being the
+        messages collapsed into it, and failed(msg, merged, error) for it
+        and those after it when one cannot be sent.
+        """
+        if not messages:
+            return
+        collapsed = _collapse(messages)
+        self.collapsed += len(messages) - len(collapsed)
+        with self._send_lock:
+            start = time.time()
+            for i, (msg, merged) in enumerate(collapsed):
+                try:
+                    try:
+                        self.sent += self._open().send_messages([msg]) or 0
+                    except smtplib.SMTPServerDisconnected:
+                        # The server dropped the connection while it was idle
+                        self._close()
+                        self.sent += self._open().send_messages([msg]) or 0
+                except Exception as e:
+                    logger.error("Failed to send %d of a batch of %d emails, handing them to background jobs" %
+                                 (len(collapsed) - i, len(collapsed)), exc_info=True)
+                    self._close()
+                    error = '%s: %s' % (type(e).__name__, e)
+                    for msg, merged in collapsed[i:]:
+                        failed(msg, merged, error)
+                        self.failed += 1
+                    break
+                sent(merged)
+            self.send_time += time.time() - start
+            self.batches += 1
+
+    def _done(self, count):
+        with self._lock:
+            self._unsent -= count
+
+    def drain(self, timeout=30):
+        """
+        Sends what is queued and waits at most timeout seconds for the
+        batch being put together to be sent. Returns True if every
+        message was sent or left to the background jobs.
+        """
+        deadline = time.time() + timeout
+        while True:
+            self.flush()
+            if not self._unsent:
+                return True
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.05)
+
+    def stats(self):
+        return {
+            'queued': self.queue.qsize(),
+            'sent': self.sent,
+            'failed': self.failed,
+            'collapsed': self.collapsed,
+            'batches': self.batches,
+            'connections': self.connections,
+            'messages_per_second': self.sent / self.send_time if self.send_time else 0,
+        }
+
+
+def send_message(msg):
+    """
+    Background job sending an EmailMessage on its own connection.
+    """
+    msg.send()
+
+
+_mailer = None
+_mailer_lock = threading.Lock()
+
+
+def get_mailer():
+    global _mailer
+    with _mailer_lock:
+        if _mailer is None:
+            _mailer = Mailer(batch_size=getattr(settings, 'PLAYGROUND_MAIL_BATCH_SIZE', 50),
+                             batch_wait=getattr(settings, 'PLAYGROUND_MAIL_BATCH_WAIT', 1.0),
+                             idle_timeout=getattr(settings, 'PLAYGROUND_MAIL_IDLE_TIMEOUT', 30))
+    return _mailer
+
+
+def send(msg):
+    """
+    Holds msg in the Outbox and queues it for sending with the shared Mailer.
+    """
+    get_mailer().send(msg)
+
+
+def drain(timeout=30):
+    """
+    Sends the emails queued by this process and waits at most timeout
+    seconds for the background jobs it queued to run. Commands call this
+    before they exit. Returns the number of jobs of this process still in
+    the Outbox, by status. Those are run later by the workers.
+    """
+    deadline = time.time() + timeout
+    get_mailer().drain(timeout)
+    executor = jobs.get_executor()
+    if executor.drain(max(deadline - time.time(), 0)):
+        return {}
+    return executor.outbox.count(owner=os.getpid())
+
+
+def _exiting():
+    # Messages still queued are sent before the process exits
+    if _mailer is not None:
+        _mailer.flush()
+
+
+atexit.register(_exiting)
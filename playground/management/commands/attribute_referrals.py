@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import csv
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from ikwen.accesscontrol.models import Member
+from ikwen.core.models import Service
+
+from playground import mail
+from playground.referrals import attribute_referrals
+
+
+class Command(BaseCommand):
+    args = '<csv_file>'
+    help = "Binds referees to the Daras who referred them, from a CSV file of lines 'dara,referee' where " \
+           "both are Member usernames. Reports throughput."
+    option_list = BaseCommand.option_list + (
+        make_option('--service', help="Id of the referred Service. Defaults to the current service."),
+        make_option('--batch-size', type='int', default=1000, help="Bindings processed at once."),
+        make_option('--no-notify', action='store_false', dest='notify', default=True,
+                    help="Do not send events and emails to Daras, for backfills."),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give the CSV file of bindings.")
+        service = Service.objects.get(pk=options['service'] or getattr(settings, 'IKWEN_SERVICE_ID'))
+        with open(args[0]) as fh:
+            rows = [row for row in csv.reader(fh) if len(row) >= 2 and row[0].strip()]
+        start = time.time()
+        totals = {'bound': 0, 'already_referred': 0, 'unknown_dara': 0, 'unknown_member': 0}
+        batch_size = options['batch_size']
+        for i in range(0, len(rows), batch_size):
+            batch = rows[i:i + batch_size]
+            usernames = set(row[0].strip() for row in batch) | set(row[1].strip() for row in batch)
+            members = dict((member.username, member) for member in Member.objects.filter(username__in=usernames))
+            bindings = []
+            for row in batch:
+                referrer, member = members.get(row[0].strip()), members.get(row[1].strip())
+                if referrer is None or member is None:
+                    totals['unknown_member'] += 1
+                    continue
+                bindings.append((referrer, member))
+            for key, value in attribute_referrals(service, bindings, options['notify']).items():
+                totals[key] += value
+            elapsed = time.time() - start
+            self.stdout.write("%d/%d bindings processed, %.0f/s" %
+                              (min(i + batch_size, len(rows)), len(rows), (i + len(batch)) / elapsed if elapsed else 0))
+        self.stdout.write("Bound: %(bound)d, already referred: %(already_referred)d, referrer not a Dara: "
+                          "%(unknown_dara)d, unknown member: %(unknown_member)d" % totals)
+        left = mail.drain()
+        if left:
+            self.stdout.write("Background jobs left in the outbox: %s" % left)
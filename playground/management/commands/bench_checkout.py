@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+import json
+from itertools import product
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from playground import views
+from playground.benchmarks import Measure, SyntheticTenants, benchmark_databases, stubbed_side_effects
+
+
+def _int_list(value):
+    return [int(item) for item in value.split(',')]
+
+
+class Command(BaseCommand):
+    help = "Benchmarks the checkout path on synthetic orders in throwaway databases. Reports wall time, " \
+           "queries per database and thread growth of each step, and can compare with a previous run."
+    option_list = BaseCommand.option_list + (
+        make_option('--entries', default='1,10', help="Comma separated numbers of order entries."),
+        make_option('--providers', default='1,3', help="Comma separated numbers of providers."),
+        make_option('--depth', default='0,1', help="Comma separated referral depths."),
+        make_option('--repeat', type='int', default=5, help="Runs of each step per combination."),
+        make_option('--output', help="File to save results to, as JSON."),
+        make_option('--compare', help="Results file of a previous run to compare with."),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            combinations = list(product(_int_list(options['entries']), _int_list(options['providers']),
+                                        _int_list(options['depth'])))
+        except ValueError:
+            raise CommandError("--entries, --providers and --depth take comma separated integers.")
+        results = {}
+        for entries, providers, depth in combinations:
+            key = 'entries=%d,providers=%d,depth=%d' % (entries, providers, depth)
+            self.stdout.write(key)
+            results[key] = self.run_combination(entries, providers, depth, options['repeat'])
+            for step, result in sorted(results[key].items()):
+                self.stdout.write("    %-28s %8.1fms %6.1f queries %3d threads" %
+                                  (step, result['ms'], result['queries'], result['threads']))
+        if options['output']:
+            with open(options['output'], 'w') as fh:
+                json.dump(results, fh, indent=2, sort_keys=True)
+        if options['compare']:
+            with open(options['compare']) as fh:
+                self.compare(json.load(fh), results)
+
+    def run_combination(self, entries, providers, depth, repeat):
+        tenants = SyntheticTenants(providers=providers, referral_depth=depth)
+        steps = {}
+        with benchmark_databases(tenants.tenant_aliases), stubbed_side_effects(views) as stub:
+            tenants.return_url = stub.url + '/callback'
+            tenants.build()
+
+            measure = steps['set_momo_order_checkout'] = Measure()
+            parse_order_info = views.parse_order_info
+            try:
+                for i in range(repeat):
+                    order = tenants.create_order(entries)
+                    views.parse_order_info = lambda request: order
+                    request = tenants.get_request(order.member, 'post')
+                    with measure():
+                        views.set_momo_order_checkout(request, tenants.payment_mean)
+            finally:
+                views.parse_order_info = parse_order_info
+
+            for step, is_async in (('confirm_checkout', False), ('confirm_checkout_async', True)):
+                measure = steps[step] = Measure()
+                with override_settings(PLAYGROUND_ASYNC_CHECKOUT=is_async):
+                    for i in range(repeat):
+                        order = tenants.create_order(entries)
+                        request = tenants.get_request(order.member, session={'object_id': order.id})
+                        with measure():
+                            views.confirm_checkout(request)
+
+            measure = steps['after_order_confirmation'] = Measure()
+            for i in range(repeat):
+                order = tenants.create_order(entries)
+                with measure():
+                    views.after_order_confirmation(order)
+
+            if tenants.daras:
+                measure = steps['set_customer_dara'] = Measure()
+                dara_member = tenants.daras[0][0].member
+                for i in range(repeat):
+                    referee = tenants.create_referee()
+                    with measure():
+                        views.set_customer_dara(tenants.retailer, dara_member, referee)
+        return dict((step, measure.as_dict(repeat)) for step, measure in steps.items())
+
+    def compare(self, previous, current):
+        self.stdout.write("Compared with previous run:")
+        for key in sorted(set(previous.keys()) & set(current.keys())):
+            self.stdout.write(key)
+            for step in sorted(set(previous[key].keys()) & set(current[key].keys())):
+                before, after = previous[key][step], current[key][step]
+                change = (after['ms'] - before['ms']) * 100 / before['ms'] if before['ms'] else 0
+                self.stdout.write("    %-28s %8.1fms -> %8.1fms (%+.0f%%), %6.1f -> %6.1f queries" %
+                                  (step, before['ms'], after['ms'], change, before['queries'], after['queries']))
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import time
+from optparse import make_option
+
+from django.core.mail import EmailMessage
+from django.core.management.base import BaseCommand
+from django.template import TemplateDoesNotExist
+from django.template.loader import get_template
+from django.test.utils import override_settings
+
+from playground.mail import Mailer, get_cached_template
+from playground.stubs import StubSMTPServer
+
+TEMPLATES = ['playground/mails/order_notice.html', 'shopping/mails/order_notice_with_reward.html',
+             'playground/mails/new_transaction_test.html', 'playground/mails/referee_joined.html']
+
+
+class Command(BaseCommand):
+    help = "Sends order notices to a local SMTP sink one connection per message as before, then " \
+           "through the Mailer, and reports messages per second of each. Also times template loading."
+    option_list = BaseCommand.option_list + (
+        make_option('--messages', type='int', default=200, help="Messages sent in each mode."),
+        make_option('--batch-size', type='int', default=50, help="Batch size of the Mailer."),
+        make_option('--renders', type='int', default=200, help="Template loads timed in each mode."),
+    )
+
+    def handle(self, *args, **options):
+        stub = StubSMTPServer().start()
+        try:
+            with override_settings(EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+                                   EMAIL_HOST=stub.host, EMAIL_PORT=stub.port, EMAIL_USE_TLS=False,
+                                   EMAIL_HOST_USER='', EMAIL_HOST_PASSWORD=''):
+                self.bench_sending(stub, options)
+        finally:
+            stub.stop()
+        with override_settings(DEBUG=False):
+            self.bench_templates(options['renders'])
+
+    def get_messages(self, count):
+        # Operators are in BCC of every notice, and the same notice is
+        # sometimes sent twice, as when a payment is notified twice.
+        messages = []
+        for i in range(count):
+            msg = EmailMessage("Order successful", "<p>Order %d</p>" % (i // 2), 'no-reply@bench.local',
+                               ['buyer%d@bench.local' % (i // 2)],
+                               bcc=['sales@bench.local', 'Sales@bench.local ', 'delivery@bench.local'])
+            msg.content_subtype = "html"
+            messages.append(msg)
+        return messages
+
+    def report(self, mode, stub, elapsed, count):
+        self.stdout.write("%-8s %6d messages in %.2fs: %7.1f messages/s, %d SMTP connections, %d recipients" %
+                          (mode, count, elapsed, count / elapsed if elapsed else 0, stub.connection_count,
+                           stub.recipient_count))
+
+    def bench_sending(self, stub, options):
+        messages = self.get_messages(options['messages'])
+        start = time.time()
+        for msg in messages:
+            msg.send()
+        self.report('single', stub, time.time() - start, len(messages))
+
+        stub.messages, stub.connection_count = [], 0
+        mailer = Mailer(batch_size=options['batch_size'])
+        messages = self.get_messages(options['messages'])
+        start = time.time()
+        for i in range(0, len(messages), options['batch_size']):
+            mailer.flush(messages[i:i + options['batch_size']])
+        mailer._close()
+        self.report('batched', stub, time.time() - start, len(messages))
+        self.stdout.write("Mailer: %s" % mailer.stats())
+
+    def bench_templates(self, renders):
+        for template_name in TEMPLATES:
+            try:
+                get_template(template_name)
+            except TemplateDoesNotExist:
+                self.stdout.write("%s: not found" % template_name)
+                continue
+            timings = []
+            for load in (get_template, get_cached_template):
+                start = time.time()
+                for i in range(renders):
+                    load(template_name)
+                timings.append((time.time() - start) * 1000 / renders)
+            self.stdout.write("%s: %.3fms loaded, %.3fms cached" % (template_name, timings[0], timings[1]))
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import reset_queries
+from django.test.utils import override_settings
+
+from ikwen_kakocase.trade.models import Order
+
+from playground import mail
+from playground.benchmarks import count_queries
+from playground.views import after_order_confirmation
+
+
+class Command(BaseCommand):
+    args = '<order_id order_id ...>'
+    help = "Runs after_order_confirmation on existing orders with immediate and write-behind " \
+           "counters and reports the query count and latency of both. Orders are settled " \
+           "again, so only run this against a staging copy of the databases."
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat', type='int', default=1,
+                    help="Number of times each order is processed in each mode."),
+    )
+
+    def handle(self, *args, **options):
+        if not getattr(settings, 'DEBUG', False):
+            raise CommandError("DEBUG must be True: queries are only recorded in DEBUG mode "
+                               "and this command must not run against production databases.")
+        if not args:
+            raise CommandError("Give at least one Order id.")
+        orders = [Order.objects.get(pk=order_id) for order_id in args]
+        for immediate, label in ((True, "Immediate"), (False, "Write-behind")):
+            elapsed, queries = 0, {}
+            with override_settings(PLAYGROUND_WRITE_BEHIND_COUNTERS=not immediate,
+                                   PLAYGROUND_COUNTERS_FLUSH_INTERVAL=0):
+                for i in range(options['repeat']):
+                    for order in orders:
+                        reset_queries()
+                        start = time.time()
+                        after_order_confirmation(order, update_stock=False)
+                        elapsed += time.time() - start
+                        for alias, count in count_queries().items():
+                            queries[alias] = queries.get(alias, 0) + count
+            runs = float(options['repeat'] * len(orders))
+            self.stdout.write("%s: %.1fms/order, %.1f queries/order" %
+                              (label, elapsed * 1000 / runs, sum(queries.values()) / runs))
+            for alias in sorted(queries.keys()):
+                self.stdout.write("    %s: %.1f" % (alias, queries[alias] / runs))
+        left = mail.drain()
+        if left:
+            self.stdout.write("Background jobs left in the outbox: %s" % left)
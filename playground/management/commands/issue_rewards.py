@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from playground import mail
+from playground.models import RewardGrant
+from playground.rewards import issue
+
+
+class Command(BaseCommand):
+    help = "Grants payment rewards queued when PLAYGROUND_REWARD_INTERVAL is set, then reports grants " \
+           "that failed or are stuck issuing."
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=500, help="Grants issued per batch."),
+    )
+
+    def handle(self, *args, **options):
+        start = time.time()
+        total = 0
+        while True:
+            issued = issue(options['batch_size'])
+            total += issued
+            if issued < options['batch_size']:
+                break
+        self.stdout.write("%d rewards granted in %.2fs" % (total, time.time() - start))
+        for status in (RewardGrant.FAILED, RewardGrant.ISSUING):
+            for grant in RewardGrant.objects.filter(status=status).order_by('created_on'):
+                self.stdout.write("%s, check the rewards of Order %s: %s" %
+                                  (status, grant.order_id, grant.error or "interrupted while issuing"))
+        left = mail.drain()
+        if left:
+            self.stdout.write("Background jobs left in the outbox: %s" % left)
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.wsgi import get_wsgi_application
+from django.test.utils import override_settings
+
+from playground.benchmarks import SyntheticTenants, benchmark_databases
+from playground.loadtest import STEPS, find_saturation, local_server, login, posted_orders, run_level, sms_to
+from playground.stubs import StubHTTPServer, StubSMTPServer
+
+
+class Command(BaseCommand):
+    help = "Load tests the Mobile Money checkout: virtual users go through cart, checkout, payment and " \
+           "confirm_checkout over HTTP against a local server, with payment, SMS, partner callbacks and " \
+           "SMTP stubbed, in throwaway databases. Reports throughput, latency percentiles, error rate and " \
+           "thread growth at each concurrency level, and where throughput stops growing."
+    option_list = BaseCommand.option_list + (
+        make_option('--concurrency', default='1,5,10,20', help="Comma separated numbers of virtual users."),
+        make_option('--iterations', type='int', default=5, help="Checkouts per virtual user at each level."),
+        make_option('--entries', type='int', default=2, help="Entries per order."),
+        make_option('--providers', type='int', default=1, help="Number of providers."),
+        make_option('--depth', type='int', default=1, help="Referral depth of buyers."),
+        make_option('--payment-delay', type='float', default=0.2, help="Seconds the payment stub takes."),
+        make_option('--sms-delay', type='float', default=0.05, help="Seconds the SMS stub takes."),
+        make_option('--webhook-delay', type='float', default=0.05, help="Seconds the partner stub takes."),
+        make_option('--async', action='store_true', dest='async', default=False,
+                    help="Process confirmed orders in the background (PLAYGROUND_ASYNC_CHECKOUT)."),
+        make_option('--output', help="File to save results to, as JSON."),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            levels = [int(level) for level in options['concurrency'].split(',')]
+        except ValueError:
+            raise CommandError("--concurrency takes comma separated integers.")
+        tenants = SyntheticTenants(providers=options['providers'], referral_depth=options['depth'])
+        payment = StubHTTPServer(delay=options['payment_delay']).start()
+        sms = StubHTTPServer(delay=options['sms_delay']).start()
+        webhooks = StubHTTPServer(delay=options['webhook_delay']).start()
+        smtp = StubSMTPServer().start()
+        results = []
+        try:
+            with benchmark_databases(tenants.tenant_aliases), \
+                    override_settings(ROOT_URLCONF='playground.loadtest', DEBUG=False, ALLOWED_HOSTS=['*'],
+                                      EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+                                      EMAIL_HOST=smtp.host, EMAIL_PORT=smtp.port, EMAIL_USE_TLS=False,
+                                      EMAIL_HOST_USER='', EMAIL_HOST_PASSWORD='',
+                                      PLAYGROUND_ASYNC_CHECKOUT=options['async'],
+                                      PLAYGROUND_MAX_TENANT_DATABASES=10000), \
+                    posted_orders(), sms_to(sms.url), local_server(get_wsgi_application()) as base_url:
+                tenants.return_url = webhooks.url + '/callback'
+                tenants.build()
+                for level in levels:
+                    flows = []
+                    for i in range(level * options['iterations']):
+                        order = tenants.create_order(options['entries'])
+                        flows.append((order.id, order.delivery_address.phone, login(order.member)))
+                    result = run_level(base_url, payment.url, flows, level)
+                    results.append(result)
+                    self.report(result)
+        finally:
+            for stub in (payment, sms, webhooks, smtp):
+                stub.stop()
+
+        self.stdout.write("Stubs received %d payments, %d SMS, %d partner callbacks and %d emails" %
+                          (len(payment.requests), len(sms.requests), len(webhooks.requests), len(smtp.messages)))
+        saturation = find_saturation(results)
+        if saturation:
+            self.stdout.write("Throughput stops growing at %d virtual users" % saturation)
+        else:
+            self.stdout.write("Throughput grows up to the highest level tested")
+        if options['output']:
+            with open(options['output'], 'w') as fh:
+                json.dump({'options': dict((key, options[key]) for key in
+                                           ('concurrency', 'iterations', 'entries', 'providers', 'depth',
+                                            'payment_delay', 'sms_delay', 'webhook_delay', 'async')),
+                           'levels': results, 'saturation': saturation}, fh, indent=2, sort_keys=True)
+
+    def report(self, result):
+        flow = result['flow']
+        self.stdout.write("%3d users: %6.1f checkouts/s, p50 %7.1fms, p95 %7.1fms, p99 %7.1fms, "
+                          "%5.1f%% errors, +%d threads at peak, +%d left" %
+                          (result['concurrency'], result['flows_per_second'], flow['p50_ms'], flow['p95_ms'],
+                           flow['p99_ms'], result['error_rate'] * 100, result['threads']['peak_growth'],
+                           result['threads']['left']))
+        for step in STEPS:
+            values = result['steps'][step]
+            self.stdout.write("    %-18s p50 %7.1fms, p95 %7.1fms, p99 %7.1fms" %
+                              (step, values['p50_ms'], values['p95_ms'], values['p99_ms']))
+        for error, count in sorted(result['errors'].items()):
+            self.stdout.write("    %d x %s" % (count, error))
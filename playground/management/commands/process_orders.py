@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from optparse import make_option
+
+from currencies.models import Currency
+from django.core.management.base import BaseCommand, CommandError
+
+from playground import mail
+from playground.models import OrderStage
+from playground.pipeline import get_stalled_order_ids
+from playground.views import process_order
+
+
+class Command(BaseCommand):
+    args = '<order_id order_id ...>'
+    help = "Processes confirmed orders again. Stages already done are skipped, " \
+           "failed or stalled stages run again only with --retry."
+    option_list = BaseCommand.option_list + (
+        make_option('--retry', action='store_true', default=False,
+                    help="Run failed or stalled stages again. Make sure they did not partly run first."),
+        make_option('--failed', action='store_true', default=False,
+                    help="Process all orders whose processing failed or stalled, see PLAYGROUND_STAGE_TIMEOUT."),
+        make_option('--days', type='int', default=7,
+                    help="With --failed, how far back to look for confirmed orders never notified."),
+    )
+
+    def handle(self, *args, **options):
+        order_ids = list(args)
+        if options['failed']:
+            order_ids += get_stalled_order_ids(options['days'])
+        if not order_ids:
+            raise CommandError("Give Order ids or use --failed.")
+        crcy = Currency.objects.get(is_default=True)
+        for order_id in sorted(set(order_ids)):
+            process_order(order_id, crcy, retry=options['retry'])
+            stages = OrderStage.objects.filter(order_id=order_id).order_by('created_on')
+            self.stdout.write("%s: %s" % (order_id, ', '.join('%s %s' % (stage.stage, stage.status) for stage in stages)))
+        left = mail.drain()
+        if left:
+            self.stdout.write("Background jobs left in the outbox: %s" % left)
@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+from django.core.management.base import BaseCommand
+
+from playground.stock import release_expired
+
+
+class Command(BaseCommand):
+    help = "Gives back to stock the units of expired reservations, those of orders that were never paid."
+
+    def handle(self, *args, **options):
+        self.stdout.write("%d reservations released" % release_expired())
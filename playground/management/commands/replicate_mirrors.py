@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from playground.replication import apply_pending, get_pending_databases
+
+
+class Command(BaseCommand):
+    args = '<db db ...>'
+    help = "Applies pending writes to mirrors recorded when PLAYGROUND_ASYNC_MIRRORS is True, for the " \
+           "databases given or all of them, then reports the lag of each database still behind."
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=100, help="Mutations applied per batch."),
+    )
+
+    def handle(self, *args, **options):
+        start = time.time()
+        total = 0
+        for db in args or get_pending_databases().keys():
+            while True:
+                applied = apply_pending(db, options['batch_size'])
+                if applied is None:
+                    self.stdout.write("%s: held by another replicator" % db)
+                    break
+                total += applied
+                if applied < options['batch_size']:
+                    break
+        elapsed = time.time() - start
+        self.stdout.write("%d mutations applied in %.2fs" % (total, elapsed))
+        for db, lag in sorted(get_pending_databases().items()):
+            self.stdout.write("%s: %d pending, %.1fs behind" % (db, lag['pending'], lag['lag']))
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from playground.rollups import fold
+
+
+class Command(BaseCommand):
+    help = "Folds the order facts appended by the order path into watch object counters and " \
+           "daily, weekly and monthly rollups. Run it regularly when PLAYGROUND_ORDER_ROLLUPS is True."
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=500, help="Facts folded per batch."),
+        make_option('--max-batches', type='int', default=0, help="Stop after this number of batches. 0 for no limit."),
+    )
+
+    def handle(self, *args, **options):
+        start = time.time()
+        total, batches = 0, 0
+        while not options['max_batches'] or batches < options['max_batches']:
+            count = fold(options['batch_size'])
+            if not count:
+                break
+            total += count
+            batches += 1
+        elapsed = time.time() - start
+        self.stdout.write("%d facts folded in %d batches, %.2fs (%.0f facts/s)" %
+                          (total, batches, elapsed, total / elapsed if elapsed else 0))
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from playground.ledger import settle, reconcile
+
+
+class Command(BaseCommand):
+    help = "Settles pending earnings of the ledger into balances. With --reconcile, also reports the " \
+           "amounts settled and pending per service, and entries stuck settling."
+    option_list = BaseCommand.option_list + (
+        make_option('--service', help="Only settle earnings of the Service with this id."),
+        make_option('--batch-size', type='int', default=1000, help="Entries settled per batch."),
+        make_option('--reconcile', action='store_true', default=False, help="Report totals per service."),
+    )
+
+    def handle(self, *args, **options):
+        start = time.time()
+        total = 0
+        while True:
+            settled = settle(options['batch_size'], options['service'])
+            total += settled
+            if settled < options['batch_size']:
+                break
+        self.stdout.write("%d entries settled in %.2fs" % (total, time.time() - start))
+        if not options['reconcile']:
+            return
+        for (service_id, db), totals in sorted(reconcile(options['service']).items()):
+            self.stdout.write("%s in %s: %.2f settled, %.2f pending, %.2f settling" %
+                              (service_id, db, totals['settled'], totals['pending'], totals['settling']))
+            for key in totals['stuck']:
+                self.stdout.write("    Stuck settling, check the balance: %s" % key)
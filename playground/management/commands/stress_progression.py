@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from ikwen.accesscontrol.backends import UMBRELLA
+from ikwen.accesscontrol.models import Member
+
+from daraja.models import Dara
+
+from playground.benchmarks import benchmark_databases
+from playground.progression import TRANSITIONS
+
+
+class Command(BaseCommand):
+    help = "Has many threads apply the Dara progression transitions to the same Daras at once in throwaway " \
+           "databases, one Dara at a time then in bulk. Checks that each bonus is awarded exactly once, " \
+           "then reports throughput."
+    option_list = BaseCommand.option_list + (
+        make_option('--threads', type='int', default=20, help="Concurrent threads."),
+        make_option('--daras', type='int', default=200, help="Daras progressed."),
+        make_option('--batch-size', type='int', default=50, help="Daras per update in bulk."),
+    )
+
+    def handle(self, *args, **options):
+        with benchmark_databases([]):
+            daras = []
+            for i in range(options['daras']):
+                member = Member(username='dara%d' % i, email='dara%d@bench.local' % i, first_name='Dara%d' % i,
+                                last_name='Bench', phone='6%08d' % i)
+                member.save(using=UMBRELLA)
+                daras.append(Dara.objects.using(UMBRELLA).create(member=member, share_rate=5, level=1, xp=0,
+                                                                 bonus_cash=0))
+            problems = []
+            for mode in ('single', 'bulk'):
+                Dara.objects.using(UMBRELLA).update(xp=0, bonus_cash=0)
+                result = self.run(mode, daras, options)
+                self.stdout.write("%s: %d attempts in %.2fs, %.0f attempts/s, %d errors" %
+                                  (mode, result['attempts'], result['elapsed'], result['attempts'] / result['elapsed'],
+                                   result['errors']))
+                for transition in TRANSITIONS:
+                    applied = result[transition.name]
+                    self.stdout.write("  %s applied %d times" % (transition.name, applied))
+                    if applied != len(daras):
+                        problems.append("%s: %s applied %d times to %d Daras" %
+                                        (mode, transition.name, applied, len(daras)))
+                bonus = sum(transition.bonus for transition in TRANSITIONS)
+                xp = TRANSITIONS[-1].xp_to
+                wrong = Dara.objects.using(UMBRELLA).exclude(xp=xp, bonus_cash=bonus).count()
+                if wrong:
+                    problems.append("%s: %d Daras without xp %d and bonus cash %d" % (mode, wrong, xp, bonus))
+        if problems:
+            raise CommandError(', '.join(problems))
+        self.stdout.write("OK")
+
+    def run(self, mode, daras, options):
+        result = dict.fromkeys(['attempts', 'errors'] + [transition.name for transition in TRANSITIONS], 0)
+        lock = threading.Lock()
+        batch_size = options['batch_size']
+
+        def add(**counts):
+            with lock:
+                for key, value in counts.items():
+                    result[key] += value
+
+        def progress(offset):
+            # Threads start at different Daras so that they overlap everywhere
+            ordered = daras[offset:] + daras[:offset]
+            try:
+                for transition in TRANSITIONS:
+                    if mode == 'bulk':
+                        for i in range(0, len(ordered), batch_size):
+                            batch = ordered[i:i + batch_size]
+                            try:
+                                add(attempts=len(batch), **{transition.name: transition.apply_bulk(batch)})
+                            except:
+                                add(attempts=len(batch), errors=1)
+                        continue
+                    for dara in ordered:
+                        try:
+                            add(attempts=1, **{transition.name: int(transition.apply(dara.member_id))})
+                        except:
+                            add(attempts=1, errors=1)
+            finally:
+                connection.close()
+
+        step = max(len(daras) // options['threads'], 1)
+        threads = [threading.Thread(target=progress, args=((i * step) % len(daras), ))
+                   for i in range(options['threads'])]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        result['elapsed'] = time.time() - start
+        return result
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import random
+import threading
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from ikwen_kakocase.kako.models import Product
+
+from playground import stock
+from playground.benchmarks import SyntheticTenants, benchmark_databases
+
+
+class Command(BaseCommand):
+    help = "Has many threads reserve and buy the same product at once in throwaway databases. Checks that " \
+           "the product is never oversold and that it is sold out exactly when its stock runs out, then " \
+           "reports throughput."
+    option_list = BaseCommand.option_list + (
+        make_option('--threads', type='int', default=20, help="Concurrent buyers."),
+        make_option('--attempts', type='int', default=50, help="Purchases attempted by each buyer."),
+        make_option('--stock', type='int', default=500, help="Initial stock of the product."),
+        make_option('--units', type='int', default=1, help="Units bought at each attempt."),
+        make_option('--abandon', type='float', default=0,
+                    help="Share of reservations released instead of paid, between 0 and 1."),
+    )
+
+    def handle(self, *args, **options):
+        if not 0 <= options['abandon'] <= 1:
+            raise CommandError("--abandon must be between 0 and 1.")
+        tenants = SyntheticTenants(providers=1, referral_depth=0)
+        with benchmark_databases(tenants.tenant_aliases):
+            tenants.build()
+            product = Product.objects.create(name='Flash sale', category=tenants.category,
+                                             provider=tenants.providers[0], retail_price=1000,
+                                             stock=options['stock'])
+            result = self.run(product.id, options)
+            final_stock = Product.objects.get(pk=product.id).stock
+
+        paid_units = result['paid'] * options['units']
+        self.stdout.write("%d attempts in %.2fs: %.0f reservations/s" %
+                          (result['attempts'], result['elapsed'], result['attempts'] / result['elapsed']))
+        self.stdout.write("Reserved: %d, rejected: %d, paid: %d, released: %d, errors: %d" %
+                          (result['reserved'], result['rejected'], result['paid'], result['released'],
+                           result['errors']))
+        self.stdout.write("Stock: %d initial, %d final, %d units paid, sold out %d time(s)" %
+                          (options['stock'], final_stock, paid_units, result['sold_out']))
+        problems = []
+        if final_stock < 0 or paid_units > options['stock']:
+            problems.append("product oversold")
+        if final_stock != options['stock'] - paid_units:
+            problems.append("final stock does not match units paid")
+        if not options['abandon'] and result['sold_out'] != (1 if final_stock == 0 else 0):
+            problems.append("sold out fired %d times" % result['sold_out'])
+        if problems:
+            raise CommandError(', '.join(problems).capitalize())
+        self.stdout.write("OK")
+
+    def run(self, product_id, options):
+        result = dict.fromkeys(('attempts', 'reserved', 'rejected', 'paid', 'released', 'errors', 'sold_out'), 0)
+        lock = threading.Lock()
+        units = {product_id: options['units']}
+
+        def add(**counts):
+            with lock:
+                for key, value in counts.items():
+                    result[key] += value
+
+        def buy(buyer):
+            try:
+                for i in range(options['attempts']):
+                    order_id = 'stress-%d-%d' % (buyer, i)
+                    try:
+                        stock.reserve(order_id, units)
+                    except stock.InsufficientStock:
+                        add(attempts=1, rejected=1)
+                        continue
+                    except:
+                        add(attempts=1, errors=1)
+                        continue
+                    add(attempts=1, reserved=1)
+                    if random.random() < options['abandon']:
+                        add(released=stock.release(order_id))
+                    else:
+                        add(paid=1, sold_out=len(stock.commit(order_id, units)))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=buy, args=(buyer, )) for buyer in range(options['threads'])]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        result['elapsed'] = time.time() - start
+        return result
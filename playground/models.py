@@ -1,3 +1,179 @@
 from django.db import models
 
-# Create your models here.
+
+class OrderStage(models.Model):
+    """
+    Marks a stage of the order processing pipeline as started for an
+    order. key is unique, so a stage can only be claimed once whatever
+    the number of payment gateway callbacks received for the order.
+    """
+    RUNNING = 'Running'
+    DONE = 'Done'
+    FAILED = 'Failed'
+
+    key = models.CharField(max_length=150, unique=True)
+    order_id = models.CharField(max_length=60, db_index=True)
+    stage = models.CharField(max_length=30)
+    status = models.CharField(max_length=15, default=RUNNING)
+    error = models.TextField(blank=True, null=True)
+    created_on = models.DateTimeField(auto_now_add=True)
+    updated_on = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return self.key
+
+
+class OrderFact(models.Model):
+    """
+    Counter changes caused by a confirmed order, appended by the order
+    path instead of updating each watch object. deltas and assignments
+    are JSON lists of [db, model, object_id, field, value]. batch is set
+    when a rollup claims the fact for folding, counted_on once its
+    changes are applied to the watch objects and folded_on once they
+    are added to the rollups too.
+    """
+    order_id = models.CharField(max_length=60, db_index=True)
+    deltas = models.TextField()
+    assignments = models.TextField(default='[]')
+    batch = models.CharField(max_length=60, blank=True, null=True, db_index=True)
+    claimed_on = models.DateTimeField(blank=True, null=True, db_index=True)
+    counted_on = models.DateTimeField(blank=True, null=True)
+    folded_on = models.DateTimeField(blank=True, null=True, db_index=True)
+    created_on = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __unicode__(self):
+        return self.order_id
+
+
+class OrderRollup(models.Model):
+    """
+    Sum of a counter field of a watch object over a day, week or month,
+    starting on start. key is unique over those.
+    """
+    DAILY = 'Daily'
+    WEEKLY = 'Weekly'
+    MONTHLY = 'Monthly'
+
+    key = models.CharField(max_length=250, unique=True)
+    period = models.CharField(max_length=15)
+    start = models.DateField(db_index=True)
+    db = models.CharField(max_length=100)
+    model = models.CharField(max_length=100)
+    object_id = models.CharField(max_length=60, db_index=True)
+    field = models.CharField(max_length=60)
+    value = models.FloatField(default=0)
+
+    def __unicode__(self):
+        return self.key
+
+
+class StockReservation(models.Model):
+    """
+    Units of a product taken from its stock for an order being paid.
+    The reservation is committed when the payment is confirmed, or
+    released when it expires. key is unique over order and product.
+    sold_out is set on the reservation whose units ran the product out.
+    """
+    RESERVED = 'Reserved'
+    COMMITTED = 'Committed'
+    RELEASED = 'Released'
+
+    key = models.CharField(max_length=150, unique=True)
+    order_id = models.CharField(max_length=60, db_index=True)
+    product_id = models.CharField(max_length=60, db_index=True)
+    count = models.IntegerField()
+    status = models.CharField(max_length=15, default=RESERVED, db_index=True)
+    expires_on = models.DateTimeField(db_index=True)
+    sold_out = models.BooleanField(default=False)
+    created_on = models.DateTimeField(auto_now_add=True)
+    updated_on = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return self.key
+
+
+class MirrorMutation(models.Model):
+    """
+    Writes to mirrors of objects in the database db of another tenant,
+    recorded by the order path and applied later, in order, by the
+    replicator. operations is a JSON list, see playground.replication.
+    """
+    PENDING = 'Pending'
+    APPLYING = 'Applying'
+    APPLIED = 'Applied'
+    FAILED = 'Failed'
+
+    db = models.CharField(max_length=100, db_index=True)
+    operations = models.TextField()
+    status = models.CharField(max_length=15, default=PENDING, db_index=True)
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(blank=True, null=True)
+    created_on = models.DateTimeField(auto_now_add=True, db_index=True)
+    applied_on = models.DateTimeField(blank=True, null=True)
+
+    def __unicode__(self):
+        return '%s: %s' % (self.db, self.created_on)
+
+
+class MirrorLease(models.Model):
+    """
+    Held by the replicator applying mutations of db, so that a single
+    one does at a time and mutations are applied in order.
+    """
+    db = models.CharField(max_length=100, unique=True)
+    owner = models.CharField(max_length=60)
+    expires_on = models.DateTimeField()
+
+    def __unicode__(self):
+        return self.db
+
+
+class EarningEntry(models.Model):
+    """
+    Earnings of the service service_id on an order, recorded in the
+    ledger then added to the balance of the service, loaded from db,
+    by settlement. key is unique over order, service and database.
+    """
+    PENDING = 'Pending'
+    SETTLING = 'Settling'
+    SETTLED = 'Settled'
+
+    key = models.CharField(max_length=250, unique=True)
+    order_id = models.CharField(max_length=60, db_index=True)
+    service_id = models.CharField(max_length=60, db_index=True)
+    db = models.CharField(max_length=100)
+    provider = models.CharField(max_length=60, blank=True, null=True)
+    amount = models.FloatField()
+    status = models.CharField(max_length=15, default=PENDING, db_index=True)
+    batch = models.CharField(max_length=60, blank=True, null=True, db_index=True)
+    created_on = models.DateTimeField(auto_now_add=True, db_index=True)
+    settled_on = models.DateTimeField(blank=True, null=True)
+
+    def __unicode__(self):
+        return self.key
+
+
+class RewardGrant(models.Model):
+    """
+    Payment rewards of the buyer of an order, queued to be granted with
+    reward_member by the reward issuer. key is unique per order.
+    """
+    PENDING = 'Pending'
+    ISSUING = 'Issuing'
+    ISSUED = 'Issued'
+    FAILED = 'Failed'
+
+    key = models.CharField(max_length=250, unique=True)
+    order_id = models.CharField(max_length=60, db_index=True)
+    service_id = models.CharField(max_length=60, db_index=True)
+    member_id = models.CharField(max_length=60, blank=True, null=True)
+    amount = models.FloatField()
+    coupon_count = models.IntegerField(default=0)
+    status = models.CharField(max_length=15, default=PENDING, db_index=True)
+    batch = models.CharField(max_length=60, blank=True, null=True, db_index=True)
+    error = models.TextField(blank=True, null=True)
+    created_on = models.DateTimeField(auto_now_add=True, db_index=True)
+    issued_on = models.DateTimeField(blank=True, null=True)
+
+    def __unicode__(self):
+        return self.key
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import logging
+import traceback
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import IntegrityError
+
+from playground.models import OrderStage
+
+logger = logging.getLogger('ikwen')
+
+CONFIRMATION = 'confirmation'
+SETTLEMENT = 'settlement'
+REWARDS = 'rewards'
+NOTIFICATIONS = 'notifications'
+
+
+def _get_key(order_id, stage):
+    return '%s:%s' % (order_id, stage)
+
+
+def _get_stalled_on():
+    # Stages running since before that were left by a process that stopped
+    return datetime.now() - timedelta(seconds=getattr(settings, 'PLAYGROUND_STAGE_TIMEOUT', 3600))
+
+
+def claim(order_id, stage, retry=False):
+    """
+    Claims stage for the order and returns True, or False if it was
+    already claimed. With retry=True, a stage that failed, or that has
+    been running for more than PLAYGROUND_STAGE_TIMEOUT seconds, can be
+    claimed again; such a stage is never claimed again implicitly
+    because it may have partly run.
+    """
+    key = _get_key(order_id, stage)
+    try:
+        OrderStage.objects.create(key=key, order_id=order_id, stage=stage)
+        return True
+    except IntegrityError:
+        if retry:
+            if OrderStage.objects.filter(key=key, status=OrderStage.FAILED)\
+                    .update(status=OrderStage.RUNNING, error=None, updated_on=datetime.now()):
+                return True
+            return OrderStage.objects.filter(key=key, status=OrderStage.RUNNING, updated_on__lt=_get_stalled_on())\
+                       .update(error=None, updated_on=datetime.now()) == 1
+        return False
+
+
+def get_stalled_order_ids(days=7):
+    """
+    Returns ids of the orders whose processing stopped: a stage failed or
+    has been running for more than PLAYGROUND_STAGE_TIMEOUT seconds, or
+    the order was confirmed that long ago, in the last days days, and
+    never got to notifications.
+    """
+    stalled_on = _get_stalled_on()
+    order_ids = set(OrderStage.objects.filter(status=OrderStage.FAILED).values_list('order_id', flat=True))
+    order_ids |= set(OrderStage.objects.filter(status=OrderStage.RUNNING, updated_on__lt=stalled_on)
+                     .values_list('order_id', flat=True))
+    confirmed = set(OrderStage.objects.filter(stage=CONFIRMATION, status=OrderStage.DONE, updated_on__lt=stalled_on,
+                                              updated_on__gte=stalled_on - timedelta(days=days))
+                    .values_list('order_id', flat=True))
+    if confirmed:
+        notified = set(OrderStage.objects.filter(stage=NOTIFICATIONS, order_id__in=list(confirmed))
+                       .values_list('order_id', flat=True))
+        order_ids |= confirmed - notified
+    return sorted(order_ids)
+
+
+def run_stage(order_id, stage, func, *args, **kwargs):
+    """
+    Runs func(*args, **kwargs) once per order. Returns True if the stage
+    ran successfully now, False if it was already claimed. Exceptions
+    are recorded on the stage then raised again.
+    """
+    retry = kwargs.pop('retry', False)
+    if not claim(order_id, stage, retry):
+        return False
+    key = _get_key(order_id, stage)
+    try:
+        func(*args, **kwargs)
+    except:
+        OrderStage.objects.filter(key=key).update(status=OrderStage.FAILED, error=traceback.format_exc(),
+                                                  updated_on=datetime.now())
+        raise
+    OrderStage.objects.filter(key=key).update(status=OrderStage.DONE, updated_on=datetime.now())
+    return True
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Progression of Daras through the first steps of the game, each step
+rewarded with bonus cash. A Transition moves a Dara from one xp to the
+next with a single conditional update, on the UMBRELLA database, that
+only matches a Dara still at the starting xp. When several orders race
+for the same Dara, only one update matches and the bonus is awarded
+exactly once, without loading or locking the Dara first.
+"""
+from django.db.models import F
+
+from ikwen.accesscontrol.backends import UMBRELLA
+
+from daraja.models import Dara
+
+
+class Transition(object):
+    """
+    Moves Daras of level at xp xp_from to xp_to, raising their bonus
+    cash by bonus.
+    """
+    def __init__(self, name, level, xp_from, xp_to, bonus):
+        self.name = name
+        self.level = level
+        self.xp_from = xp_from
+        self.xp_to = xp_to
+        self.bonus = bonus
+
+    def _update(self, queryset):
+        return queryset.filter(level=self.level, xp=self.xp_from)\
+            .update(xp=self.xp_to, bonus_cash=F('bonus_cash') + self.bonus)
+
+    def _mark(self, dara):
+        # Reflects the update on an instance loaded before it
+        if dara is not None and dara.level == self.level and dara.xp == self.xp_from:
+            dara.xp = self.xp_to
+            dara.bonus_cash += self.bonus
+
+    def apply(self, member, dara=None):
+        """
+        Applies the transition to the Dara of member, if due. Returns True
+        if it was applied now. dara, the Dara of member if already loaded,
+        is updated accordingly.
+        """
+        applied = self._update(Dara.objects.using(UMBRELLA).filter(member=member)) == 1
+        if applied:
+            self._mark(dara)
+        return applied
+
+    def apply_bulk(self, daras):
+        """
+        Applies the transition to every Dara of daras it is due for, with
+        one update. Returns the number of Daras it was applied to.
+        Instances are updated as if it was applied to all those that
+        were due when they were loaded.
+        """
+        daras = list(daras)
+        if not daras:
+            return 0
+        applied = self._update(Dara.objects.using(UMBRELLA).filter(pk__in=[dara.pk for dara in daras]))
+        for dara in daras:
+            self._mark(dara)
+        return applied
+
+    def __repr__(self):
+        return '<Transition %s: level %d, xp %d -> %d, +%d>' % (self.name, self.level, self.xp_from, self.xp_to,
+                                                              self.bonus)
+
+
+FIRST_PURCHASE = Transition('first_purchase', level=1, xp_from=0, xp_to=1, bonus=100)
+FIRST_REFEREE = Transition('first_referee', level=1, xp_from=1, xp_to=2, bonus=100)
+FIRST_REFEREE_PURCHASE = Transition('first_referee_purchase', level=1, xp_from=2, xp_to=3, bonus=200)
+
+TRANSITIONS = [FIRST_PURCHASE, FIRST_REFEREE, FIRST_REFEREE_PURCHASE]
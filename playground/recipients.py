@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of the people notified of orders for each service: the addresses
+in notification_email of its OperatorProfile and the email of its owner.
+Entries are kept PLAYGROUND_RECIPIENTS_CACHE_TIMEOUT seconds and dropped
+as soon as the OperatorProfile is saved in this project. Saves made by
+other projects are seen when the entry expires.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_save
+
+from ikwen_kakocase.kakocase.models import OperatorProfile
+
+from playground.db import use_database
+
+
+def _get_key(service_id):
+    return 'playground:recipients:%s' % service_id
+
+
+def split_emails(emails):
+    return [email.strip() for email in (emails or '').split(',') if email.strip()]
+
+
+def get_recipients(service, profile=None):
+    """
+    Returns the notification recipients of service. profile, the
+    OperatorProfile of service, is looked up in the database of service
+    when not given and the recipients are not cached.
+    """
+    key = _get_key(service.id)
+    recipients = cache.get(key)
+    if recipients is None:
+        if profile is None:
+            db = service.database
+            use_database(db)
+            profile = OperatorProfile.objects.using(db).get(service=service)
+        recipients = split_emails(profile.notification_email) + [service.member.email]
+        cache.set(key, recipients, getattr(settings, 'PLAYGROUND_RECIPIENTS_CACHE_TIMEOUT', 600))
+    return recipients
+
+
+def invalidate_recipients(sender, instance, **kwargs):
+    cache.delete(_get_key(instance.service_id))
+
+post_save.connect(invalidate_recipients, sender=OperatorProfile)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Referral attribution in bulk, for imports and backfills of campaigns.
+attribute_referrals() does what set_customer_dara does for one referee,
+for many at once: a fixed number of queries per Dara instead of about
+ten per referee.
+"""
+import logging
+from datetime import datetime
+
+from django.core.mail import EmailMessage
+from django.utils.translation import gettext as _, activate
+
+from ikwen.accesscontrol.backends import UMBRELLA
+from ikwen.accesscontrol.models import Member
+from ikwen.core.models import Service, Application
+from ikwen.core.utils import add_event
+
+from ikwen_kakocase.shopping.models import Customer
+
+from daraja.models import Dara, DARAJA, REFEREE_JOINED_EVENT
+
+from playground import jobs, mail, progression
+from playground.counters import CounterBuffer
+from playground.db import use_database
+
+logger = logging.getLogger('ikwen')
+
+
+def notify_referee_joined(service, referrer, member, dara_umbrella):
+    """
+    Queues the email telling the Dara referrer that member joined service.
+    """
+    diff = datetime.now() - member.date_joined
+    activate(referrer.language)
+    sender = "%s via Playground <no-reply@ikwen.com>" % member.full_name
+    if diff.days > 1:
+        subject = _("I'm back on %s !" % service.project_name)
+    else:
+        subject = _("I just joined %s !" % service.project_name)
+    html_content = mail.render(subject, template_name='playground/mails/referee_joined.html',
+                               extra_context={'referred_service_name': service.project_name, 'referee': member,
+                                              'dara': dara_umbrella, 'cta_url': 'https://daraja.ikwen.com/'
+                                              })
+    msg = EmailMessage(subject, html_content, sender, [referrer.email])
+    msg.content_subtype = "html"
+    mail.send(msg)
+
+
+def _get_or_create_customers(db, referees, dara_service):
+    """
+    Makes each referee a Customer referred by dara_service in db.
+    Customers already existing are updated in one query, missing ones
+    created in one.
+    """
+    referee_ids = [member.id for member in referees]
+    existing = set(Customer.objects.using(db).filter(member__in=referee_ids).values_list('member', flat=True))
+    if existing:
+        Customer.objects.using(db).filter(member__in=existing).update(referrer=dara_service)
+    Customer.objects.using(db).bulk_create([Customer(member=member, referrer=dara_service)
+                                            for member in referees if member.id not in existing])
+
+
+def _mirror_customers(db, dara_db, referees):
+    """
+    Copies the Customers of referees in db to dara_db with their pk, as
+    set_customer_dara does with save(using=dara_db), so that later
+    mirror writes find them by pk.
+    """
+    customers = list(Customer.objects.using(db).filter(member__in=[member.id for member in referees]))
+    mirrored = set(Customer.objects.using(dara_db).filter(pk__in=[customer.pk for customer in customers])
+                   .values_list('id', flat=True))
+    for customer in customers:
+        if customer.pk in mirrored:
+            customer.save(using=dara_db)
+    Customer.objects.using(dara_db).bulk_create([customer for customer in customers if customer.pk not in mirrored])
+
+
+def attribute_referrals(service, bindings, notify=True):
+    """
+    Binds referees to the Daras who referred them on service.
+
+    :param service: Referred Service
+    :param bindings: Iterable of (referrer, member): the Dara Member and the
+        referred Member, as set_customer_dara takes them.
+    :param notify: Whether to queue the REFEREE_JOINED_EVENT and the email
+        to the Dara for each referee bound.
+    :return: dict of the number of referees bound, already referred or
+        whose referrer is not a Dara of service.
+    """
+    db = service.database
+    use_database(db)
+    stats = {'bound': 0, 'already_referred': 0, 'unknown_dara': 0}
+
+    # A referee already referred, or listed twice, keeps their first referrer
+    referrers, referees_by_referrer = {}, {}
+    seen = set()
+    for referrer, member in bindings:
+        if member.id in seen:
+            stats['already_referred'] += 1
+            continue
+        seen.add(member.id)
+        referrers[referrer.id] = referrer
+        referees_by_referrer.setdefault(referrer.id, []).append(member)
+    if not seen:
+        return stats
+    referred = set(Customer.objects.using(db).filter(member__in=list(seen), referrer__isnull=False)
+                   .values_list('member', flat=True))
+
+    app = Application.objects.using(db).get(slug=DARAJA)
+    dara_services = dict((dara_service.member_id, dara_service) for dara_service in
+                         Service.objects.using(db).filter(app=app, member__in=list(referrers.keys())))
+    daras = dict((dara.member_id, dara) for dara in
+                 Dara.objects.using(UMBRELLA).filter(member__in=list(referrers.keys())))
+    counters = CounterBuffer(immediate=False)
+    bound = []
+
+    for referrer_id, referees in referees_by_referrer.items():
+        referrer = referrers[referrer_id]
+        dara_service, dara_umbrella = dara_services.get(referrer_id), daras.get(referrer_id)
+        if dara_service is None or dara_umbrella is None:
+            stats['unknown_dara'] += len(referees)
+            continue
+        referees = [member for member in referees if member.id not in referred]
+        stats['already_referred'] += len(referees_by_referrer[referrer_id]) - len(referees)
+        if not referees:
+            continue
+        try:
+            _get_or_create_customers(db, referees, dara_service)
+
+            # Mirror referees in the Dara database
+            dara_db = dara_service.database
+            use_database(dara_db)
+            referee_ids = [member.id for member in referees]
+            mirrored = set(Member.objects.using(dara_db).filter(pk__in=referee_ids).values_list('id', flat=True))
+            Member.objects.using(dara_db).bulk_create([member for member in referees if member.id not in mirrored])
+            _mirror_customers(db, dara_db, referees)
+            service_mirror = Service.objects.using(dara_db).get(pk=service.id)
+            counters.set_counters(service_mirror)
+            counters.increment(service_mirror, 'community_history', len(referees))
+        except:
+            logger.error("%s - Error while binding %d referees to Dara %s" %
+                         (service.project_name, len(referees), referrer.username), exc_info=True)
+            continue
+
+        stats['bound'] += len(referees)
+        bound.append((referrer, referees, dara_umbrella))
+
+    counters.flush()
+    # The first referee bonus of all Daras who got referees, in one update
+    progression.FIRST_REFEREE.apply_bulk([dara_umbrella for referrer, referees, dara_umbrella in bound])
+    if notify:
+        for referrer, referees, dara_umbrella in bound:
+            for member in referees:
+                jobs.submit(add_event, service, REFEREE_JOINED_EVENT, member)
+                notify_referee_joined(service, referrer, member, dara_umbrella)
+    return stats
@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+"""
+Writes to mirrors, the copies of services, members and customers kept
+in the databases of other tenants, like the Dara of a referred customer.
+
+The order path records them through get_mirrors(). By default they are
+written right away, as they used to be. With PLAYGROUND_ASYNC_MIRRORS =
+True, they are recorded as one MirrorMutation per target database in
+the default database, and a Replicator applies them in the background
+in batches, per target database and in the order they were recorded.
+A lease per target database makes sure a single replicator applies its
+mutations at a time.
+
+There are no transactions to make applying a mutation and marking it
+applied atomic. A mutation is marked Applying before it is applied,
+so one found Applying by the next replicator was interrupted. Like one
+that failed while being written, counters included, it is marked
+Failed for an operator to check rather than applied twice. The lease
+is renewed between mutations, so that it does not expire while a batch
+is applied.
+Mirror objects are identified by their pk, which is the pk of the
+object they were copied from. Copies are recorded as the field values
+of the object, in JSON like the rest of the mutation.
+"""
+import copy
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from threading import Thread
+
+from django.conf import settings
+from django.core import serializers
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, close_old_connections
+from django.db.models import get_model
+
+from playground.counters import CounterBuffer
+from playground.db import close_evicted_connections, use_database
+from playground.identity import get_identity_map
+from playground.models import MirrorMutation, MirrorLease
+
+logger = logging.getLogger('ikwen')
+
+SAVE = 'save'
+ENSURE = 'ensure'
+COUNTERS = 'counters'
+
+
+def _get_label(obj):
+    return '%s.%s' % (obj._meta.app_label, obj._meta.object_name)
+
+
+def _dumps(obj):
+    # Field values of obj, which json.dumps encodes with DjangoJSONEncoder
+    return serializers.serialize('python', [obj])[0]['fields']
+
+
+def _loads(label, pk, data):
+    return list(serializers.deserialize('python', [{'model': label, 'pk': pk, 'fields': data}]))[0].object
+
+
+class DirectMirrors(object):
+    """
+    Writes mirrors right away. Counters go to the buffer of the caller.
+    """
+    def __init__(self, counters):
+        self.counters = counters
+
+    def _resolve(self, obj, db):
+        if db is None or db == (obj._state.db or 'default'):
+            return obj
+        use_database(db)
+        return get_identity_map().get(type(obj), db, pk=obj.pk)
+
+    def save(self, obj, db):
+        """
+        Copies obj in db.
+        """
+        use_database(db)
+        mirror = copy.deepcopy(obj)
+        mirror.save(using=db)
+        get_identity_map().add(mirror)
+
+    def ensure(self, obj, db):
+        """
+        Copies obj in db unless it is already there.
+        """
+        use_database(db)
+        try:
+            get_identity_map().get(type(obj), db, pk=obj.pk)
+        except type(obj).DoesNotExist:
+            self.save(obj, db)
+
+    def set_counters(self, obj, db=None):
+        self.counters.set_counters(self._resolve(obj, db))
+
+    def increment(self, obj, history_field, increment_value=1, db=None):
+        self.counters.increment(self._resolve(obj, db), history_field, increment_value)
+
+    def set_field(self, obj, field, value, db=None):
+        self.counters.set_field(self._resolve(obj, db), field, value)
+
+    def commit(self):
+        pass
+
+
+class MirrorLog(object):
+    """
+    Has the interface of DirectMirrors, but records the writes, which
+    commit() saves as one MirrorMutation per target database. The mirror
+    of obj in db is the object of the same model and pk in db; it is not
+    loaded, so recording makes no query on the target database.
+    """
+    def __init__(self):
+        self._operations = OrderedDict()
+        self._counters = {}
+
+    def _add(self, db, operation):
+        self._operations.setdefault(db, []).append(operation)
+
+    def save(self, obj, db):
+        self._counters.pop((db, _get_label(obj), obj.pk), None)
+        self._add(db, [SAVE, _get_label(obj), obj.pk, _dumps(obj)])
+
+    def ensure(self, obj, db):
+        self._counters.pop((db, _get_label(obj), obj.pk), None)
+        self._add(db, [ENSURE, _get_label(obj), obj.pk, _dumps(obj)])
+
+    def _get_counters(self, obj, db):
+        # Changes to counters of the same mirror are merged, unless the
+        # mirror was saved in between.
+        db = db or obj._state.db or 'default'
+        key = (db, _get_label(obj), obj.pk)
+        operation = self._counters.get(key)
+        if operation is None:
+            operation = self._counters[key] = [COUNTERS, key[1], obj.pk, False, {}, {}]
+            self._add(db, operation)
+        return operation
+
+    def set_counters(self, obj, db=None):
+        self._get_counters(obj, db)[3] = True
+
+    def increment(self, obj, history_field, increment_value=1, db=None):
+        deltas = self._get_counters(obj, db)[4]
+        deltas[history_field] = deltas.get(history_field, 0) + increment_value
+
+    def set_field(self, obj, field, value, db=None):
+        self._get_counters(obj, db)[5][field] = value
+
+    def commit(self):
+        for db, operations in self._operations.items():
+            MirrorMutation.objects.create(db=db, operations=json.dumps(operations, cls=DjangoJSONEncoder))
+        if self._operations:
+            if getattr(settings, 'UNIT_TESTING', False):
+                for db in self._operations.keys():
+                    apply_pending(db)
+            else:
+                get_replicator().start()
+        self._operations = OrderedDict()
+        self._counters = {}
+
+
+def get_mirrors(counters):
+    """
+    Returns what mirror writes are made through: a MirrorLog if
+    PLAYGROUND_ASYNC_MIRRORS is True, else DirectMirrors writing
+    counters in the counters buffer given.
+    """
+    if getattr(settings, 'PLAYGROUND_ASYNC_MIRRORS', False):
+        return MirrorLog()
+    return DirectMirrors(counters)
+
+
+def _get_owner():
+    return '%s:%d:%d' % (socket.gethostname(), os.getpid(), threading.current_thread().ident)
+
+
+def _acquire(db, duration):
+    owner = _get_owner()
+    expires_on = datetime.now() + timedelta(seconds=duration)
+    try:
+        MirrorLease.objects.create(db=db, owner=owner, expires_on=expires_on)
+        return True
+    except IntegrityError:
+        if MirrorLease.objects.filter(db=db, owner=owner).update(expires_on=expires_on):
+            return True
+        return MirrorLease.objects.filter(db=db, expires_on__lt=datetime.now())\
+            .update(owner=owner, expires_on=expires_on) == 1
+
+
+def _release(db):
+    MirrorLease.objects.filter(db=db, owner=_get_owner()).delete()
+
+
+class _WriteError(Exception):
+    pass
+
+
+def _apply(db, operations, counters, objects):
+    # Everything that may fail is loaded first, so that a mutation
+    # failing then can be tried again: nothing of it was written.
+    # Errors while writing, counters included, raise _WriteError.
+    copied = set()
+    resolved = []
+    for operation in operations:
+        kind, label, pk = operation[:3]
+        model = get_model(*label.split('.'))
+        if kind in (SAVE, ENSURE):
+            copied.add((label, pk))
+            resolved.append((kind, model, label, pk, _loads(label, pk, operation[3])))
+            continue
+        if (label, pk) not in copied and (label, pk) not in objects:
+            objects[(label, pk)] = model._default_manager.using(db).get(pk=pk)
+        resolved.append((kind, model, label, pk, operation[3:]))
+
+    try:
+        for kind, model, label, pk, data in resolved:
+            if kind in (SAVE, ENSURE):
+                # Counters recorded before must be written before the mirror is replaced
+                _flush(counters)
+                objects.pop((label, pk), None)
+                if kind == ENSURE and model._default_manager.using(db).filter(pk=pk).exists():
+                    continue
+                data.save(using=db)
+                continue
+            obj = objects.get((label, pk))
+            if obj is None:
+                obj = objects[(label, pk)] = model._default_manager.using(db).get(pk=pk)
+            reset, deltas, assignments = data
+            if reset:
+                counters.set_counters(obj)
+            for field, value in deltas.items():
+                counters.increment(obj, field, value)
+            for field, value in assignments.items():
+                counters.set_field(obj, field, obj._meta.get_field(field).to_python(value))
+        _flush(counters)
+    except _WriteError:
+        raise
+    except Exception as e:
+        raise _WriteError('%s: %s' % (type(e).__name__, e))
+
+
+def _flush(counters):
+    failures = counters.flush()
+    if failures:
+        raise _WriteError('Failed to write counters of ' +
+                          ', '.join('%s %s: %s' % (model.__name__, pk, error) for model, pk, db, error in failures))
+
+
+def apply_pending(db, batch_size=100, max_attempts=5):
+    """
+    Applies a batch of pending mutations of db in the order they were
+    recorded. Returns the number applied, or None if another replicator
+    holds db.
+    """
+    lease = getattr(settings, 'PLAYGROUND_REPLICATION_LEASE', 60)
+    if not _acquire(db, lease):
+        return None
+    renewed_on = time.time()
+    try:
+        use_database(db)
+        interrupted = MirrorMutation.objects.filter(db=db, status=MirrorMutation.APPLYING)
+        if interrupted.exists():
+            logger.error("Mutations of mirrors in %s were interrupted while applied and may be partly applied" % db)
+            interrupted.update(status=MirrorMutation.FAILED, error="Interrupted, may be partly applied")
+
+        mutations = list(MirrorMutation.objects.filter(db=db, status=MirrorMutation.PENDING)
+                         .order_by('created_on', 'id')[:batch_size])
+        counters = CounterBuffer(immediate=False)
+        objects = {}
+        applied = []
+        for mutation in mutations:
+            if time.time() - renewed_on > lease / 2.0:
+                if not _acquire(db, lease):
+                    logger.error("Lost the lease of mirrors in %s while applying mutations" % db)
+                    break
+                renewed_on = time.time()
+            MirrorMutation.objects.filter(pk=mutation.pk).update(status=MirrorMutation.APPLYING)
+            try:
+                _apply(db, json.loads(mutation.operations), counters, objects)
+            except Exception as e:
+                # Later mutations of db wait, so that the order is kept. A
+                # mutation that failed while written is not tried again.
+                status = MirrorMutation.PENDING
+                if isinstance(e, _WriteError) or mutation.attempts + 1 >= max_attempts:
+                    status = MirrorMutation.FAILED
+                MirrorMutation.objects.filter(pk=mutation.pk)\
+                    .update(status=status, attempts=mutation.attempts + 1, error='%s: %s' % (type(e).__name__, e))
+                logger.error("Failed to apply mutation %s of mirrors in %s" % (mutation.pk, db), exc_info=True)
+                break
+            applied.append(mutation.pk)
+        if applied:
+            MirrorMutation.objects.filter(pk__in=applied)\
+                .update(status=MirrorMutation.APPLIED, applied_on=datetime.now())
+        return len(applied)
+    finally:
+        _release(db)
+
+
+def get_pending_databases(limit=10000):
+    """
+    Returns the number of pending mutations and the lag in seconds, age
+    of the oldest pending mutation, of each database lagging behind.
+    """
+    now = datetime.now()
+    lag = {}
+    for db, created_on in MirrorMutation.objects.filter(status=MirrorMutation.PENDING)\
+            .order_by('created_on').values_list('db', 'created_on')[:limit]:
+        if db not in lag:
+            lag[db] = {'pending': 0, 'lag': (now - created_on).total_seconds()}
+        lag[db]['pending'] += 1
+    return lag
+
+
+class Replicator(object):
+    """
+    Applies pending mutations of every database every interval seconds,
+    from a background thread.
+    """
+    def __init__(self, interval=1.0, batch_size=100):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.applied = 0
+        self.rounds = 0
+        self._lock = threading.Lock()
+        self._started = False
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        thread = Thread(target=self._run, name='mirror-replicator')
+        thread.setDaemon(True)
+        thread.start()
+
+    def run_once(self):
+        for db in get_pending_databases().keys():
+            try:
+                self.applied += apply_pending(db, self.batch_size) or 0
+            except:
+                logger.error("Failed to replicate mirrors in %s" % db, exc_info=True)
+        self.rounds += 1
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.run_once()
+            except:
+                logger.error("Mirror replicator error", exc_info=True)
+            finally:
+                close_old_connections()
+                close_evicted_connections()
+
+    def stats(self):
+        return {
+            'applied': self.applied,
+            'rounds': self.rounds,
+            'failed': MirrorMutation.objects.filter(status=MirrorMutation.FAILED).count(),
+            'databases': get_pending_databases(),
+        }
+
+
+_replicator = None
+_replicator_lock = threading.Lock()
+
+
+def get_replicator():
+    global _replicator
+    with _replicator_lock:
+        if _replicator is None:
+            _replicator = Replicator(interval=getattr(settings, 'PLAYGROUND_REPLICATION_INTERVAL', 1.0),
+                                     batch_size=getattr(settings, 'PLAYGROUND_REPLICATION_BATCH_SIZE', 100))
+    return _replicator
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Payment rewards of buyers. The reward rules of a retailer, its
+PaymentRewardPacks, are compiled into RewardRules that tell without a
+query which packs a payment earns and how many coupons they make.
+RewardRules are cached PLAYGROUND_REWARD_RULES_CACHE_TIMEOUT seconds
+and dropped as soon as a pack is saved or deleted in this project;
+changes made by other projects are seen when the entry expires.
+
+Payments that earn nothing skip reward_member altogether. The others
+are granted right away unless PLAYGROUND_REWARD_INTERVAL is set, in
+which case they are queued as RewardGrant and a RewardIssuer grants
+them in batches every interval seconds, off the order path. The buyer
+is told the coupons the rules give in the meantime.
+"""
+import logging
+import threading
+import time
+import uuid
+from bisect import bisect_right
+from datetime import datetime
+from threading import Thread
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, close_old_connections
+from django.db.models.signals import post_save, post_delete
+
+from ikwen.accesscontrol.backends import UMBRELLA
+from ikwen.accesscontrol.models import Member
+from ikwen.core.models import Service
+from ikwen.rewarding.models import Reward, PaymentRewardPack
+from ikwen.rewarding.utils import reward_member
+
+from playground.db import close_evicted_connections
+from playground.models import RewardGrant
+
+logger = logging.getLogger('ikwen')
+
+
+def _get_key(service_id):
+    return 'playground:rewards:%s' % service_id
+
+
+class RewardRules(object):
+    """
+    Payment reward packs of a retailer, sorted by floor.
+    """
+    def __init__(self, packs):
+        self.packs = sorted(packs, key=lambda pack: pack.floor)
+        self._floors = [pack.floor for pack in self.packs]
+
+    def _get_candidates(self, amount):
+        return self.packs[:bisect_right(self._floors, amount)]
+
+    def may_reward(self, amount):
+        """
+        Whether a payment of amount may earn a pack. Bounds are taken
+        inclusively, so that a payment is never left unrewarded for
+        being on the ceiling of a pack.
+        """
+        return any(amount <= pack.ceiling for pack in self._get_candidates(amount))
+
+    def evaluate(self, amount):
+        """
+        Returns the packs a payment of amount earns, those of floor up to
+        amount and ceiling above it as reward_member selects them, and
+        the number of coupons they make.
+        """
+        packs = [pack for pack in self._get_candidates(amount) if amount < pack.ceiling]
+        return packs, sum(pack.count for pack in packs)
+
+
+def get_rules(service):
+    key = _get_key(service.id)
+    rules = cache.get(key)
+    if rules is None:
+        db = getattr(settings, 'PLAYGROUND_REWARD_RULES_DB', UMBRELLA)
+        rules = RewardRules(PaymentRewardPack.objects.using(db).select_related('coupon').filter(service=service))
+        cache.set(key, rules, getattr(settings, 'PLAYGROUND_REWARD_RULES_CACHE_TIMEOUT', 600))
+    return rules
+
+
+def invalidate_rules(sender, instance, **kwargs):
+    cache.delete(_get_key(instance.service_id))
+
+post_save.connect(invalidate_rules, sender=PaymentRewardPack)
+post_delete.connect(invalidate_rules, sender=PaymentRewardPack)
+
+
+def _reward(service, member, amount):
+    return reward_member(service, member, Reward.PAYMENT, amount=amount, model_name='trade.Order')
+
+
+def grant(order):
+    """
+    Rewards the buyer of order for their payment. Returns the packs
+    earned and the number of coupons they make.
+    """
+    service = order.retailer
+    rules = get_rules(service)
+    if not rules.may_reward(order.items_cost):
+        return [], 0
+    if not getattr(settings, 'PLAYGROUND_REWARD_INTERVAL', 0) or getattr(settings, 'UNIT_TESTING', False):
+        return _reward(service, order.member, order.items_cost)
+    packs, coupon_count = rules.evaluate(order.items_cost)
+    try:
+        RewardGrant.objects.create(key=order.id, order_id=order.id, service_id=service.id,
+                                   member_id=order.member.id if order.member else None,
+                                   amount=order.items_cost, coupon_count=coupon_count)
+    except IntegrityError:
+        logger.info("Rewards of Order %s were already queued" % order.id)
+    get_issuer().start()
+    return packs, coupon_count
+
+
+def _claim(limit):
+    grant_ids = list(RewardGrant.objects.filter(status=RewardGrant.PENDING).order_by('created_on')
+                     .values_list('id', flat=True)[:limit])
+    if not grant_ids:
+        return []
+    batch = uuid.uuid4().hex
+    RewardGrant.objects.filter(pk__in=grant_ids, status=RewardGrant.PENDING)\
+        .update(status=RewardGrant.ISSUING, batch=batch)
+    return list(RewardGrant.objects.filter(batch=batch))
+
+
+def issue(batch_size=500):
+    """
+    Grants at most batch_size queued rewards, loading their services and
+    members in one query each. Returns the number granted. A grant that
+    fails is marked Failed rather than tried again, as reward_member may
+    have partly run.
+    """
+    grants = _claim(batch_size)
+    if not grants:
+        return 0
+    services = Service.objects.in_bulk(list(set(grant.service_id for grant in grants)))
+    members = Member.objects.in_bulk(list(set(grant.member_id for grant in grants if grant.member_id)))
+    issued = []
+    for grant in grants:
+        try:
+            _reward(services[grant.service_id], members.get(grant.member_id), grant.amount)
+        except Exception as e:
+            logger.error("Failed to grant rewards of Order %s" % grant.order_id, exc_info=True)
+            RewardGrant.objects.filter(pk=grant.pk)\
+                .update(status=RewardGrant.FAILED, error='%s: %s' % (type(e).__name__, e))
+            continue
+        issued.append(grant.pk)
+    if issued:
+        RewardGrant.objects.filter(pk__in=issued).update(status=RewardGrant.ISSUED, issued_on=datetime.now())
+    return len(issued)
+
+
+class RewardIssuer(object):
+    """
+    Grants queued rewards every interval seconds from a background thread.
+    """
+    def __init__(self, interval=5, batch_size=500):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.issued = 0
+        self.rounds = 0
+        self._lock = threading.Lock()
+        self._started = False
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        thread = Thread(target=self._run, name='reward-issuer')
+        thread.setDaemon(True)
+        thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                while True:
+                    issued = issue(self.batch_size)
+                    self.issued += issued
+                    if issued < self.batch_size:
+                        break
+            except:
+                logger.error("Reward issuer error", exc_info=True)
+            finally:
+                self.rounds += 1
+                close_old_connections()
+                close_evicted_connections()
+
+    def stats(self):
+        return {
+            'issued': self.issued,
+            'rounds': self.rounds,
+            'pending': RewardGrant.objects.filter(status=RewardGrant.PENDING).count(),
+            'failed': RewardGrant.objects.filter(status=RewardGrant.FAILED).count(),
+        }
+
+
+_issuer = None
+_issuer_lock = threading.Lock()
+
+
+def get_issuer():
+    global _issuer
+    with _issuer_lock:
+        if _issuer is None:
+            _issuer = RewardIssuer(interval=getattr(settings, 'PLAYGROUND_REWARD_INTERVAL', 0) or 5,
+                                   batch_size=getattr(settings, 'PLAYGROUND_REWARD_BATCH_SIZE', 500))
+    return _issuer
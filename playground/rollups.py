@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+Order counters as an append-only log of facts folded in batches.
+
+With PLAYGROUND_ORDER_ROLLUPS = True, the order path records its counter
+changes in a FactRecorder, which appends one OrderFact per order instead
+of saving every watch object touched. fold() then claims a batch of
+facts, sums their deltas per watch object field, applies the sums to the
+*_history fields through a CounterBuffer (one save per object per batch)
+and adds them to the daily, weekly and monthly OrderRollup buckets,
+all on the day the fact was recorded. The order_rollups report reads
+the buckets with get_report(). Dashboards keep reading the history
+fields, which lag behind orders by the time between two folds; run the
+rollup_orders command often enough.
+
+A fold that fails leaves its facts claimed. They are claimed again
+PLAYGROUND_ROLLUP_RECLAIM_AFTER seconds later, skipping the watch
+objects when their facts were already counted.
+"""
+import json
+import logging
+import uuid
+from array import array
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError
+from django.db.models import F, get_model
+
+from playground.counters import CounterBuffer, get_counter_buffer
+from playground.db import use_database
+from playground.models import OrderFact, OrderRollup
+
+logger = logging.getLogger('ikwen')
+
+PERIODS = (OrderRollup.DAILY, OrderRollup.WEEKLY, OrderRollup.MONTHLY)
+
+
+def _get_target(obj):
+    return obj._state.db or 'default', '%s.%s' % (obj._meta.app_label, obj._meta.object_name), obj.pk
+
+
+def _get_bucket_start(period, day):
+    if period == OrderRollup.WEEKLY:
+        return day - timedelta(days=day.weekday())
+    if period == OrderRollup.MONTHLY:
+        return day.replace(day=1)
+    return day
+
+
+class FactRecorder(object):
+    """
+    Has the interface of CounterBuffer, but commit() appends the changes
+    recorded as one OrderFact instead of saving the objects.
+    """
+    def __init__(self, order_id):
+        self.order_id = order_id
+        self._deltas = OrderedDict()
+        self._assignments = OrderedDict()
+
+    def set_counters(self, obj):
+        # fold() resets counters of every object it increments
+        pass
+
+    def increment(self, obj, history_field, increment_value=1):
+        key = _get_target(obj) + (history_field, )
+        self._deltas[key] = self._deltas.get(key, 0) + increment_value
+
+    def set_field(self, obj, field, value):
+        setattr(obj, field, value)
+        self._assignments[_get_target(obj) + (field, )] = value
+
+    def commit(self):
+        deltas = [list(key) + [value] for key, value in self._deltas.items()]
+        assignments = [list(key) + [value] for key, value in self._assignments.items()]
+        OrderFact.objects.create(order_id=self.order_id, deltas=json.dumps(deltas, cls=DjangoJSONEncoder),
+                                 assignments=json.dumps(assignments, cls=DjangoJSONEncoder))
+
+
+def get_order_counters(order):
+    """
+    Returns what the processing of order records its counters in: a
+    FactRecorder when PLAYGROUND_ORDER_ROLLUPS is True, else a buffer
+    from get_counter_buffer().
+    """
+    if getattr(settings, 'PLAYGROUND_ORDER_ROLLUPS', False) and not getattr(settings, 'UNIT_TESTING', False):
+        return FactRecorder(order.id)
+    return get_counter_buffer()
+
+
+def _claim_batch(batch_size):
+    # Facts not claimed yet, then facts of batches whose fold failed
+    candidates = list(OrderFact.objects.filter(batch__isnull=True).order_by('created_on')
+                      .values_list('id', 'batch')[:batch_size])
+    if len(candidates) < batch_size:
+        stale = datetime.now() - timedelta(seconds=getattr(settings, 'PLAYGROUND_ROLLUP_RECLAIM_AFTER', 600))
+        candidates += list(OrderFact.objects.filter(folded_on__isnull=True, claimed_on__lt=stale)
+                           .order_by('created_on').values_list('id', 'batch')[:batch_size - len(candidates)])
+    if not candidates:
+        return []
+    fact_ids = OrderedDict()
+    for fact_id, previous in candidates:
+        fact_ids.setdefault(previous, []).append(fact_id)
+    batch = uuid.uuid4().hex
+    for previous, ids in fact_ids.items():
+        OrderFact.objects.filter(pk__in=ids, batch=previous, folded_on__isnull=True)\
+            .update(batch=batch, claimed_on=datetime.now())
+    return list(OrderFact.objects.filter(batch=batch))
+
+
+def _load_objects(targets):
+    """
+    Loads watch objects with one query per model per database.
+    """
+    pks_by_model = OrderedDict()
+    for db, label, pk in targets:
+        pks_by_model.setdefault((db, label), []).append(pk)
+    objects = {}
+    for (db, label), pks in pks_by_model.items():
+        model = get_model(*label.split('.'))
+        use_database(db)
+        for obj in model._default_manager.using(db).filter(pk__in=pks):
+            objects[(db, label, obj.pk)] = obj
+    return objects
+
+
+def _add_to_bucket(period, start, target, field, value):
+    db, label, pk = target
+    key = '%s:%s:%s:%s:%s:%s' % (period, start.isoformat(), db, label, pk, field)
+    if OrderRollup.objects.filter(key=key).update(value=F('value') + value):
+        return
+    try:
+        OrderRollup.objects.create(key=key, period=period, start=start, db=db, model=label,
+                                   object_id=pk, field=field, value=value)
+    except IntegrityError:
+        OrderRollup.objects.filter(key=key).update(value=F('value') + value)
+
+
+def _as_number(value):
+    return int(value) if value == int(value) else value
+
+
+def fold(batch_size=500):
+    """
+    Folds a batch of at most batch_size facts not folded yet. Returns the
+    number of facts claimed, 0 when there is nothing left to fold. Facts
+    are claimed before being applied, so concurrent folds never apply
+    the same fact twice. A fold that fails is logged and its facts are
+    claimed again later. Facts are marked counted once applied to the
+    watch objects, so that they are not counted twice then; only the
+    writes of the failed step itself may be repeated.
+    """
+    facts = _claim_batch(batch_size)
+    if not facts:
+        return 0
+
+    # Columns are the distinct (watch object, field) pairs of the batch.
+    # Sums are accumulated in one array per bucket and one per day of
+    # the history fields, indexed by column. Facts already counted only
+    # go to the buckets.
+    today = date.today()
+    columns = OrderedDict()
+    parsed = []
+    for fact in facts:
+        deltas = json.loads(fact.deltas)
+        for db, label, pk, field, value in deltas:
+            columns.setdefault((db, label, pk, field), len(columns))
+        parsed.append((fact, deltas, json.loads(fact.assignments)))
+    width = len(columns)
+    days = {}
+    buckets = {}
+    assignments = {}
+    for fact, deltas, fact_assignments in parsed:
+        day = fact.created_on.date()
+        rows = []
+        for period in PERIODS:
+            start = _get_bucket_start(period, day)
+            row = buckets.get((period, start))
+            if row is None:
+                row = buckets[(period, start)] = array('d', [0]) * width
+            rows.append(row)
+        if not fact.counted_on:
+            days_ago = max((today - day).days, 0)
+            row = days.get(days_ago)
+            if row is None:
+                row = days[days_ago] = array('d', [0]) * width
+            rows.append(row)
+            for db, label, pk, field, value in fact_assignments:
+                key = (db, label, pk, field)
+                if key not in assignments or assignments[key][0] <= fact.created_on:
+                    assignments[key] = (fact.created_on, value)
+        for db, label, pk, field, value in deltas:
+            index = columns[(db, label, pk, field)]
+            for row in rows:
+                row[index] += value
+
+    fact_ids = [fact.pk for fact in facts]
+    uncounted = [fact.pk for fact in facts if not fact.counted_on]
+    try:
+        if uncounted:
+            targets = set(key[:3] for key, index in columns.items() if any(row[index] for row in days.values())) | \
+                set(key[:3] for key in assignments.keys())
+            objects = _load_objects(targets)
+            counters = CounterBuffer(immediate=False)
+            for (db, label, pk, field), index in columns.items():
+                obj = objects.get((db, label, pk))
+                if obj is None:
+                    continue
+                for days_ago, row in days.items():
+                    if row[index]:
+                        counters.set_counters(obj)
+                        counters.increment(obj, field, _as_number(row[index]), days_ago)
+            for (db, label, pk, field), (created_on, value) in assignments.items():
+                obj = objects.get((db, label, pk))
+                if obj is None:
+                    continue
+                counters.set_field(obj, field, obj._meta.get_field(field).to_python(value))
+            if counters.flush():
+                logger.error("Failed to count OrderFact batch %s, it will be claimed again" % facts[0].batch)
+                return len(facts)
+            OrderFact.objects.filter(pk__in=uncounted, batch=facts[0].batch).update(counted_on=datetime.now())
+
+        for (period, start), row in buckets.items():
+            for (db, label, pk, field), index in columns.items():
+                if row[index]:
+                    _add_to_bucket(period, start, (db, label, pk), field, _as_number(row[index]))
+        OrderFact.objects.filter(pk__in=fact_ids, batch=facts[0].batch).update(folded_on=datetime.now())
+    except:
+        logger.error("Failed to fold OrderFact batch %s, it will be claimed again" % facts[0].batch, exc_info=True)
+    return len(facts)
+
+
+def get_rollups(obj, field, period=OrderRollup.DAILY, start=None, end=None):
+    """
+    Returns the buckets of field of obj over period, as a list of
+    (start, value) ordered by start.
+    """
+    db, label, pk = _get_target(obj)
+    queryset = OrderRollup.objects.filter(period=period, db=db, model=label, object_id=pk, field=field)
+    if start:
+        queryset = queryset.filter(start__gte=start)
+    if end:
+        queryset = queryset.filter(start__lte=end)
+    return [(rollup.start, rollup.value) for rollup in queryset.order_by('start')]
+
+
+def get_report(obj, fields, period=OrderRollup.DAILY, count=30):
+    """
+    Returns the last count buckets of each of fields of obj over period,
+    up to the current one, as a dict of lists of (start, value) ordered
+    by start. Buckets without orders are 0.
+    """
+    starts = [_get_bucket_start(period, date.today())]
+    while len(starts) < count:
+        starts.insert(0, _get_bucket_start(period, starts[0] - timedelta(days=1)))
+    report = {}
+    for field in fields:
+        values = dict(get_rollups(obj, field, period, start=starts[0]))
+        report[field] = [(start, values.get(start, 0)) for start in starts]
+    return report
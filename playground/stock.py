@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+Stock reservations. With PLAYGROUND_STOCK_RESERVATION = True, units are
+taken from the stock of products when the order is created, with
+conditional atomic updates so that concurrent checkouts never take more
+than what is available. The reservation is committed when the payment
+is confirmed, or released, giving units back, when it expires after
+PLAYGROUND_STOCK_RESERVATION_TIMEOUT seconds.
+
+A product runs out with the update bringing its stock from a positive
+value to 0 or less. Only one update can do that, and the reservation it
+made is flagged sold_out. The product is sold out when those units are
+paid for: commit() returns it if its stock is still out then, and
+callers fire sold out handling for it. A release bringing the stock of
+a product back above 0 runs mark_duplicates again, so that the product
+is offered again.
+"""
+import logging
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.db.models import F
+
+from ikwen.core.utils import add_event
+
+from ikwen_kakocase.kako.models import Product
+from ikwen_kakocase.kako.utils import mark_duplicates
+from ikwen_kakocase.kakocase.models import SOLD_OUT_EVENT
+
+from playground.models import StockReservation
+
+logger = logging.getLogger('ikwen')
+
+
+class InsufficientStock(Exception):
+    def __init__(self, product_id):
+        super(InsufficientStock, self).__init__("Insufficient stock for Product %s" % product_id)
+        self.product_id = product_id
+
+
+def take(product_id, count, force=False):
+    """
+    Takes count units from the stock of the product. Returns a tuple
+    (taken, sold_out). Unless force is True, units are only taken if
+    available. force is for units already paid for, which are taken
+    whatever the stock, possibly making it negative.
+    """
+    while True:
+        if Product.objects.filter(pk=product_id, stock__gt=count).update(stock=F('stock') - count):
+            return True, False
+        if Product.objects.filter(pk=product_id, stock=count).update(stock=0):
+            return True, True
+        if force:
+            if Product.objects.filter(pk=product_id, stock__gt=0, stock__lt=count).update(stock=F('stock') - count):
+                return True, True
+            if Product.objects.filter(pk=product_id, stock__lte=0).update(stock=F('stock') - count):
+                return True, False
+        # Stock changed between the updates unless it is short now
+        elif not Product.objects.filter(pk=product_id, stock__gte=count).exists():
+            return False, False
+        if not Product.objects.filter(pk=product_id).exists():
+            return False, False
+
+
+def give_back(product_id, count):
+    """
+    Gives count units back to the stock of the product. Returns True if
+    this brought the stock from 0 or less above 0.
+    """
+    while True:
+        if Product.objects.filter(pk=product_id, stock__gt=0).update(stock=F('stock') + count):
+            return False
+        if Product.objects.filter(pk=product_id, stock__lte=0, stock__gt=-count).update(stock=F('stock') + count):
+            return True
+        if Product.objects.filter(pk=product_id, stock__lte=-count).update(stock=F('stock') + count):
+            return False
+        if not Product.objects.filter(pk=product_id).exists():
+            return False
+
+
+def _get_key(order_id, product_id):
+    return '%s:%s' % (order_id, product_id)
+
+
+def get_units(order):
+    """
+    Units of each product of the order, keyed by Product id.
+    """
+    units = {}
+    for entry in order.entries:
+        units[entry.product.id] = units.get(entry.product.id, 0) + entry.count
+    return units
+
+
+def reserve(order_id, units, timeout=None):
+    """
+    Reserves units for the order, a dict of counts keyed by Product id.
+    Either all units are reserved or none, in which case
+    InsufficientStock is raised. Expired reservations of a product short
+    on stock are released before giving up. Reserving again for the
+    same order has no effect.
+    """
+    if timeout is None:
+        timeout = getattr(settings, 'PLAYGROUND_STOCK_RESERVATION_TIMEOUT', 900)
+    expires_on = datetime.now() + timedelta(seconds=timeout)
+    reserved = set(StockReservation.objects.filter(order_id=order_id).values_list('product_id', flat=True))
+    taken = []
+    try:
+        for product_id, count in sorted(units.items()):
+            if product_id in reserved or count <= 0:
+                continue
+            success, is_sold_out = take(product_id, count)
+            if not success and release_expired(product_id):
+                success, is_sold_out = take(product_id, count)
+            if not success:
+                raise InsufficientStock(product_id)
+            taken.append((product_id, count))
+            StockReservation.objects.create(key=_get_key(order_id, product_id), order_id=order_id,
+                                            product_id=product_id, count=count, expires_on=expires_on,
+                                            sold_out=is_sold_out)
+    except:
+        restocked = []
+        for product_id, count in taken:
+            StockReservation.objects.filter(key=_get_key(order_id, product_id)).delete()
+            if give_back(product_id, count):
+                restocked.append(product_id)
+        _restock(restocked)
+        raise
+
+
+def commit(order_id, units):
+    """
+    Commits reservations of the order upon payment. Units not reserved,
+    or whose reservation was released meanwhile, are taken now since
+    they were paid for. Returns the ids of products sold out by the
+    units paid for, whose stock is still out. Committing again, as when
+    the settlement of the order is retried, takes nothing more and
+    returns no product.
+    """
+    committed = {}
+    sold_out = []
+    for reservation in StockReservation.objects.filter(order_id=order_id, status__in=[StockReservation.RESERVED,
+                                                                                     StockReservation.COMMITTED]):
+        if reservation.status == StockReservation.COMMITTED:
+            committed[reservation.product_id] = reservation.count
+        elif StockReservation.objects.filter(pk=reservation.pk, status=StockReservation.RESERVED)\
+                .update(status=StockReservation.COMMITTED, updated_on=datetime.now()):
+            committed[reservation.product_id] = reservation.count
+            if reservation.sold_out:
+                sold_out.append(reservation.product_id)
+    for product_id, count in units.items():
+        count -= committed.get(product_id, 0)
+        if count <= 0:
+            continue
+        taken, is_sold_out = take(product_id, count, force=True)
+        if is_sold_out:
+            sold_out.append(product_id)
+        if taken:
+            try:
+                StockReservation.objects.create(key=_get_key(order_id, product_id), order_id=order_id,
+                                                product_id=product_id, count=count, expires_on=datetime.now(),
+                                                status=StockReservation.COMMITTED)
+            except IntegrityError:
+                StockReservation.objects.filter(key=_get_key(order_id, product_id))\
+                    .update(status=StockReservation.COMMITTED, count=count, updated_on=datetime.now())
+    if not sold_out:
+        return []
+    # Units released since the product ran out may have been given back
+    return list(Product.objects.filter(pk__in=sold_out, stock__lte=0).values_list('id', flat=True))
+
+
+def _restock(product_ids):
+    for product in Product.objects.filter(pk__in=product_ids):
+        mark_duplicates(product)
+
+
+def _release(queryset):
+    released = 0
+    restocked = set()
+    for reservation in queryset.filter(status=StockReservation.RESERVED):
+        # Only one of the release and commit updates can match
+        if StockReservation.objects.filter(pk=reservation.pk, status=StockReservation.RESERVED)\
+                .update(status=StockReservation.RELEASED, updated_on=datetime.now()):
+            if give_back(reservation.product_id, reservation.count):
+                restocked.add(reservation.product_id)
+            released += 1
+    if restocked:
+        _restock(list(restocked))
+    return released
+
+
+def release(order_id):
+    """
+    Releases reservations of the order, for instance when it is cancelled.
+    """
+    return _release(StockReservation.objects.filter(order_id=order_id))
+
+
+def release_expired(product_id=None):
+    """
+    Releases expired reservations, of the product only if given. Returns
+    the number of reservations released.
+    """
+    queryset = StockReservation.objects.filter(expires_on__lt=datetime.now())
+    if product_id:
+        queryset = queryset.filter(product_id=product_id)
+    return _release(queryset)
+
+
+def fire_sold_out(service, product_ids, sudo_group):
+    for product in Product.objects.filter(pk__in=product_ids):
+        add_event(service, SOLD_OUT_EVENT, group_id=sudo_group.id, object_id=product.id)
+        mark_duplicates(product)
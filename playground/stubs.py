@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+import asyncore
+import smtpd
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from threading import Thread
+from urlparse import parse_qs
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, so that connection reuse can be observed
+
+    def _respond(self):
+        stub = self.server.stub
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else ''
+        status = stub.record(self.command, self.path, body, self.client_address)
+        if stub.delay:
+            time.sleep(stub.delay)
+        content = stub.content
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = _respond
+    do_POST = _respond
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubHTTPServer(object):
+    """
+    Local HTTP endpoint standing in for partner return_url, payment
+    gateway and SMS APIs. Records every request it receives and can be
+    told to answer errors or to be slow:
+
+        stub = StubHTTPServer(fail_first=2).start()
+        get_dispatcher().post(stub.url + '/callback', {'order_id': '1'})
+        stub.requests  # [(method, path, data, client_address), ...]
+        stub.stop()
+    """
+    def __init__(self, host='127.0.0.1', port=0, status=200, fail_first=0, delay=0, content='OK'):
+        self.status = status
+        self.fail_first = fail_first
+        self.delay = delay
+        self.content = content
+        self.requests = []
+        self._lock = threading.Lock()
+        self._server = _ThreadingHTTPServer((host, port), _StubHandler)
+        self._server.stub = self
+        self.url = 'http://%s:%d' % self._server.server_address
+
+    def record(self, method, path, body, client_address):
+        with self._lock:
+            self.requests.append((method, path, parse_qs(body), client_address))
+            if len(self.requests) <= self.fail_first:
+                return 503
+        return self.status
+
+    @property
+    def connection_count(self):
+        return len(set(client_address for method, path, data, client_address in self.requests))
+
+    def start(self):
+        thread = Thread(target=self._server.serve_forever, name='stub-http')
+        thread.setDaemon(True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def _move_channel(dispatcher, socket_map):
+    fileno = dispatcher._fileno
+    dispatcher.del_channel()
+    dispatcher._fileno = fileno
+    dispatcher._map = socket_map
+    dispatcher.add_channel()
+
+
+class _SMTPSink(smtpd.SMTPServer):
+    # Channels of this server are kept in their own socket map, apart
+    # from other asyncore users.
+
+    def __init__(self, stub, localaddr, socket_map):
+        smtpd.SMTPServer.__init__(self, localaddr, None)
+        self.stub = stub
+        self.socket_map = socket_map
+        _move_channel(self, socket_map)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+        conn, addr = pair
+        self.stub.connection_count += 1
+        _move_channel(smtpd.SMTPChannel(self, conn, addr), self.socket_map)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.stub.record(peer, mailfrom, rcpttos, data)
+
+
+class StubSMTPServer(object):
+    """
+    Local SMTP server that accepts and records every message instead of
+    delivering it:
+
+        stub = StubSMTPServer().start()
+        with override_settings(EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+                               EMAIL_HOST=stub.host, EMAIL_PORT=stub.port):
+            ...
+        stub.messages  # [(mailfrom, rcpttos, data), ...]
+        stub.stop()
+    """
+    def __init__(self, host='127.0.0.1', port=0):
+        self.messages = []
+        self.connection_count = 0
+        self._lock = threading.Lock()
+        self._map = {}
+        self._server = _SMTPSink(self, (host, port), self._map)
+        self.host, self.port = self._server.socket.getsockname()[:2]
+        self._stopped = threading.Event()
+
+    def record(self, peer, mailfrom, rcpttos, data):
+        with self._lock:
+            self.messages.append((mailfrom, rcpttos, data))
+
+    @property
+    def recipient_count(self):
+        return sum(len(rcpttos) for mailfrom, rcpttos, data in self.messages)
+
+    def _serve(self):
+        while not self._stopped.is_set():
+            asyncore.loop(timeout=0.05, map=self._map, count=1)
+
+    def start(self):
+        self._thread = Thread(target=self._serve, name='stub-smtp')
+        self._thread.setDaemon(True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        asyncore.close_all(self._map)
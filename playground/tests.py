@@ -1,3 +1,391 @@
-from django.test import TestCase
+import os
+import shutil
+import tempfile
+import threading
+from datetime import date, datetime, timedelta
 
-# Create your tests here.
+import requests
+from django.core.mail import EmailMessage
+from django.core.urlresolvers import Resolver404
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import override_settings
+
+from ikwen.core.models import Service
+
+from ikwen_kakocase.kako.models import Product
+from ikwen_kakocase.kakocase.models import ProductCategory
+
+from conf.routing import Dispatcher, _get_key, _get_literal_prefix
+
+from playground import jobs, stock, webhooks
+from playground.counters import CounterBuffer
+from playground.rollups import _add_to_bucket, _get_target, get_report
+from playground.mail import Mailer
+from playground.models import OrderRollup, StockReservation
+from playground.stubs import StubHTTPServer, StubSMTPServer
+from playground.webhooks import WebhookDispatcher
+
+
+def _run_concurrently(func, args_list):
+    """
+    Calls func with each args of args_list, each in its own thread, all
+    at once. Returns results in the order of args_list, exceptions
+    raised being returned as results.
+    """
+    results = [None] * len(args_list)
+    barrier = threading.Event()
+
+    def run(i, args):
+        barrier.wait()
+        try:
+            results[i] = func(*args)
+        except Exception as e:
+            results[i] = e
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=run, args=(i, args)) for i, args in enumerate(args_list)]
+    for thread in threads:
+        thread.start()
+    barrier.set()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class StockTestCase(TestCase):
+    def setUp(self):
+        provider = Service.objects.create(project_name='Provider', project_name_slug='provider')
+        category = ProductCategory.objects.create(name='Stock', slug='stock')
+        self.product = Product.objects.create(name='Flash sale', category=category, provider=provider,
+                                              retail_price=1000, stock=10)
+        self.units = {self.product.id: 1}
+
+    def get_stock(self):
+        return Product.objects.get(pk=self.product.id).stock
+
+    def test_reserve_concurrently_never_oversells(self):
+        results = _run_concurrently(stock.reserve, [('order-%d' % i, self.units) for i in range(20)])
+        rejected = [result for result in results if isinstance(result, stock.InsufficientStock)]
+        self.assertEqual(len(rejected), 10)
+        self.assertEqual(self.get_stock(), 0)
+        self.assertEqual(StockReservation.objects.filter(status=StockReservation.RESERVED).count(), 10)
+        self.assertEqual(StockReservation.objects.filter(sold_out=True).count(), 1)
+
+    def test_commit_and_release_concurrently(self):
+        for i in range(10):
+            stock.reserve('order-%d' % i, self.units)
+
+        def settle(i):
+            if i % 2:
+                return stock.release('order-%d' % i)
+            return stock.commit('order-%d' % i, self.units)
+
+        results = _run_concurrently(settle, [(i, ) for i in range(10)])
+        self.assertEqual(self.get_stock(), 5)
+        self.assertEqual([result for result in results if isinstance(result, Exception)], [])
+        # The reservation that ran the product out was released
+        self.assertEqual([result for result in results if result == [self.product.id]], [])
+        self.assertEqual(StockReservation.objects.filter(status=StockReservation.COMMITTED).count(), 5)
+        self.assertEqual(StockReservation.objects.filter(status=StockReservation.RELEASED).count(), 5)
+
+    def test_sold_out_fires_once_on_commit(self):
+        sold_out = []
+        for i in range(10):
+            stock.reserve('order-%d' % i, self.units)
+        results = _run_concurrently(stock.commit, [('order-%d' % i, self.units) for i in range(10)])
+        for result in results:
+            sold_out.extend(result)
+        self.assertEqual(sold_out, [self.product.id])
+        self.assertEqual(self.get_stock(), 0)
+
+    def test_expired_reservations_released_while_committed(self):
+        for i in range(10):
+            stock.reserve('order-%d' % i, self.units, timeout=-1)
+        args_list = [('order-%d' % i, self.units) for i in range(10)] + [(None, None)] * 5
+
+        def commit_or_release(order_id, units):
+            if order_id is None:
+                return stock.release_expired(self.product.id)
+            return stock.commit(order_id, units)
+
+        _run_concurrently(commit_or_release, args_list)
+        # Whether released first or not, each paid unit is taken once
+        self.assertEqual(self.get_stock(), 0)
+        self.assertEqual(StockReservation.objects.filter(status=StockReservation.COMMITTED).count(), 10)
+
+    def test_release_restocks_sold_out_product(self):
+        stock.reserve('order-1', {self.product.id: 4})
+        stock.reserve('order-2', {self.product.id: 6})
+        self.assertEqual(stock.commit('order-2', {self.product.id: 6}), [self.product.id])
+        self.assertEqual(self.get_stock(), 0)
+        self.assertEqual(stock.release('order-1'), 1)
+        self.assertEqual(self.get_stock(), 4)
+        self.assertFalse(stock.give_back(self.product.id, 1))
+
+    def test_commit_twice_takes_units_once(self):
+        stock.reserve('order-1', {self.product.id: 3})
+        stock.commit('order-1', {self.product.id: 3})
+        self.assertEqual(stock.commit('order-1', {self.product.id: 3}), [])
+        self.assertEqual(self.get_stock(), 7)
+        # Units paid for without a reservation
+        stock.commit('order-2', {self.product.id: 2})
+        stock.commit('order-2', {self.product.id: 2})
+        self.assertEqual(self.get_stock(), 5)
+        self.assertEqual(StockReservation.objects.filter(status=StockReservation.COMMITTED).count(), 2)
+
+    def test_commit_again_does_not_fire_sold_out(self):
+        stock.reserve('order-1', {self.product.id: 10})
+        self.assertEqual(stock.commit('order-1', {self.product.id: 10}), [self.product.id])
+        self.assertEqual(stock.commit('order-1', {self.product.id: 10}), [])
+        self.assertEqual(self.get_stock(), 0)
+
+
+class _Field(object):
+    def __init__(self, name, primary_key=False):
+        self.name = self.attname = name
+        self.primary_key = primary_key
+
+
+class _Watched(object):
+    """
+    Stands for a watch object, recording the fields each save writes.
+    """
+    class _meta:
+        fields = [_Field('id', primary_key=True), _Field('last_payment_on'),
+                  _Field('orders_count_history'), _Field('total_orders_count')]
+
+    class _state:
+        db = 'default'
+
+    def __init__(self):
+        self.pk = self.id = '1'
+        self.last_payment_on = None
+        self.orders_count_history = [0]
+        self.total_orders_count = 0
+        self.saves = []
+
+    def save(self, using=None, update_fields=None):
+        self.saves.append((using, update_fields))
+
+
+class CounterBufferTestCase(SimpleTestCase):
+    def test_assigned_fields_saved(self):
+        obj, counters = _Watched(), CounterBuffer(immediate=False)
+        counters.set_field(obj, 'last_payment_on', datetime(2026, 10, 18))
+        counters.increment(obj, 'orders_count_history')
+        counters.increment(obj, 'orders_count_history')
+        self.assertEqual(counters.flush(), [])
+        self.assertEqual(len(obj.saves), 1)
+        using, update_fields = obj.saves[0]
+        self.assertEqual(using, 'default')
+        self.assertIn('last_payment_on', update_fields)
+        self.assertIn('orders_count_history', update_fields)
+        self.assertEqual(obj.orders_count_history, [2])
+
+    def test_assigned_field_alone_saved(self):
+        obj, counters = _Watched(), CounterBuffer(immediate=False)
+        counters.set_field(obj, 'last_payment_on', datetime(2026, 10, 18))
+        counters.flush()
+        self.assertEqual(obj.saves, [('default', ['last_payment_on'])])
+
+
+class RollupsTestCase(TestCase):
+    def test_report_reads_buckets(self):
+        service = Service.objects.create(project_name='Provider', project_name_slug='provider')
+        today = date.today()
+        _add_to_bucket(OrderRollup.DAILY, today, _get_target(service), 'orders_count_history', 2)
+        _add_to_bucket(OrderRollup.DAILY, today, _get_target(service), 'orders_count_history', 1)
+        _add_to_bucket(OrderRollup.DAILY, today - timedelta(days=2), _get_target(service), 'orders_count_history', 4)
+        # Out of the report
+        _add_to_bucket(OrderRollup.DAILY, today - timedelta(days=3), _get_target(service), 'orders_count_history', 8)
+        report = get_report(service, ['orders_count_history', 'turnover_history'], OrderRollup.DAILY, 3)
+        self.assertEqual(report['orders_count_history'], [(today - timedelta(days=2), 4),
+                                                          (today - timedelta(days=1), 0), (today, 3)])
+        self.assertEqual([value for start, value in report['turnover_history']], [0, 0, 0])
+
+
+class RoutingTestCase(SimpleTestCase):
+    def test_get_literal_prefix(self):
+        self.assertEqual(_get_literal_prefix(r'^$'), ('', True))
+        self.assertEqual(_get_literal_prefix(r'^welcome/$'), ('welcome/', True))
+        # Include prefixes
+        self.assertEqual(_get_literal_prefix(r'^shopping/'), ('shopping/', False))
+        self.assertEqual(_get_literal_prefix(r'^page/(?P<url>[-\w]+)/$'), ('page/', False))
+        # Quantifiers make the character before optional or repeated
+        self.assertEqual(_get_literal_prefix(r'^a+b/'), ('', False))
+        self.assertEqual(_get_literal_prefix(r'^ab?/'), ('a', False))
+        self.assertEqual(_get_literal_prefix(r'^ab*/'), ('a', False))
+        self.assertEqual(_get_literal_prefix(r'^ab{2}/'), ('a', False))
+        # Escapes
+        self.assertEqual(_get_literal_prefix(r'^offline\.html$'), ('offline.html', True))
+        self.assertEqual(_get_literal_prefix(r'^offline.html$'), ('offline', False))
+        self.assertEqual(_get_literal_prefix(r'^\$x/'), ('$x/', False))
+        self.assertEqual(_get_literal_prefix(r'^a\d/'), ('a', False))
+        # Alternation and unanchored patterns cannot be reasoned about
+        self.assertIsNone(_get_literal_prefix(r'^a/|^b/'))
+        self.assertIsNone(_get_literal_prefix(r'^(a|b)/'))
+        self.assertIsNone(_get_literal_prefix(r'shopping/'))
+
+    def test_get_key(self):
+        self.assertEqual(_get_key(r'^$'), '')
+        self.assertEqual(_get_key(r'^shopping/'), 'shopping')
+        self.assertEqual(_get_key(r'^shopping/cart/$'), 'shopping')
+        self.assertEqual(_get_key(r'^playground/confirm_checkout'), 'playground')
+        self.assertEqual(_get_key(r'^welcome/$'), 'welcome')
+        self.assertEqual(_get_key(r'^offline\.html$'), 'offline.html')
+        self.assertEqual(_get_key(r'^a\.b/'), 'a.b')
+        # The first segment of matching paths is not definite
+        self.assertIsNone(_get_key(r'^offline.html$'))
+        self.assertIsNone(_get_key(r'^abc'))
+        self.assertIsNone(_get_key(r'^ab?/'))
+        self.assertIsNone(_get_key(r'^a/|^b/'))
+
+    def test_compiled_dispatch_resolves_like_urlconf(self):
+        from conf.urls import urlpatterns
+        if len(urlpatterns) == 1 and isinstance(urlpatterns[0], Dispatcher):
+            urlpatterns = urlpatterns[0].url_patterns
+        regular, compiled = Dispatcher(urlpatterns), Dispatcher(urlpatterns, compiled=True, cache_size=8)
+
+        def describe(resolver, path):
+            try:
+                match = resolver.resolve(path)
+            except Resolver404:
+                return None
+            return match.func, match.args, match.kwargs, match.url_name, match.app_name, match.namespaces
+
+        paths = ['', 'shopping/cart/', 'shopping/cart/order-1/', 'shopping/nowhere/', 'playground/confirm_checkout',
+                 'playground/confirm_checkoutx', 'playground/stats', 'playground/statsx', 'playground/rollups',
+                 'page/about/', 'welcome/', 'welcome', 'offline.html', 'offlineXhtml', 'ikwen/home/',
+                 'ikwen/dashboard/', 'i18n/setlang/', 'laakam/', 'nowhere/', 'nowhere', 'home/']
+        resolved = 0
+        for i in range(2):
+            # The second time, compiled matches come from the cache
+            for path in paths:
+                expected = describe(regular, path)
+                self.assertEqual(describe(compiled, path), expected, "/%s" % path)
+                resolved += expected is not None
+        self.assertTrue(resolved)
+        self.assertIsNone(describe(compiled, 'nowhere/'))
+
+
+@override_settings(UNIT_TESTING=True)
+class WebhooksTestCase(SimpleTestCase):
+    def setUp(self):
+        self.dispatcher = webhooks._dispatcher
+        webhooks._dispatcher = WebhookDispatcher(retries=3, backoff_factor=0)
+
+    def tearDown(self):
+        webhooks._dispatcher = self.dispatcher
+
+    def deliver(self, stub, data_list):
+        try:
+            webhooks.deliver(stub.url + '/callback', data_list)
+        finally:
+            stub.stop()
+
+    def test_deliver_retries_connection_errors_only(self):
+        retry = webhooks.get_dispatcher().get_session('http://partner.local/callback')\
+            .get_adapter('http://partner.local/callback').max_retries
+        self.assertEqual(retry.connect, 3)
+        self.assertEqual(retry.read, 0)
+        self.assertFalse(retry.status_forcelist)
+
+    def test_deliver_does_not_repeat_server_errors(self):
+        stub = StubHTTPServer(fail_first=1).start()
+        self.assertRaises(requests.RequestException, self.deliver, stub, [{'order_id': '1'}])
+        # Left to the retry of the job, the partner may have processed it
+        self.assertEqual(len(stub.requests), 1)
+        self.assertEqual(webhooks.get_dispatcher().stats()['failed'], 1)
+
+    def test_deliver_fails_when_all_callbacks_fail(self):
+        stub = StubHTTPServer(fail_first=100).start()
+        self.assertRaises(requests.RequestException, self.deliver, stub, [{'order_id': '1'}, {'order_id': '2'}])
+        self.assertEqual(len(stub.requests), 2)
+
+    def test_deliver_queues_failed_callbacks_again(self):
+        stub = StubHTTPServer(fail_first=1).start()
+        self.deliver(stub, [{'order_id': '1'}, {'order_id': '2'}])
+        # 1 failed, then was delivered again after 2
+        self.assertEqual([data['order_id'] for method, path, data, client_address in stub.requests],
+                         [['1'], ['2'], ['1']])
+
+    def test_deliver_reuses_connection(self):
+        stub = StubHTTPServer().start()
+        self.deliver(stub, [{'order_id': str(i)} for i in range(5)])
+        self.assertEqual(len(stub.requests), 5)
+        self.assertEqual(stub.connection_count, 1)
+
+
+class MailerTestCase(SimpleTestCase):
+    def setUp(self):
+        self.stub = StubSMTPServer().start()
+        self.settings_override = override_settings(EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+                                                   EMAIL_HOST=self.stub.host, EMAIL_PORT=self.stub.port,
+                                                   EMAIL_HOST_USER='', EMAIL_HOST_PASSWORD='',
+                                                   EMAIL_USE_TLS=False)
+        self.settings_override.enable()
+        self.mailer = Mailer()
+
+    def tearDown(self):
+        self.mailer._close()
+        self.settings_override.disable()
+        self.stub.stop()
+
+    def get_messages(self, count, offset=0):
+        return [EmailMessage('Order %d' % i, 'Thank you', 'no-reply@ikwen.com', ['buyer%d@ikwen.com' % i])
+                for i in range(offset, offset + count)]
+
+    def test_batches_share_connection(self):
+        self.mailer.flush(self.get_messages(3))
+        self.mailer.flush(self.get_messages(2, 3))
+        self.assertEqual(len(self.stub.messages), 5)
+        self.assertEqual(self.stub.connection_count, 1)
+        self.assertEqual(self.mailer.stats()['connections'], 1)
+        self.assertEqual(self.mailer.stats()['batches'], 2)
+
+    def test_connection_opened_again_once_closed(self):
+        self.mailer.flush(self.get_messages(2))
+        self.mailer._close()
+        self.mailer.flush(self.get_messages(2, 2))
+        self.assertEqual(len(self.stub.messages), 4)
+        self.assertEqual(self.stub.connection_count, 2)
+
+    def test_identical_messages_collapsed(self):
+        messages = [EmailMessage('New order', 'Check it out', 'no-reply@ikwen.com', bcc=['provider%d@ikwen.com' % i])
+                    for i in range(3)]
+        self.mailer.flush(messages)
+        self.assertEqual(len(self.stub.messages), 1)
+        self.assertEqual(self.stub.recipient_count, 3)
+
+    def hold_outbox(self):
+        outbox_dir = tempfile.mkdtemp(prefix='test_outbox_')
+        executor = jobs.JobExecutor(jobs.Outbox(os.path.join(outbox_dir, 'outbox.sqlite3')), sweep_interval=3600)
+        previous_executor, jobs._executor = jobs._executor, executor
+
+        def restore():
+            jobs._executor = previous_executor
+            executor.stop()
+            shutil.rmtree(outbox_dir, ignore_errors=True)
+
+        self.addCleanup(restore)
+        return executor.outbox
+
+    @override_settings(UNIT_TESTING=False)
+    def test_sent_messages_deleted_from_outbox(self):
+        outbox = self.hold_outbox()
+        for msg in self.get_messages(3):
+            self.mailer.send(msg)
+        self.assertTrue(self.mailer.drain())
+        self.assertEqual(len(self.stub.messages), 3)
+        self.assertEqual(outbox.count(), {})
+
+    @override_settings(UNIT_TESTING=False)
+    def test_unsent_messages_left_in_outbox(self):
+        outbox = self.hold_outbox()
+        self.stub.stop()
+        for msg in self.get_messages(3):
+            self.mailer.send(msg)
+        self.assertTrue(self.mailer.drain())
+        self.assertEqual(outbox.count(), {jobs.PENDING: 3})
@@ -1,15 +1,14 @@
 # -*- coding: utf-8 -*-
+import json
 import logging
 from datetime import datetime
-from threading import Thread
 
-import requests
 from currencies.context_processors import currencies
 from django.conf import settings
 from django.contrib.auth.models import Group
 from django.core.mail import EmailMessage
 from django.core.urlresolvers import reverse
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseBadRequest
 from django.http.response import HttpResponseRedirect
 from django.shortcuts import get_object_or_404
 from django.utils.translation import gettext as _, activate
@@ -17,13 +16,9 @@ from django.utils.translation import gettext as _, activate
 from ikwen.accesscontrol.backends import UMBRELLA
 from ikwen.accesscontrol.models import SUDO, Member
 from ikwen.core.models import Service, Application
-from ikwen.core.utils import get_service_instance, add_event, add_database, set_counters, increment_history_field, \
-    get_mail_content, XEmailMessage
-from ikwen.rewarding.models import Reward
-from ikwen.rewarding.utils import reward_member
+from ikwen.core.utils import add_event, XEmailMessage
 
-from ikwen_kakocase.kako.utils import mark_duplicates
-from ikwen_kakocase.kakocase.models import OperatorProfile, SOLD_OUT_EVENT, NEW_ORDER_EVENT
+from ikwen_kakocase.kakocase.models import OperatorProfile, ProductCategory, NEW_ORDER_EVENT
 from ikwen_kakocase.kako.models import Product
 from ikwen_kakocase.shopping.utils import parse_order_info, send_order_confirmation_sms, set_logicom_earnings_and_stats
 from ikwen_kakocase.shopping.models import Customer
@@ -36,16 +31,38 @@ from daraja.models import Dara
 
 from daraja.models import DARAJA, REFEREE_JOINED_EVENT
 
+from conf import startup
+from conf.routing import route_stats
+
+from playground import jobs, mail, progression, stock
+from playground.counters import CounterBuffer
+from playground.daras import get_dara
+from playground.db import get_registry, use_database
+from playground.identity import get_identity_map, identity_map_stats, unit_of_work
+from playground.instrumentation import profiled, checkpoint, profile_stats
+from playground.ledger import EarningsLedger, get_settler
+from playground.pipeline import run_stage, CONFIRMATION, SETTLEMENT, REWARDS, NOTIFICATIONS
+from playground.recipients import get_recipients
+from playground.referrals import notify_referee_joined
+from playground.replication import get_mirrors, get_replicator
+from playground.rewards import grant as grant_rewards, get_issuer, get_rules
+from playground.models import OrderRollup
+from playground.rollups import PERIODS, get_order_counters, get_report
+from playground.webhooks import WebhookBatch, get_dispatcher
+
 logger = logging.getLogger('ikwen')
 
 
+@profiled
+@unit_of_work
 def set_momo_order_checkout(request, payment_mean, *args, **kwargs):
     """
     This function has no URL associated with it.
     It serves as ikwen setting "MOMO_BEFORE_CHECKOUT"
     """
-    service = get_service_instance()
+    service = get_identity_map().get_service_instance()
     config = service.config
+    checkpoint('parse_order_info')
     if getattr(settings, 'DEBUG', False):
         order = parse_order_info(request)
     else:
@@ -55,9 +72,18 @@ def set_momo_order_checkout(request, payment_mean, *args, **kwargs):
             return HttpResponseRedirect(reverse('shopping:checkout'))
     order.retailer = service
     order.payment_mean = payment_mean
+    checkpoint('save')
     order.save()  # Save first to generate the Order id
     order = Order.objects.get(pk=order.id)  # Grab the newly created object to avoid create another one in subsequent save()
 
+    if getattr(settings, 'PLAYGROUND_STOCK_RESERVATION', False):
+        checkpoint('reserve_stock')
+        try:
+            stock.reserve(order.id, stock.get_units(order))
+        except stock.InsufficientStock:
+            return HttpResponseRedirect(reverse('shopping:checkout'))
+
+    checkpoint('finalize')
     member = request.user
     if member.is_authenticated():
         order.member = member
@@ -70,14 +96,70 @@ def set_momo_order_checkout(request, payment_mean, *args, **kwargs):
     request.session['amount'] = order.total_cost
 
 
+@profiled
+@unit_of_work
 def confirm_checkout(request, *args, **kwargs):
     order_id = request.session.get('object_id')
     order = get_object_or_404(Order, pk=order_id)
 
+    # Payment gateways may notify several times for the same payment.
+    # Only the first notification gets the order processed.
     order.status = Order.PENDING
-    order.save()
+    checkpoint('claim')
+    if not run_stage(order.id, CONFIRMATION, order.save):
+        return HttpResponse("Notification received")
+
+    checkpoint('process')
+    crcy = currencies(request)['CURRENCY']
+    if getattr(settings, 'PLAYGROUND_ASYNC_CHECKOUT', False):
+        jobs.submit(process_order, order.id, crcy)
+    else:
+        process_order(order.id, crcy)
+
+    return HttpResponse("Notification received")
 
-    after_order_confirmation(order)
+
+@profiled
+@unit_of_work
+def process_order(order_id, crcy, retry=False):
+    """
+    Settles, rewards and notifies a confirmed order. Each stage runs at
+    most once per order, so that processing the same order again never
+    credits balances or decrements stock twice. Processing stops at the
+    first failed stage; failed stages, and stages stalled in a process
+    that stopped, run again only with retry=True. The failure is logged
+    with the order and stage, and the stage is marked failed so that
+    process_orders --failed finds the order.
+    """
+    order = Order.objects.get(pk=order_id)
+    rewards = {}
+    stage = None
+    try:
+        if retry:
+            stage = CONFIRMATION
+            order.status = Order.PENDING
+            run_stage(order.id, CONFIRMATION, order.save, retry=True)
+        stage = SETTLEMENT
+        run_stage(order.id, SETTLEMENT, after_order_confirmation, order, retry=retry)
+        stage = REWARDS
+        if not run_stage(order.id, REWARDS, reward_buyer, order, rewards, retry=retry):
+            # Rewarded before, tell the buyer the same coupons again
+            rewards['reward_pack_list'], rewards['coupon_count'] = get_rules(order.retailer).evaluate(order.items_cost)
+        stage = NOTIFICATIONS
+        run_stage(order.id, NOTIFICATIONS, notify_buyer, order, crcy, rewards.get('reward_pack_list'),
+                  rewards.get('coupon_count'), retry=retry)
+    except Exception:
+        logger.error("Processing of Order %s stopped at stage %s, run process_orders --failed --retry once fixed" %
+                     (order_id, stage), exc_info=True, extra={'order_id': order_id, 'stage': stage})
+
+
+@profiled
+def reward_buyer(order, rewards):
+    rewards['reward_pack_list'], rewards['coupon_count'] = grant_rewards(order)
+
+
+@profiled
+def notify_buyer(order, crcy, reward_pack_list=None, coupon_count=None):
     member = order.member
     buyer_name = member.full_name
     buyer_email = order.delivery_address.email
@@ -85,53 +167,59 @@ def confirm_checkout(request, *args, **kwargs):
 
     activate(member.language)
     subject = _("Order successful")
-    reward_pack_list, coupon_count = reward_member(order.retailer, member, Reward.PAYMENT,
-                                                   amount=order.items_cost, model_name='trade.Order')
     try:
-        dara = Dara.objects.using(UMBRELLA).get(member=member)
+        dara = get_identity_map().get(Dara, UMBRELLA, member=member)
     except:
         dara = None
-    send_order_confirmation_email(request, subject, buyer_name, buyer_email, dara, order, reward_pack_list=reward_pack_list)
-    if getattr(settings, 'UNIT_TESTING', False):
-        send_order_confirmation_sms(buyer_name, buyer_phone, order)
-    else:
-        Thread(target=send_order_confirmation_sms, args=(buyer_name, buyer_phone, order)).start()
-
-    return HttpResponse("Notification received")
+    checkpoint('email')
+    send_order_confirmation_email(None, subject, buyer_name, buyer_email, dara, order,
+                                  reward_pack_list=reward_pack_list, crcy=crcy, coupon_count=coupon_count)
+    checkpoint('sms')
+    jobs.submit(send_order_confirmation_sms, buyer_name, buyer_phone, order)
 
 
+@profiled
 def after_order_confirmation(order, update_stock=True):
     member = order.member
-    service = get_service_instance()
+    identity = get_identity_map()
+    service = identity.get_service_instance()
     config = service.config
     delcom = order.delivery_option.company
     delcom_db = delcom.database
-    add_database(delcom_db)
-    delcom_profile_original = OperatorProfile.objects.using(delcom_db).get(pk=delcom.config.id)
+    use_database(delcom_db)
+    delcom_profile_original = identity.get(OperatorProfile, delcom_db, pk=delcom.config.id)
     dara, dara_service_original, provider_mirror = None, None, None
     sudo_group = Group.objects.get(name=SUDO)
     customer = member.customer
     referrer = customer.referrer
     referrer_share_rate = 0
+    counters = get_order_counters(order)
+    mirrors = get_mirrors(counters)
 
     # Test if the customer has been referred
+    checkpoint('referrer')
     if referrer:
         referrer_db = referrer.database
-        add_database(referrer_db)
+        use_database(referrer_db)
         try:
-            dara = Dara.objects.get(member=referrer.member)
+            dara = identity.get(Dara, member=referrer.member)
         except Dara.DoesNotExist:
             logging.error("%s - Dara %s not found" % (service.project_name, member.username))
         try:
-            dara_service_original = Service.objects.using(referrer_db).get(pk=referrer.id)
+            dara_service_original = identity.get(Service, referrer_db, pk=referrer.id)
         except Dara.DoesNotExist:
             logging.error("%s - Dara service not found in %s database for %s" % (service.project_name, referrer_db, referrer.project_name))
         try:
-            provider_mirror = Service.objects.using(referrer_db).get(pk=service.id)
+            provider_mirror = identity.get(Service, referrer_db, pk=service.id)
         except Service.DoesNotExist:
             logging.error("%s - Provider Service not found in %s database for %s" % (service.project_name, referrer_db, referrer.project_name))
 
+    checkpoint('split_into_packages')
     packages_info = order.split_into_packages(dara)
+    webhooks = WebhookBatch()
+    ledger = EarningsLedger(order.id)
+
+    checkpoint('settlement')
 
     if delcom != service and delcom_profile_original.payment_delay == OperatorProfile.STRAIGHT:
         set_logicom_earnings_and_stats(order)
@@ -148,124 +236,126 @@ def after_order_confirmation(order, update_stock=True):
             provider_revenue += order.delivery_option.packing_cost
             provider_earnings += order.delivery_option.packing_cost * (100 - config.ikwen_share_rate) / 100
         provider_profile_umbrella = packages_info[provider_db]['provider_profile']
+        use_database(provider_db)
         provider_profile_original = provider_profile_umbrella.get_from(provider_db)
         provider_original = provider_profile_original.service
 
         if delcom == service:
-            provider_original.raise_balance(provider_earnings, provider=order.payment_mean.slug)
+            ledger.credit(provider_original, provider_db, provider_earnings, order.payment_mean.slug)
         else:
             if delcom_profile_original.return_url:
                 nvp_dict = package.get_nvp_api_dict()
-                Thread(target=lambda url, data: requests.post(url, data=data),
-                       args=(delcom_profile_original.return_url, nvp_dict)).start()
+                webhooks.add(delcom_profile_original.return_url, nvp_dict)
             if provider_profile_original.payment_delay == OperatorProfile.STRAIGHT:
                 if package.provider_earnings > 0:
-                    provider_original.raise_balance(provider_earnings, provider=order.payment_mean.slug)
+                    ledger.credit(provider_original, provider_db, provider_earnings, order.payment_mean.slug)
         if provider_profile_original.return_url:
             nvp_dict = package.get_nvp_api_dict()
-            Thread(target=lambda url, data: requests.post(url, data=data),
-                   args=(provider_profile_original.return_url, nvp_dict)).start()
-
-    set_counters(config)
-    increment_history_field(config, 'orders_count_history')
-    increment_history_field(config, 'items_traded_history', order.items_count)
-    increment_history_field(config, 'turnover_history', provider_revenue)
-    increment_history_field(config, 'earnings_history', provider_earnings)
-
-    set_counters(customer)
-    customer.last_payment_on = datetime.now()
-    increment_history_field(customer, 'orders_count_history')
-    increment_history_field(customer, 'items_purchased_history', order.items_count)
-    increment_history_field(customer, 'turnover_history', provider_revenue)
-    increment_history_field(customer, 'earnings_history', provider_earnings)
+            webhooks.add(provider_profile_original.return_url, nvp_dict)
+
+    ledger.commit()
+    webhooks.dispatch()
+
+    checkpoint('counters')
+    counters.set_counters(config)
+    counters.increment(config, 'orders_count_history')
+    counters.increment(config, 'items_traded_history', order.items_count)
+    counters.increment(config, 'turnover_history', provider_revenue)
+    counters.increment(config, 'earnings_history', provider_earnings)
+
+    counters.set_counters(customer)
+    counters.set_field(customer, 'last_payment_on', datetime.now())
+    counters.increment(customer, 'orders_count_history')
+    counters.increment(customer, 'items_purchased_history', order.items_count)
+    counters.increment(customer, 'turnover_history', provider_revenue)
+    counters.increment(customer, 'earnings_history', provider_earnings)
 
     # Test whether the referrer (of the current customer) is a Dara
     if dara:
         referrer_share_rate = dara.share_rate
         send_dara_notification_email(dara_service_original, order)
 
-        set_counters(dara)
-        dara.last_transaction_on = datetime.now()
+        counters.set_counters(dara)
+        counters.set_field(dara, 'last_transaction_on', datetime.now())
 
-        increment_history_field(dara, 'orders_count_history')
-        increment_history_field(dara, 'items_traded_history', order.items_count)
-        increment_history_field(dara, 'turnover_history', provider_revenue)
-        increment_history_field(dara, 'earnings_history', provider_earnings)
+        counters.increment(dara, 'orders_count_history')
+        counters.increment(dara, 'items_traded_history', order.items_count)
+        counters.increment(dara, 'turnover_history', provider_revenue)
+        counters.increment(dara, 'earnings_history', provider_earnings)
 
         if dara_service_original:
-            set_counters(dara_service_original)
-            increment_history_field(dara_service_original, 'transaction_count_history')
-            increment_history_field(dara_service_original, 'turnover_history', raw_provider_revenue)
-            increment_history_field(dara_service_original, 'earnings_history', order.referrer_earnings)
+            mirrors.set_counters(dara_service_original)
+            mirrors.increment(dara_service_original, 'transaction_count_history')
+            mirrors.increment(dara_service_original, 'turnover_history', raw_provider_revenue)
+            mirrors.increment(dara_service_original, 'earnings_history', order.referrer_earnings)
 
         if dara_service_original:
-            set_counters(provider_mirror)
-            increment_history_field(provider_mirror, 'transaction_count_history')
-            increment_history_field(provider_mirror, 'turnover_history', raw_provider_revenue)
-            increment_history_field(provider_mirror, 'earnings_history', order.referrer_earnings)
-
-        try:
-            member_ref = Member.objects.using(referrer_db).get(pk=member.id)
-        except Member.DoesNotExist:
-            member.save(using=referrer_db)
-            member_ref = Member.objects.using(referrer_db).get(pk=member.id)
-            member.customer.save(using=referrer_db)
-        customer_ref = member_ref.customer
-        set_counters(customer_ref)
-        customer_ref.last_payment_on = datetime.now()
-        increment_history_field(customer_ref, 'orders_count_history')
-        increment_history_field(customer_ref, 'items_purchased_history', order.items_count)
-        increment_history_field(customer_ref, 'turnover_history', raw_provider_revenue)
-        increment_history_field(customer_ref, 'earnings_history', order.retailer_earnings)
-
-        dara_umbrella = Dara.objects.using(UMBRELLA).get(member=dara.member)
-        if dara_umbrella.level == 1 and dara_umbrella.xp == 2:
-            dara_umbrella.xp = 3
-            dara_umbrella.raise_bonus_cash(200)
-            dara_umbrella.save()
+            mirrors.set_counters(provider_mirror)
+            mirrors.increment(provider_mirror, 'transaction_count_history')
+            mirrors.increment(provider_mirror, 'turnover_history', raw_provider_revenue)
+            mirrors.increment(provider_mirror, 'earnings_history', order.referrer_earnings)
+
+        # Mirror of the customer in the referrer database
+        mirrors.ensure(member, referrer_db)
+        mirrors.ensure(customer, referrer_db)
+        mirrors.set_counters(customer, referrer_db)
+        mirrors.set_field(customer, 'last_payment_on', datetime.now(), referrer_db)
+        mirrors.increment(customer, 'orders_count_history', db=referrer_db)
+        mirrors.increment(customer, 'items_purchased_history', order.items_count, referrer_db)
+        mirrors.increment(customer, 'turnover_history', raw_provider_revenue, referrer_db)
+        mirrors.increment(customer, 'earnings_history', order.retailer_earnings, referrer_db)
+
+        progression.FIRST_REFEREE_PURCHASE.apply(dara.member)
 
     category_list = []
 
     # Adding a 100 bonus in dara account to have buy online
-    try:
-        dara_as_buyer = Dara.objects.using(UMBRELLA).get(member=member)
-        if dara_as_buyer.level == 1 and dara_as_buyer.xp == 0:
-            dara_as_buyer.xp = 1
-            dara_as_buyer.raise_bonus_cash(100)
-            dara_as_buyer.save()
-    except Dara.DoesNotExist:
-        logging.error("The customer is not yet a Dara")
-
+    progression.FIRST_PURCHASE.apply(member)
+
+    checkpoint('entries')
+    # Load everything the entries need in one query per model, whatever the size of the cart
+    product_ids = set(entry.product.id for entry in order.entries)
+    product_dict = dict((product.id, product) for product in Product.objects.filter(pk__in=product_ids))
+    category_ids = set(product.category_id for product in product_dict.values())
+    category_dict = dict((category.id, category) for category in ProductCategory.objects.filter(pk__in=category_ids))
+    provider_ids = set(product.provider_id for product in product_dict.values())
+    provider_profile_dict = dict((profile.service_id, profile) for profile in
+                                 OperatorProfile.objects.using(UMBRELLA).filter(service__in=provider_ids))
+
+    units_sold = {}
     for entry in order.entries:
-        product = Product.objects.get(pk=entry.product.id)
-        provider_service = product.provider
-        provider_profile_umbrella = OperatorProfile.objects.using(UMBRELLA).get(service=provider_service)
-        category = product.category
+        product = product_dict[entry.product.id]
+        provider_profile_umbrella = provider_profile_dict[product.provider_id]
+        category = category_dict[product.category_id]
 
         turnover = entry.count * product.retail_price
-        set_counters(category)
+        counters.set_counters(category)
         provider_earnings = turnover * (100 - referrer_share_rate - provider_profile_umbrella.ikwen_share_rate) / 100
-        increment_history_field(category, 'earnings_history', provider_earnings)
-        increment_history_field(category, 'turnover_history', turnover)
-        increment_history_field(category, 'items_traded_history', entry.count)
-        if category not in category_list:
-            increment_history_field(category, 'orders_count_history')
-            category_list.append(category)
-
-        if update_stock:
-            product.stock -= entry.count
-            if product.stock == 0:
-                add_event(service, SOLD_OUT_EVENT, group_id=sudo_group.id, object_id=product.id)
-                mark_duplicates(product)
-        product.save()
-        set_counters(product)
-        increment_history_field(product, 'units_sold_history', entry.count)
-
+        counters.increment(category, 'earnings_history', provider_earnings)
+        counters.increment(category, 'turnover_history', turnover)
+        counters.increment(category, 'items_traded_history', entry.count)
+        if category.id not in category_list:
+            counters.increment(category, 'orders_count_history')
+            category_list.append(category.id)
+
+        units_sold[product.id] = units_sold.get(product.id, 0) + entry.count
+        counters.set_counters(product)
+        counters.increment(product, 'units_sold_history', entry.count)
+
+    if update_stock:
+        checkpoint('stock')
+        sold_out = stock.commit(order.id, units_sold)
+        if sold_out:
+            stock.fire_sold_out(service, sold_out, sudo_group)
+
+    checkpoint('commit')
+    mirrors.commit()
+    counters.commit()
     add_event(service, NEW_ORDER_EVENT, group_id=sudo_group.id, object_id=order.id)
 
 
 def send_dara_notification_email(dara_service, order):
-    service = get_service_instance()
+    service = get_identity_map().get_service_instance()
     config = service.config
     template_name = 'playground/mails/new_transaction_test.html'
 
@@ -273,62 +363,107 @@ def send_dara_notification_email(dara_service, order):
     subject = _("New transaction on Playground")
     try:
         dashboard_url = 'https://daraja.ikwen.com/daraja/dashboard/'
-        html_content = get_mail_content(subject, template_name=template_name,
-                                        extra_context={'currency_symbol': config.currency_symbol,
-                                                       'amount': order.items_cost,
-                                                       'dara_earnings': order.referrer_earnings,
-                                                       'transaction_time': order.updated_on.strftime('%Y-%m-%d %H:%M:%S'),
-                                                       'account_balance': dara_service.balance,
-                                                       'dashboard_url': dashboard_url,
-                                                       'dara': dara_service
-                                                       })
+        html_content = mail.render(subject, template_name=template_name,
+                                   extra_context={'currency_symbol': config.currency_symbol,
+                                                  'amount': order.items_cost,
+                                                  'dara_earnings': order.referrer_earnings,
+                                                  'transaction_time': order.updated_on.strftime('%Y-%m-%d %H:%M:%S'),
+                                                  'account_balance': dara_service.balance,
+                                                  'dashboard_url': dashboard_url,
+                                                  'dara': dara_service
+                                                  })
         sender = 'Daraja Playground <no-reply@ikwen.com>'
         msg = EmailMessage(subject, html_content, sender, [dara_service.member.email])
         msg.content_subtype = "html"
-        Thread(target=lambda m: m.send(), args=(msg,)).start()
+        mail.send(msg)
     except:
         logger.error("Failed to notify %s Dara after follower purchase." % service, exc_info=True)
 
 
 def send_order_confirmation_email(request, subject, buyer_name, buyer_email, dara, order, message=None,
-                                  reward_pack_list=None):
-    service = get_service_instance()
-    coupon_count = 0
+                                  reward_pack_list=None, crcy=None, coupon_count=None):
+    identity = get_identity_map()
+    service = identity.get_service_instance()
     if reward_pack_list:
         template_name = 'shopping/mails/order_notice_with_reward.html'
-        for pack in reward_pack_list:
-            coupon_count += pack.count
+        if coupon_count is None:
+            coupon_count = sum(pack.count for pack in reward_pack_list)
     else:
+        coupon_count = 0
         template_name = 'playground/mails/order_notice.html'
     # invitation_url = 'https://daraja.ikwen.com/daraja/companies/'
     invitation_url = 'https://daraja.ikwen.com/'
-    crcy = currencies(request)['CURRENCY']
+    if crcy is None:
+        crcy = currencies(request)['CURRENCY']
     sender = 'Daraja Playground <no-reply@ikwen.com>'
     extra_context = {'buyer_name': buyer_name, 'order': order, 'message': message,
                      'IS_BANK': getattr(settings, 'IS_BANK', False),
                      'coupon_count': coupon_count, 'crcy': crcy, 'dara': dara}
     if dara:
         extra_context['invitation_url'] = invitation_url
-    html_content = get_mail_content(subject, template_name=template_name, extra_context=extra_context)
+    html_content = mail.render(subject, template_name=template_name, extra_context=extra_context)
 
     msg = XEmailMessage(subject, html_content, sender, [buyer_email])
-    bcc = [email.strip() for email in service.config.notification_email.split(',') if email.strip()]
+    bcc = get_recipients(service, service.config)
     delcom = order.delivery_option.company
     if service != delcom:
-        db = delcom.database
-        add_database(db)
         try:
-            delcom_config = OperatorProfile.objects.using(db).get(service=delcom)
-            bcc += [email.strip() for email in delcom_config.notification_email.split(',') if email.strip()]
-            bcc.append(delcom.member.email)
+            bcc = bcc + get_recipients(delcom)
         except:
-            pass
-    bcc.append(service.member.email)
+            logger.error("%s - Could not get notification recipients of %s" % (service.project_name, delcom),
+                         exc_info=True)
     msg.bcc = list(set(bcc))
     msg.content_subtype = "html"
-    Thread(target=lambda m: m.send(), args=(msg,)).start()
+    mail.send(msg)
 
 
+def runtime_stats(request, *args, **kwargs):
+    """
+    Exposes counters of the background job executor, webhook dispatcher,
+    tenant database registry, identity map, mailer, mirror replicator,
+    earnings settler and reward issuer, the stage profile of the checkout path, the startup
+    report of the worker and route hits for monitoring.
+    """
+    stats = {
+        'jobs': jobs.get_executor().stats(),
+        'webhooks': get_dispatcher().stats(),
+        'databases': get_registry().stats(),
+        'identity_map': identity_map_stats(),
+        'mail': mail.get_mailer().stats(),
+        'replication': get_replicator().stats(),
+        'settlement': get_settler().stats(),
+        'rewards': get_issuer().stats(),
+        'profile': profile_stats(),
+        'startup': startup.report(),
+        'routes': route_stats(),
+    }
+    return HttpResponse(json.dumps(stats), 'application/json')
+
+
+def order_rollups(request, *args, **kwargs):
+    """
+    Reports orders, items traded, turnover and earnings of the current
+    service over the last `count` days, weeks or months, `period` being
+    Daily, Weekly or Monthly. Read from the rollups folded by the
+    rollup_orders command, which are only recorded when
+    PLAYGROUND_ORDER_ROLLUPS is True.
+    """
+    period = request.GET.get('period', OrderRollup.DAILY)
+    try:
+        count = int(request.GET.get('count', 30))
+    except ValueError:
+        count = 0
+    if period not in PERIODS or not 0 < count <= 366:
+        return HttpResponseBadRequest("period must be one of %s and count between 1 and 366" % ', '.join(PERIODS))
+    config = get_identity_map().get_service_instance().config
+    report = get_report(config, ['orders_count_history', 'items_traded_history', 'turnover_history',
+                                 'earnings_history'], period, count)
+    for field, buckets in report.items():
+        report[field] = [(start.isoformat(), value) for start, value in buckets]
+    return HttpResponse(json.dumps({'period': period, 'rollups': report}), 'application/json')
+
+
+@unit_of_work
 def referee_registration_callback(request, *args, **kwargs):
     """
     This function should run upon registration. This is achieved
@@ -338,13 +473,14 @@ def referee_registration_callback(request, *args, **kwargs):
     referrer = request.COOKIES.get('referrer')
     if referrer:
         try:
-            service = kwargs.get('service', get_service_instance())
+            service = kwargs.get('service') or get_identity_map().get_service_instance()
             dara_member = Member.objects.get(pk=referrer)
             set_customer_dara(service, dara_member, request.user)
         except:
             pass
 
 
+@profiled
 def set_customer_dara(service, referrer, member):
     """
     Binds referrer to member referred.
@@ -353,49 +489,38 @@ def set_customer_dara(service, referrer, member):
     :param member: Referred Member
     :return:
     """
+    identity = get_identity_map()
     try:
+        checkpoint('bind')
         db = service.database
-        add_database(db)
-        app = Application.objects.using(db).get(slug=DARAJA)
-        dara_service = Service.objects.using(db).get(app=app, member=referrer)
+        use_database(db)
+        app = identity.get(Application, db, slug=DARAJA)
+        dara_service = identity.get(Service, db, app=app, member=referrer)
         customer, change = Customer.objects.using(db).get_or_create(member=member)
         if customer.referrer:
             return
 
-        dara_umbrella = Dara.objects.using(UMBRELLA).get(member=referrer)
-        if dara_umbrella.level == 1 and dara_umbrella.xp == 1:
-            dara_umbrella.xp = 2
-            dara_umbrella.raise_bonus_cash(100)
-            dara_umbrella.save()
+        dara_umbrella = identity.get(Dara, UMBRELLA, member=referrer)
+        progression.FIRST_REFEREE.apply(referrer, dara_umbrella)
 
         customer.referrer = dara_service
         customer.save()
 
+        checkpoint('mirror')
         dara_db = dara_service.database
-        add_database(dara_db)
-        member.save(using=dara_db)
-        customer.save(using=dara_db)
-        service_mirror = Service.objects.using(dara_db).get(pk=service.id)
-        set_counters(service_mirror)
-        increment_history_field(service_mirror, 'community_history')
+        counters = CounterBuffer()
+        mirrors = get_mirrors(counters)
+        mirrors.save(member, dara_db)
+        mirrors.save(customer, dara_db)
+        mirrors.set_counters(service, dara_db)
+        mirrors.increment(service, 'community_history', db=dara_db)
+        mirrors.commit()
+        counters.commit()
 
         add_event(service, REFEREE_JOINED_EVENT, member)
 
-        diff = datetime.now() - member.date_joined
-
-        activate(referrer.language)
-        sender = "%s via Playground <no-reply@ikwen.com>" % member.full_name
-        if diff.days > 1:
-            subject = _("I'm back on %s !" % service.project_name)
-        else:
-            subject = _("I just joined %s !" % service.project_name)
-        html_content = get_mail_content(subject, template_name='playground/mails/referee_joined.html',
-                                        extra_context={'referred_service_name': service.project_name, 'referee': member,
-                                                       'dara': dara_umbrella, 'cta_url': 'https://daraja.ikwen.com/'
-                                                       })
-        msg = EmailMessage(subject, html_content, sender, [referrer.email])
-        msg.content_subtype = "html"
-        Thread(target=lambda m: m.send(), args=(msg, )).start()
+        checkpoint('mail')
+        notify_referee_joined(service, referrer, member, dara_umbrella)
     except:
         logger.error("%s - Error while setting Customer Dara", exc_info=True)
 
@@ -405,7 +530,7 @@ class PlaygroundCart(Cart):
     def get_context_data(self, **kwargs):
         context = super(PlaygroundCart, self).get_context_data(**kwargs)
         try:
-            context['dara'] = Dara.objects.get(member=self.request.user)
+            context['dara'] = get_dara(self.request.user)
         except:
-            pass
+            logger.error("Could not get the Dara status of %s" % self.request.user, exc_info=True)
         return context
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+from collections import OrderedDict
+from urlparse import urlparse
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from playground import jobs
+
+logger = logging.getLogger('ikwen')
+
+
+class WebhookDispatcher(object):
+    """
+    Posts callbacks to partner return_url. Keeps one requests Session per
+    host so connections are reused from one callback to the next, and
+    applies a timeout and retries with exponential backoff on connection
+    errors. Read errors and 5xx responses are left to the retry of the
+    deliver job: the partner may have processed the callback already, and
+    retrying in both places would send it several times.
+    """
+    def __init__(self, timeout=(3.05, 10), retries=3, backoff_factor=0.5, pool_size=4):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.pool_size = pool_size
+        self.sent = 0
+        self.failed = 0
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get_session(self, url):
+        parsed = urlparse(url)
+        key = (parsed.scheme, parsed.netloc)
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                retry = Retry(total=self.retries, connect=self.retries, read=0, backoff_factor=self.backoff_factor,
+                              method_whitelist=False)
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+                session = requests.Session()
+                session.mount('%s://' % parsed.scheme, adapter)
+                self._sessions[key] = session
+        return session
+
+    def post(self, url, data):
+        try:
+            response = self.get_session(url).post(url, data=data, timeout=self.timeout)
+            response.raise_for_status()
+        except:
+            self.failed += 1
+            raise
+        self.sent += 1
+        return response
+
+    def stats(self):
+        return {'hosts': len(self._sessions), 'sent': self.sent, 'failed': self.failed}
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher():
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = WebhookDispatcher(timeout=getattr(settings, 'PLAYGROUND_WEBHOOK_TIMEOUT', (3.05, 10)),
+                                            retries=getattr(settings, 'PLAYGROUND_WEBHOOK_RETRIES', 3))
+    return _dispatcher
+
+
+def deliver(url, data_list):
+    """
+    Background job posting a batch of callbacks to the same endpoint.
+    When every post fails, the job fails and the executor retries it
+    later. When only some fail, those are queued again in a new job so
+    that partners do not receive the same callback twice.
+    """
+    dispatcher = get_dispatcher()
+    failed = []
+    for data in data_list:
+        try:
+            dispatcher.post(url, data)
+        except requests.RequestException:
+            failed.append(data)
+    if len(failed) == len(data_list):
+        raise requests.RequestException("All %d callbacks to %s failed" % (len(data_list), url))
+    if failed:
+        logger.warning("%d of %d callbacks to %s failed, queued again" % (len(failed), len(data_list), url))
+        jobs.submit(deliver, url, failed)
+
+
+class WebhookBatch(object):
+    """
+    Groups the callbacks of an order by endpoint so that each endpoint
+    gets a single background job.
+    """
+    def __init__(self):
+        self._batches = OrderedDict()
+
+    def add(self, url, data):
+        self._batches.setdefault(url, []).append(data)
+
+    def dispatch(self):
+        for url, data_list in self._batches.items():
+            jobs.submit(deliver, url, data_list)
+        self._batches.clear()